@@ -6,16 +6,18 @@ Re-implementation of: https://arxiv.org/abs/2308.04455
 some features are missing from the thesis (Speaker F0 norm + F0 quant and other), results will differ.
 """
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import multiprocessing
 from pathlib import Path
-import torchaudio
 from tqdm import tqdm
 import random
 
 import torch
 import kaldiio
 
-from utils import read_kaldi_format, copy_data_dir, create_clean_dir, setup_logger, load_wav_from_scp
+from utils import read_kaldi_format, copy_data_dir, create_clean_dir, setup_logger, load_wav_from_scp, \
+    get_audio_sink, scan_audio_sink
 
 logger = setup_logger(__name__)
 
@@ -69,6 +71,7 @@ def process_data(dataset_path: Path, anon_level: str, results_dir: Path, setting
     output_path = Path(str(dataset_path) + settings['anon_suffix'])
     device = settings.get("device", "cpu")
     batch_size = settings.get("batch_size", 4)
+    output_format = settings.get("output_format", "wav")
     if anon_level == "constant":
         target_constant_spkid = settings.get("target_constant_spkid", "6081") # For constant anon_level
     tag_version = settings.get("model_tag_version", "hifigan_bn_tdnnf_wav2vec2_vq_48_v1") 
@@ -94,6 +97,10 @@ def process_data(dataset_path: Path, anon_level: str, results_dir: Path, setting
     source_utt2spk = read_kaldi_format(utt2spk)
     out_spk2target = {} # For spk anon_level
 
+    # writes happen on a single background thread while the next batch is converted
+    sink = get_audio_sink(output_format, results_dir)
+    writer_pool = ThreadPoolExecutor(max_workers=1)
+
 
     @torch.no_grad()
     def process_wav(utid, freq, audio, f0, original_len):
@@ -141,43 +148,49 @@ def process_data(dataset_path: Path, anon_level: str, results_dir: Path, setting
         wav_conv = wav_conv.cpu()
 
         def parallel_write():
+            scp_values = []
             for i in range(wav_conv.shape[0]):
                 wav = wav_conv[i]
                 if len(wav.shape) == 1:
                     wav = wav.unsqueeze(0) # batch == 1 -> len(dst) % batch == 1
                 wav = wav[:, :original_len[i]]
                 # write to buffer
-                u = utid[i]
-                output_file = results_dir / f'{u}.wav'
-                torchaudio.save(output_file, wav, freq, encoding='PCM_S', bits_per_sample=16)
-        p = multiprocessing.Process(target=parallel_write, args=())
-        p.start()
-        return p
+                scp_value, _ = sink.write(utid[i], wav, freq)
+                scp_values.append(scp_value)
+            return scp_values
+        return writer_pool.submit(parallel_write)
 
     wavs = read_kaldi_format(wav_scp)
     nj = multiprocessing.cpu_count()
     nj = min(nj, 18)
-    p = None
+    written = {} if force_compute else scan_audio_sink(output_format, results_dir)
 
     with open(wav_scp_out, 'wt', encoding='utf-8') as writer:
         filtered_wavs = {}
         for u, file in wavs.items():
-            output_file = results_dir / f'{u}.wav'
-            if output_file.exists() and not force_compute:
-                logger.debug(f'File {output_file} already exists')
-                writer.writelines(f"{u} {output_file}\n")
+            if u in written:
+                logger.debug(f'Utterance {u} already exists: {written[u]}')
+                writer.writelines(f"{u} {written[u]}\n")
             else:
                 filtered_wavs[u] = file
 
         data_loader = torch.utils.data.DataLoader(Dataset(filtered_wavs, model.get_f0), batch_size=batch_size, num_workers=nj, collate_fn=collate_fn)
+        def write_scp(utid, future):
+            writer.writelines(f"{u} {scp_value}\n" for u, scp_value in zip(utid, future.result()))
+
+        # the converted batches wait in memory until written, at most max_pending of them: beyond that the
+        # conversion waits for the oldest write
+        max_pending = 4
+        pending = deque()
         for audio, f0, original_len, utid, freq in tqdm(data_loader):
-            p = process_wav(utid, freq, audio, f0, original_len)
-            for u in utid:
-                output_file = results_dir / f'{u}.wav'
-                writer.writelines(f"{u} {output_file}\n")
+            pending.append((utid, process_wav(utid, freq, audio, f0, original_len)))
+            if len(pending) >= max_pending:
+                write_scp(*pending.popleft())
             if device.startswith("cuda"):
                 torch.cuda.empty_cache()
-    # wait for last p to write the anonymized audios
-    if p:
-        p.join()
+        # wait for the writer thread to write the remaining anonymized audios
+        while pending:
+            write_scp(*pending.popleft())
+    writer_pool.shutdown()
+    sink.close()
     logger.info('Done')
@@ -16,11 +16,12 @@ import os
 import scipy
 import scipy.signal
 import shutil
-import wave
+import tempfile
 
 from pathlib import Path
 from tqdm import tqdm
-from utils import read_kaldi_format, copy_data_dir, create_clean_dir, setup_logger, load_wav_from_scp
+from utils import read_kaldi_format, copy_data_dir, create_clean_dir, setup_logger, load_wav_from_scp, load_wav_blocks_from_scp, \
+    get_audio_sink
 
 multiprocessing.set_start_method('spawn', force=True)
 
@@ -40,7 +41,8 @@ def hash_textstring(text):
     # sha256 is deterministic, using the first 8Bytes (32bits)
     return np.abs(int(hashlib.sha256(text.encode('utf-8')).hexdigest()[:8], 16))
 
-def process_data(dataset_path: Path, anon_level: str, results_dir: Path, settings: dict, force_compute: bool):
+def process_data(dataset_path: Path, anon_level: str, results_dir: Path, settings: dict, force_compute: bool,
+                 device='cpu'):
     """
         Process data (must be in Kaldi format) in dataset_path with
         B2 (McAdams coefficients-based) anonymization.
@@ -50,6 +52,7 @@ def process_data(dataset_path: Path, anon_level: str, results_dir: Path, setting
             anon_level (str): Level of anonymization, either 'spk' or 'utt'
             settings (dict): Settings for anonymization
             settings (bool): Force re-computation even if file already exists
+            device: torch device used when settings['backend'] is 'torch'
     """
     utt2spk = None
     if anon_level == 'spk':
@@ -78,27 +81,119 @@ def process_data(dataset_path: Path, anon_level: str, results_dir: Path, setting
         rng = np.random.default_rng(hash_textstring('VPC2024'))
         mcadams_coeffs = rng.uniform(settings['mc_coeff_min'], settings['mc_coeff_max'], N)
 
-    nj = multiprocessing.cpu_count()
-    if 'nj' in settings:
-        nj = settings['nj']
-    settings["force_compute"] = force_compute
-    fn = functools.partial(process_wav, settings=settings, reader=reader, output_path=str(results_dir))
-    # the minimum utterances is 393 libri-dev-enroll, make sure chunksize=393//nj*10 > 0, otherwise scp_entries=Null
-    with multiprocessing.Pool(processes=nj) as pool:
-        scp_entries = pool.starmap(fn, tqdm(zip(mcadams_coeffs, reader.keys()), total=N), chunksize=max([1, len(reader)//(nj*10)]))
-    
+    # skip the utterances already finalised by a previous (interrupted) run
+    manifest = CompletionManifest(results_dir / 'manifest')
+    completed = manifest.read()
+    tasks = [(mcadams, utid) for mcadams, utid in zip(mcadams_coeffs, reader.keys())
+             if utid not in completed or completed[utid][2] != mcadams]
+    if len(tasks) < N:
+        logger.info(f'{N - len(tasks)}/{N} utterances already completed according to {manifest.path}')
+
+    if settings.get('backend', 'numpy') == 'torch':
+        from .anonymise_dir_mcadams_torch import process_wavs_torch
+        sink = get_audio_sink(settings.get('output_format', 'wav'), results_dir, name=f'torch{os.getpid()}')
+        with manifest, sink:
+            for entry in process_wavs_torch(tasks, reader, settings, sink, device):
+                manifest.append(*entry)
+                completed[entry[0]] = entry[1:]
+    else:
+        nj = multiprocessing.cpu_count()
+        if 'nj' in settings:
+            nj = settings['nj']
+        # each worker reads wav.scp once in its initializer, tasks are only (coeff, utt_id) tuples
+        # entries are appended to the manifest as soon as the worker finalised the file
+        with multiprocessing.Pool(processes=nj, initializer=_init_worker,
+                                  initargs=(str(wav_scp), settings, str(results_dir))) as pool, manifest:
+            entries = pool.imap_unordered(_process_wav_task, tasks, chunksize=max([1, len(tasks)//(nj*10)]))
+            for entry in tqdm(entries, total=len(tasks)):
+                manifest.append(*entry)
+                completed[entry[0]] = entry[1:]
+
     with open(path_wav_scp_out, 'wt', encoding='utf-8') as writer:
-        writer.writelines(scp_entries)
+        writer.writelines(f'{utid} {completed[utid][0]}\n' for utid in reader.keys())
     logger.info('Done')
 
-def process_wav(mcadams, utid, reader, settings, output_path):
-    output_file = Path(output_path) / f'{utid}.wav'
 
-    if output_file.exists() and not settings['force_compute']:
-        logger.debug(f'File {output_file} already exists')
-        return f'{utid} {output_file}\n'
+class CompletionManifest:
+    """
+        Append-only log of the finalised outputs of a dataset, one line
+        `utt_id scp_value size mcadams` per utterance. Outputs are complete in
+        their audio sink before they are logged, so restarts only need to read
+        this file instead of probing every output; anything not logged (e.g.
+        a file truncated by a crash) is recomputed.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._file = None
+
+    def read(self):
+        """Returns a dict utt_id -> (scp_value, size, mcadams) of the completed utterances"""
+        completed = {}
+        if not self.path.exists():
+            return completed
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                # the scp value may contain spaces (e.g. a path), the other fields cannot
+                fields = line.split(maxsplit=1)
+                fields = fields[:1] + fields[1].rsplit(maxsplit=2) if len(fields) == 2 else fields
+                # a line cut by a crash does not count as completed
+                if len(fields) != 4 or not line.endswith('\n'):
+                    continue
+                utid, scp_value, size, mcadams = fields
+                completed[utid] = (scp_value, int(size), float(mcadams))
+        return completed
+
+    def append(self, utid, scp_value, size, mcadams):
+        # one write per line, flushed immediately
+        self._file.write(f'{utid} {scp_value} {size} {float(mcadams)!r}\n')
+        self._file.flush()
+
+    def __enter__(self):
+        # terminate a line cut by a crash so that it is not merged with the next entry
+        cut_line = False
+        if self.path.exists() and self.path.stat().st_size > 0:
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                cut_line = f.read(1) != b'\n'
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if cut_line:
+            self._file.write('\n')
+        return self
+
+    def __exit__(self, *args):
+        self._file.close()
+        self._file = None
+
+# per-process state of the pool workers, filled once by _init_worker
+_worker_state = {}
+
+def _init_worker(wav_scp, settings, output_path):
+    """Pool initializer: load the wav.scp index once per worker instead of
+    pickling it with every chunk of tasks"""
+    _worker_state['reader'] = read_kaldi_format(wav_scp)
+    _worker_state['settings'] = settings
+    # one shard per worker when writing shards
+    _worker_state['sink'] = get_audio_sink(settings.get('output_format', 'wav'), output_path,
+                                           name=f'worker{os.getpid()}')
+
+def _process_wav_task(task):
+    mcadams, utid = task
+    return process_wav(mcadams, utid, **_worker_state)
+
+def process_wav(mcadams, utid, reader, settings, sink):
+    """
+        Anonymize utterance utid and write it to sink.
 
+        Returns:
+            the manifest entry (utid, wav.scp value, size, mcadams)
+    """
     file = reader[utid]
+    if settings.get('streaming', False):
+        blocks, freq = stream_anonymized_wav(mcadams, file, settings, spill_dir=sink.out_dir)
+        scp_value, size = sink.write_blocks(utid, blocks, freq)
+        return utid, scp_value, size, mcadams
+
     samples, freq = load_wav_from_scp(file)
     samples = samples.squeeze(0).numpy()
 
@@ -111,20 +206,75 @@ def process_wav(mcadams, utid, reader, settings, output_path):
         shiftLengthinms=settings['shiftLengthinms'],
         lp_order=settings['n_coeffs'], mcadams=mcadams)
 
+    scp_value, size = save_anonymized_wav(sink, utid, samples, freq)
+
+    #return the manifest entry
+    return utid, scp_value, size, mcadams
+
+
+def save_anonymized_wav(sink, utid, samples, freq):
+    """Peak-normalise the anonymized float samples to int16 and write them to sink"""
     # convert float to int16
     samples = (samples / np.max(np.abs(samples)) \
                 * (np.iinfo(np.int16).max - 1)).astype(np.int16)
 
-    # write to buffer
-    with output_file.open('wb') as file:
-        with wave.open(file, 'wb') as stream:
-            stream.setframerate(freq)
-            stream.setnchannels(1)
-            stream.setsampwidth(2)
-            stream.writeframes(samples)
+    return sink.write(utid, samples, freq)
+
+
+def stream_anonymized_wav(mcadams, wav, settings, spill_dir=None):
+    """
+        Streaming counterpart of process_wav for long recordings: the input is
+        read in blocks of settings['stream_block_size'] samples and anonymized
+        with anonym_v2_stream.
+
+        The in-memory path scales the output by its global peak, which is only
+        known at the end. settings['stream_norm'] selects how this is handled:
+            'two_pass' (default): the float output is spilled to a temporary
+                file in spill_dir, then rescaled by its peak. The int16
+                samples are identical to the in-memory path.
+            'fixed_gain': the output is multiplied by settings['stream_gain']
+                (default 1.0) and clipped, in a single pass.
+
+        Returns:
+            a generator of int16 blocks and the sampling rate
+    """
+    blocksize = settings.get('stream_block_size', 480000)
+    norm = settings.get('stream_norm', 'two_pass')
+    if norm not in ('two_pass', 'fixed_gain'):
+        raise ValueError(f'Unknown stream_norm {norm}, expected two_pass or fixed_gain')
+    int16_max = np.iinfo(np.int16).max - 1
+
+    blocks, freq = load_wav_blocks_from_scp(wav, blocksize)
+    anonymized_blocks = anonym_v2_stream(freq=freq, blocks=blocks,
+        winLengthinms=settings['winLengthinms'],
+        shiftLengthinms=settings['shiftLengthinms'],
+        lp_order=settings['n_coeffs'], mcadams=mcadams)
 
-    #return the .scp entry
-    return f'{utid} {output_file}\n'
+    def fixed_gain():
+        gain = settings.get('stream_gain', 1.0) * int16_max
+        for samples in anonymized_blocks:
+            yield np.clip(samples * gain, -int16_max, int16_max).astype(np.int16)
+
+    def two_pass():
+        # first pass spills the float output and tracks the peak
+        peak, dtype = 0, None
+        with tempfile.TemporaryFile(dir=spill_dir) as spill:
+            for samples in anonymized_blocks:
+                if len(samples) == 0:
+                    continue
+                peak = max(peak, np.max(np.abs(samples)))
+                dtype = samples.dtype
+                spill.write(samples.tobytes())
+
+            # second pass rescales exactly like the in-memory path
+            spill.seek(0)
+            while dtype is not None:
+                samples = np.frombuffer(spill.read(blocksize * np.dtype(dtype).itemsize), dtype=dtype)
+                if len(samples) == 0:
+                    break
+                yield (samples / peak * int16_max).astype(np.int16)
+
+    return (fixed_gain() if norm == 'fixed_gain' else two_pass()), freq
 
 
 def anonym(freq, samples, winLengthinms=20, shiftLengthinms=10, lp_order=20, mcadams=0.8):
@@ -202,9 +352,10 @@ def anonym(freq, samples, winLengthinms=20, shiftLengthinms=10, lp_order=20, mca
 
 
 
-def anonym_v2(freq, samples, winLengthinms=20, shiftLengthinms=10, lp_order=20, mcadams=0.8):
+def anonym_v2(freq, samples, winLengthinms=20, shiftLengthinms=10, lp_order=20, mcadams=0.8, batched=True):
     """anonymized_data = anonym_v2(freq, samples,
-                                    winLengthinms=20, shiftLengthinms=10, lp_order=20, mcadams=0.8)
+                                    winLengthinms=20, shiftLengthinms=10, lp_order=20, mcadams=0.8,
+                                    batched=True)
 
     input
     -----
@@ -214,6 +365,9 @@ def anonym_v2(freq, samples, winLengthinms=20, shiftLengthinms=10, lp_order=20,
       shiftLengthinms:   analysis window shift (ms), default 10ms
       lp_order:          order of linear prediction analysis, default 20
       mcadams:           value of McAdam coef, default 0.8
+      batched:           process all frames at once (companion-matrix poles,
+                         vectorized pole-to-polynomial and filtering),
+                         default True. False uses the per-frame reference loop
 
     output
     ------
@@ -225,24 +379,54 @@ def anonym_v2(freq, samples, winLengthinms=20, shiftLengthinms=10, lp_order=20,
     samples = samples + eps
 
     # short-time analysis parameters
+    winlen, shift, win = _analysis_window(freq, winLengthinms, shiftLengthinms)
+
+    # framing
+    frames = librosa.util.frame(samples, frame_length=winlen, hop_length=shift).T
+
+    # windowing
+    windowed_frames = frames * win
+
+    # LP analysis, pole modification and LP synthesis on all frames
+    recon_frames = _anonym_frames(windowed_frames, win, lp_order, mcadams, batched)
+
+    # overlap-add
+    anonymized_data = np.zeros_like(samples)
+    _overlap_add(anonymized_data, recon_frames, shift)
+
+    # convert to int16
+    #anonymized_data = (anonymized_data / np.max(np.abs(anonymized_data)) * (np.iinfo(np.int16).max - 1)).astype(np.int16)
+    return anonymized_data
+
+
+def _analysis_window(freq, winLengthinms, shiftLengthinms):
+    """winlen, shift, win = _analysis_window(freq, winLengthinms, shiftLengthinms)
+    Frame length, frame shift (in samples) and the analysis/synthesis window
+    """
     winlen = np.floor(winLengthinms * 0.001 * freq).astype(int)
     shift = np.floor(shiftLengthinms * 0.001 * freq).astype(int)
-    length_sig = len(samples)
-
-    # fft processing parameters
-    NFFT = 2 ** (np.ceil((np.log2(winlen)))).astype(int)
 
     # anaysis and synth window which satisfies the constraint
     wPR = np.hanning(winlen)
     K = np.sum(wPR) / shift
     win = np.sqrt(wPR / K)
-    Nframes = 1 + np.floor((length_sig - winlen) / shift).astype(int) # nr of complete frames
+    return winlen, shift, win
 
-    # framing
-    frames = librosa.util.frame(samples, frame_length=winlen, hop_length=shift).T
 
-    # windowing
-    windowed_frames = frames * win
+def _overlap_add(output, frames, shift):
+    """In-place overlap-add of frames (nframe, winlen) into output"""
+    librosa.core.spectrum.__overlap_add(output, frames.T, shift)
+
+
+def _anonym_frames(windowed_frames, win, lp_order, mcadams, batched=True):
+    """recon_frames = _anonym_frames(windowed_frames, win, lp_order, mcadams, batched=True)
+    McAdams transform of windowed frames, returns the windowed reconstructed
+    frames ready for overlap-add
+
+    windowed_frames: np.array, (nframe, winlen)
+    win: np.array, synthesis window, (winlen, )
+    """
+    eps = np.finfo(np.float32).eps
 
     # number of frames
     nframe = windowed_frames.shape[0]
@@ -251,9 +435,12 @@ def anonym_v2(freq, samples, winLengthinms=20, shiftLengthinms=10, lp_order=20,
     lpc_coefs = librosa.core.lpc(windowed_frames + eps, order=lp_order, axis=1)
 
     # get Poles for LP AR transfer function
-    # tf2zpk only accepts a single transfunction function,
-    # we have to create a list
-    ar_poles = np.array([scipy.signal.tf2zpk(np.array([1]), x)[1] for x in lpc_coefs])
+    if batched:
+        ar_poles = _batched_roots(lpc_coefs)
+    else:
+        # tf2zpk only accepts a single transfunction function,
+        # we have to create a list
+        ar_poles = np.array([scipy.signal.tf2zpk(np.array([1]), x)[1] for x in lpc_coefs])
 
     def _mcadam_angle(poles, mcadams):
         """new_angles = _mcadam_angle(poles, mcadams)
@@ -313,16 +500,204 @@ def anonym_v2(freq, samples, winLengthinms=20, shiftLengthinms=10, lp_order=20,
     poles_new = _new_poles(ar_poles, pole_new_angles)
 
     # reconstruct frame using new LPC coef
-    recon_frames = [_lpc_ana_syn(lpc_coefs[x], np.real(np.poly(poles_new[x])), windowed_frames[x]) for x in np.arange(nframe)]
-    recon_frames = np.stack(recon_frames, axis=0) * win
+    if batched:
+        recon_frames = _batched_lpc_ana_syn(lpc_coefs, _batched_poly(poles_new), windowed_frames)
+    else:
+        recon_frames = [_lpc_ana_syn(lpc_coefs[x], np.real(np.poly(poles_new[x])), windowed_frames[x]) for x in np.arange(nframe)]
+        recon_frames = np.stack(recon_frames, axis=0)
+    recon_frames = recon_frames * win
 
-    # overlap-add
-    anonymized_data = np.zeros_like(samples)
-    librosa.core.spectrum.__overlap_add(anonymized_data, recon_frames.T, shift)
+    return recon_frames
+
+
+class McAdamsStream:
+    """Block-wise anonym_v2 with bounded memory.
+
+    Input blocks are appended to a buffer holding only the samples of the
+    frames that are not complete yet, and the overlap-add tail of the last
+    processed frames is carried over to the next block. Concatenating the
+    outputs of process() and flush() gives the same samples as anonym_v2
+    on the whole signal.
+    """
+
+    def __init__(self, freq, winLengthinms=20, shiftLengthinms=10, lp_order=20, mcadams=0.8, batched=True):
+        self.lp_order = lp_order
+        self.mcadams = mcadams
+        self.batched = batched
+        self.winlen, self.shift, self.win = _analysis_window(freq, winLengthinms, shiftLengthinms)
+        # input samples from the start of the next frame on
+        self._buffer = None
+        # overlap-add tail, aligned with the start of self._buffer
+        self._tail = None
+
+    def process(self, block):
+        """Add a block of input samples and return the output samples that
+        no further frame contributes to (possibly empty)."""
+        block = block + np.finfo(np.float32).eps
+        if self._buffer is None:
+            self._buffer = block[:0]
+            self._tail = np.zeros(self.winlen, dtype=block.dtype)
+        self._buffer = np.concatenate([self._buffer, block])
+
+        if len(self._buffer) < self.winlen:
+            return self._tail[:0]
+        nframe = 1 + (len(self._buffer) - self.winlen) // self.shift
+        done = nframe * self.shift
+
+        frames = librosa.util.frame(self._buffer[:done - self.shift + self.winlen],
+                                    frame_length=self.winlen, hop_length=self.shift).T
+        recon_frames = _anonym_frames(frames * self.win, self.win, self.lp_order, self.mcadams, self.batched)
+
+        output = np.zeros(done - self.shift + self.winlen, dtype=self._tail.dtype)
+        output[:self.winlen] = self._tail
+        _overlap_add(output, recon_frames, self.shift)
+
+        self._buffer = self._buffer[done:]
+        self._tail = np.zeros(self.winlen, dtype=output.dtype)
+        self._tail[:self.winlen - self.shift] = output[done:]
+        return output[:done]
+
+    def flush(self):
+        """Return the remaining output samples, up to the input length."""
+        if self._buffer is None:
+            return np.zeros(0)
+        output = self._tail[:len(self._buffer)]
+        self._buffer, self._tail = None, None
+        return output
+
+
+def anonym_v2_stream(freq, blocks, winLengthinms=20, shiftLengthinms=10, lp_order=20, mcadams=0.8, batched=True):
+    """anonymized_blocks = anonym_v2_stream(freq, blocks, ...)
+    Generator version of anonym_v2 over an iterable of input blocks,
+    see McAdamsStream
+    """
+    stream = McAdamsStream(freq, winLengthinms=winLengthinms, shiftLengthinms=shiftLengthinms,
+                           lp_order=lp_order, mcadams=mcadams, batched=batched)
+    for block in blocks:
+        output = stream.process(block)
+        if len(output) > 0:
+            yield output
+    yield stream.flush()
+
+
+def _batched_roots(coefs):
+    """roots = _batched_roots(coefs)
+    Roots of a batch of polynomials, as eigenvalues of their companion
+    matrices (same construction as np.roots, one LAPACK call for all frames)
+
+    coefs: np.array, polynomial coefficients, (nframe, p + 1)
+    roots: np.array, complex roots, (nframe, p)
+    """
+    nframe, order = coefs.shape[0], coefs.shape[1] - 1
+    companion = np.zeros((nframe, order, order), dtype=coefs.dtype)
+    companion[:, 0, :] = -coefs[:, 1:] / coefs[:, :1]
+    companion[:, np.arange(1, order), np.arange(order - 1)] = 1
+    return np.linalg.eigvals(companion).astype(complex)
+
+
+def _batched_poly(roots):
+    """coefs = _batched_poly(roots)
+    Real monic polynomials from a batch of roots (vectorized np.poly)
+
+    roots: np.array, complex roots, (nframe, p)
+    coefs: np.array, polynomial coefficients, (nframe, p + 1)
+    """
+    nframe, order = roots.shape
+    coefs = np.zeros((nframe, order + 1), dtype=complex)
+    coefs[:, 0] = 1
+    # multiply by (1 - r_k z^-1) one root at a time, over all frames
+    for k in range(order):
+        coefs[:, 1:k + 2] = coefs[:, 1:k + 2] - roots[:, k:k + 1] * coefs[:, :k + 1]
+    return np.real(coefs)
+
+
+def _batched_lpc_ana_syn(old_lpc_coefs, new_lpc_coefs, frames):
+    """new_frames = _batched_lpc_ana_syn(old_lpc_coefs, new_lpc_coefs, frames)
+    get excitation using old LPC, synthesize using new LPC coef, all frames at once
+
+    old_lpc_coefs: np.array, old LPC coef, (nframe, p + 1)
+    new_lpc_coefs: np.array, new monic LPC coef, (nframe, p + 1)
+    frames: np.array, frames to be analyzed / synthesized (nframe, N)
+    """
+    order = old_lpc_coefs.shape[1] - 1
+    nsample = frames.shape[1]
+
+    # FIR analysis filter: res[n] = sum_k a_old[k] x[n - k]
+    res = np.zeros_like(frames)
+    for k in range(min(order + 1, nsample)):
+        res[:, k:] += old_lpc_coefs[:, k:k + 1] * frames[:, :nsample - k]
+
+    # IIR synthesis filter: y[n] = res[n] - sum_{k>=1} a_new[k] y[n - k]
+    # the first `order` columns hold the zero initial state
+    out = np.zeros((frames.shape[0], order + nsample), dtype=res.dtype)
+    a_rev = new_lpc_coefs[:, :0:-1]
+    for n in range(nsample):
+        out[:, order + n] = res[:, n] - np.einsum('ij,ij->i', a_rev, out[:, n:order + n])
+    return out[:, order:]
+
+
+def benchmark_anonym_v2(freq=16000, duration=10, repeats=3, atol=1e-6, seed=0):
+    """Compare frames/sec of the batched and per-frame anonym_v2 engines
+    on a random signal and check that their outputs agree within atol.
+    """
+    import time
+
+    rng = np.random.default_rng(seed)
+    samples = rng.uniform(-0.5, 0.5, int(freq * duration))
+    nframe = librosa.util.frame(samples, frame_length=int(0.02 * freq), hop_length=int(0.01 * freq)).shape[1]
+
+    outputs = {}
+    for batched in (False, True):
+        start = time.perf_counter()
+        for _ in range(repeats):
+            outputs[batched] = anonym_v2(freq=freq, samples=samples, batched=batched)
+        elapsed = (time.perf_counter() - start) / repeats
+        print(f'{"batched" if batched else "per-frame"}: {nframe / elapsed:.0f} frames/sec')
+
+    max_diff = np.max(np.abs(outputs[True] - outputs[False]))
+    print(f'max abs difference: {max_diff:.2e} (tolerance {atol:.0e})')
+    assert max_diff <= atol, 'batched engine does not match the per-frame reference'
+
+
+def _bench_task_partial(mcadams, utid, reader):
+    return f'{utid} {reader[utid]}\n'
+
+def _bench_task_worker(mcadams, utid):
+    return f'{utid} {_worker_state["reader"][utid]}\n'
+
+def benchmark_pool_overhead(n_utts=100000, nj=4):
+    """Startup and per-task IPC overhead of handing the wav.scp index to
+    the pool workers, bound into each task (functools.partial) vs. loaded
+    once per worker (initializer), on a synthetic scp with a no-op task.
+    """
+    import time
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        wav_scp = Path(tmp_dir) / 'wav.scp'
+        with open(wav_scp, 'w', encoding='utf-8') as f:
+            for i in range(n_utts):
+                f.write(f'utt{i:07d} /corpus/spk{i % 1000:04d}/utt{i:07d}.wav\n')
+        reader = read_kaldi_format(wav_scp)
+        tasks = [(0.8, utid) for utid in reader.keys()]
+        chunksize = max([1, n_utts // (nj * 10)])
+
+        variants = {
+            'partial': (functools.partial(_bench_task_partial, reader=reader), {}),
+            'initializer': (_bench_task_worker, {'initializer': _init_worker,
+                                                 'initargs': (str(wav_scp), {}, tmp_dir)}),
+        }
+        for name, (fn, pool_kwargs) in variants.items():
+            start = time.perf_counter()
+            with multiprocessing.Pool(processes=nj, **pool_kwargs) as pool:
+                pool.starmap(fn, tasks[:nj], chunksize=1)
+                startup = time.perf_counter() - start
+                start = time.perf_counter()
+                pool.starmap(fn, tasks, chunksize=chunksize)
+                per_task = (time.perf_counter() - start) / n_utts
+            print(f'{name}: startup {startup:.2f} s, {per_task * 1e6:.1f} us/task')
 
-    # convert to int16
-    #anonymized_data = (anonymized_data / np.max(np.abs(anonymized_data)) * (np.iinfo(np.int16).max - 1)).astype(np.int16)
-    return anonymized_data
 
 if __name__ == "__main__":
     print(__doc__)
+    benchmark_anonym_v2()
+    benchmark_pool_overhead()
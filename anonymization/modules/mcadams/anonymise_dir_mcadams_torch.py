@@ -0,0 +1,222 @@
+#!/usr/bin/env python3.0
+# -*- coding: utf-8 -*-
+"""
+Torch backend of the B2 (McAdams coefficient) anonymization.
+
+Same transform as anonym_v2 in anonymise_dir_mcadams_rand_seed.py, computed on
+padded mini-batches of utterances on any torch device (CPU build included).
+"""
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from utils import setup_logger, load_wav_from_scp
+
+logger = setup_logger(__name__)
+
+
+def anonym_v2_torch(freq, samples, lengths, mcadams, winLengthinms=20, shiftLengthinms=10, lp_order=20,
+                    dtype=torch.float64):
+    """anonymized_data = anonym_v2_torch(freq, samples, lengths, mcadams,
+                                          winLengthinms=20, shiftLengthinms=10, lp_order=20)
+
+    input
+    -----
+      freq:              sampling frequency (Hz), scalar, shared by the batch
+      samples:           zero-padded input waveforms, torch.Tensor float32, (B, N)
+      lengths:           number of valid samples of each waveform, torch.Tensor, (B, )
+      mcadams:           value of McAdam coef of each waveform, torch.Tensor or scalar, (B, )
+      winLengthinms:     analysis window length (ms), default 20ms
+      shiftLengthinms:   analysis window shift (ms), default 10ms
+      lp_order:          order of linear prediction analysis, default 20
+      dtype:             precision of the LP analysis / synthesis, default float64
+
+    output
+    ------
+      anonymized_data:   anonymized data, torch.Tensor, (B, N), zero after each length
+    """
+    device = samples.device
+    batch_size, length_sig = samples.shape
+
+    # to prevent numerical issue
+    eps = np.finfo(np.float32).eps
+    samples = samples + eps
+
+    # short-time analysis parameters, same window as the numpy implementation
+    winlen = int(np.floor(winLengthinms * 0.001 * freq))
+    shift = int(np.floor(shiftLengthinms * 0.001 * freq))
+    wPR = np.hanning(winlen)
+    K = np.sum(wPR) / shift
+    win = torch.from_numpy(np.sqrt(wPR / K)).to(device=device, dtype=dtype)
+
+    # framing and windowing, (B, nframe, winlen)
+    windowed_frames = samples.unfold(-1, winlen, shift).to(dtype) * win
+    nframe = windowed_frames.shape[1]
+
+    # frames lying completely inside each waveform
+    lengths = torch.as_tensor(lengths, device=device)
+    valid = torch.arange(nframe, device=device)[None, :] < (1 + (lengths[:, None] - winlen) // shift)
+
+    mcadams = torch.as_tensor(mcadams, device=device, dtype=dtype).reshape(-1, 1, 1).expand(batch_size, nframe, 1)
+
+    frames = windowed_frames.reshape(batch_size * nframe, winlen)
+    lpc_coefs = lpc_burg(frames + eps, lp_order)
+    ar_poles = batched_roots(lpc_coefs)
+    poles_new = mcadams_poles(ar_poles, mcadams.reshape(-1, 1))
+    recon_frames = lpc_ana_syn(lpc_coefs, batched_poly(poles_new), frames)
+    recon_frames = recon_frames.reshape(batch_size, nframe, winlen) * win * valid[..., None]
+
+    # overlap-add
+    ola_length = (nframe - 1) * shift + winlen
+    anonymized_data = torch.nn.functional.fold(recon_frames.transpose(1, 2), output_size=(1, ola_length),
+                                               kernel_size=(1, winlen), stride=(1, shift)).reshape(batch_size, -1)
+    anonymized_data = torch.nn.functional.pad(anonymized_data, (0, length_sig - ola_length))
+    return anonymized_data
+
+
+def lpc_burg(frames, order):
+    """lpc_coefs = lpc_burg(frames, order)
+    LP coefficients of each frame with Burg's method, a batched port of
+    librosa.lpc so that results match the numpy implementation
+
+    frames: torch.Tensor, (nframe, winlen)
+    lpc_coefs: torch.Tensor, (nframe, order + 1)
+    """
+    nframe = frames.shape[0]
+    epsilon = torch.finfo(frames.dtype).tiny
+
+    ar_coeffs = torch.zeros(nframe, order + 1, dtype=frames.dtype, device=frames.device)
+    ar_coeffs[:, 0] = 1
+
+    fwd_pred_error = frames[:, 1:]
+    bwd_pred_error = frames[:, :-1]
+    den = torch.sum(fwd_pred_error ** 2 + bwd_pred_error ** 2, dim=1)
+
+    for i in range(order):
+        reflect_coeff = -2 * torch.sum(bwd_pred_error * fwd_pred_error, dim=1) / (den + epsilon)
+
+        # Levinson-Durbin update of the AR coefficients
+        ar_coeffs_prev = ar_coeffs.clone()
+        ar_coeffs[:, 1:i + 2] = ar_coeffs_prev[:, 1:i + 2] + reflect_coeff[:, None] * ar_coeffs_prev[:, :i + 1].flip(-1)
+
+        fwd_pred_error, bwd_pred_error = (fwd_pred_error + reflect_coeff[:, None] * bwd_pred_error,
+                                          bwd_pred_error + reflect_coeff[:, None] * fwd_pred_error)
+
+        den = (1.0 - reflect_coeff ** 2) * den - bwd_pred_error[:, -1] ** 2 - fwd_pred_error[:, 0] ** 2
+
+        fwd_pred_error = fwd_pred_error[:, 1:]
+        bwd_pred_error = bwd_pred_error[:, :-1]
+
+    return ar_coeffs
+
+
+def batched_roots(coefs):
+    """roots = batched_roots(coefs)
+    Roots of a batch of polynomials, as eigenvalues of their companion matrices
+
+    coefs: torch.Tensor, polynomial coefficients, (nframe, p + 1)
+    roots: torch.Tensor, complex roots, (nframe, p)
+    """
+    nframe, order = coefs.shape[0], coefs.shape[1] - 1
+    companion = torch.zeros(nframe, order, order, dtype=coefs.dtype, device=coefs.device)
+    companion[:, 0, :] = -coefs[:, 1:] / coefs[:, :1]
+    companion[:, torch.arange(1, order), torch.arange(order - 1)] = 1
+    return torch.linalg.eigvals(companion)
+
+
+def mcadams_poles(poles, mcadams):
+    """new_poles = mcadams_poles(poles, mcadams)
+    Raise the angle of the complex poles to the power mcadams, keep their magnitude
+
+    poles: torch.Tensor, complex poles, (nframe, p)
+    mcadams: torch.Tensor, (nframe, 1)
+    """
+    old_angles = torch.angle(poles)
+    cplx = poles.imag != 0
+    neg_idx = cplx & (old_angles < 0.0)
+    pos_idx = cplx & (old_angles > 0.0)
+    new_angles = torch.where(neg_idx, -((-old_angles).clamp(min=0) ** mcadams), old_angles)
+    new_angles = torch.where(pos_idx, old_angles.clamp(min=0) ** mcadams, new_angles)
+    return torch.polar(torch.abs(poles), new_angles)
+
+
+def batched_poly(roots):
+    """coefs = batched_poly(roots)
+    Real monic polynomials from a batch of roots
+
+    roots: torch.Tensor, complex roots, (nframe, p)
+    coefs: torch.Tensor, polynomial coefficients, (nframe, p + 1)
+    """
+    nframe, order = roots.shape
+    coefs = torch.zeros(nframe, order + 1, dtype=roots.dtype, device=roots.device)
+    coefs[:, 0] = 1
+    for k in range(order):
+        coefs[:, 1:k + 2] = coefs[:, 1:k + 2] - roots[:, k:k + 1] * coefs[:, :k + 1]
+    return coefs.real
+
+
+def lpc_ana_syn(old_lpc_coefs, new_lpc_coefs, frames):
+    """new_frames = lpc_ana_syn(old_lpc_coefs, new_lpc_coefs, frames)
+    get excitation using old LPC, synthesize using new LPC coef, all frames at once
+
+    old_lpc_coefs: torch.Tensor, old LPC coef, (nframe, p + 1)
+    new_lpc_coefs: torch.Tensor, new monic LPC coef, (nframe, p + 1)
+    frames: torch.Tensor, frames to be analyzed / synthesized (nframe, N)
+    """
+    order = old_lpc_coefs.shape[1] - 1
+    nsample = frames.shape[1]
+
+    # FIR analysis filter as a sliding dot product over the zero-padded frames
+    padded = torch.nn.functional.pad(frames, (order, 0))
+    res = torch.einsum('fnk,fk->fn', padded.unfold(-1, order + 1, 1), old_lpc_coefs.flip(-1))
+
+    # IIR synthesis filter, the first `order` columns hold the zero initial state
+    out = torch.zeros(frames.shape[0], order + nsample, dtype=frames.dtype, device=frames.device)
+    a_rev = new_lpc_coefs[:, 1:].flip(-1)
+    for n in range(nsample):
+        out[:, order + n] = res[:, n] - torch.sum(a_rev * out[:, n:order + n], dim=1)
+    return out[:, order:]
+
+
+def process_wavs_torch(tasks, reader, settings, sink, device='cpu'):
+    """
+        Anonymize the (mcadams, utt_id) tasks with the torch backend on device
+        and write them to sink like process_wav. Utterances are read in windows of
+        settings['sort_window'] batches, sorted by length there and split into
+        zero-padded mini-batches of settings['batch_size'] utterances.
+
+        Yields:
+            the manifest entry (utid, wav.scp value, size, mcadams) of each
+            utterance, once it is written
+    """
+    from .anonymise_dir_mcadams_rand_seed import save_anonymized_wav
+
+    batch_size = settings.get('batch_size', 16)
+    sort_window = batch_size * settings.get('sort_window', 8)
+
+    with tqdm(total=len(tasks)) as progress:
+        for start in range(0, len(tasks), sort_window):
+            utterances = []
+            for mcadams, utid in tasks[start:start + sort_window]:
+                samples, freq = load_wav_from_scp(reader[utid])
+                utterances.append((freq, samples.shape[-1], utid, mcadams, samples[0]))
+            utterances.sort(key=lambda x: (x[0], x[1]))
+
+            for i in range(0, len(utterances), batch_size):
+                batch = utterances[i:i + batch_size]
+                for freq in sorted(set(x[0] for x in batch)):
+                    same_freq = [x for x in batch if x[0] == freq]
+                    samples = torch.nn.utils.rnn.pad_sequence([x[4] for x in same_freq], batch_first=True)
+                    lengths = torch.tensor([x[1] for x in same_freq])
+                    coeffs = torch.tensor([x[3] for x in same_freq])
+                    with torch.no_grad():
+                        anonymized = anonym_v2_torch(freq=freq, samples=samples.to(device),
+                            lengths=lengths.to(device), mcadams=coeffs.to(device),
+                            winLengthinms=settings['winLengthinms'],
+                            shiftLengthinms=settings['shiftLengthinms'],
+                            lp_order=settings['n_coeffs'])
+                    anonymized = anonymized.cpu().numpy()
+                    for (_, length, utid, mcadams, _), data in zip(same_freq, anonymized):
+                        scp_value, size = save_anonymized_wav(sink, utid, data[:length].astype(np.float32), freq)
+                        yield utid, scp_value, size, mcadams
+                progress.update(len(batch))
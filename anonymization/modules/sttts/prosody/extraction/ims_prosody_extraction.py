@@ -2,7 +2,6 @@ import torch
 torch.set_num_threads(1)
 
 from torch.optim import SGD
-import soundfile as sf
 
 from ...tts.IMSToucan.Preprocessing.AudioPreprocessor import AudioPreprocessor
 from ...tts.IMSToucan.Preprocessing.TextFrontend import ArticulatoryCombinedTextFrontend
@@ -10,7 +9,7 @@ from ...tts.IMSToucan.TrainingInterfaces.Text_to_Spectrogram.AutoAligner.Aligner
 from ...tts.IMSToucan.TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.DurationCalculator import DurationCalculator
 from ...tts.IMSToucan.TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.EnergyCalculator import EnergyCalculator
 from ...tts.IMSToucan.TrainingInterfaces.Text_to_Spectrogram.FastSpeech2.PitchCalculator import Parselmouth
-from utils import setup_logger
+from utils import setup_logger, load_wav_from_scp
 
 logger = setup_logger(__name__)
 
@@ -25,10 +24,13 @@ class ImsProsodyExtractor:
         self.ap = AudioPreprocessor(input_sr=16000, output_sr=16000, melspec_buckets=80, hop_length=256, n_fft=1024, cut_silence=False)
         self.tf = ArticulatoryCombinedTextFrontend(language="en")
         self.device = device
-        self.aligner_weights = torch.load(aligner_path, map_location='cpu')["asr_model"]
         self.acoustic_model = Aligner()
-        self.acoustic_model.load_state_dict(self.aligner_weights)
+        self.acoustic_model.load_state_dict(torch.load(aligner_path, map_location='cpu')["asr_model"])
         self.acoustic_model = self.acoustic_model.to(self.device)
+        # the fine-tuning changes the parameters and the batch norm statistics of the aligner, they are restored in
+        # place from these snapshots on the model device before every utterance
+        self.aligner_state = {name: tensor.detach().clone() for name, tensor in self._aligner_tensors().items()}
+        self.optim_asr = SGD(self.acoustic_model.parameters(), lr=0.1)
         torch.hub._validate_not_a_forked_repo = lambda a, b, c: True  # torch 1.9 has a bug in the hub loading, this is a workaround
         # careful: assumes 16kHz or 8kHz audio
         self.silero_model, utils = torch.hub.load(repo_or_dir='snakers4/silero-vad',
@@ -48,12 +50,26 @@ class ImsProsodyExtractor:
                         ref_audio_path,
                         lang="en",
                         input_is_phones=False):
+        utterance = self._prepare_utterance(transcript, ref_audio_path, lang=lang, input_is_phones=input_is_phones)
+
         if self.on_line_fine_tune:
-            self.acoustic_model.load_state_dict(self.aligner_weights)
+            self._load_aligner_state(self.aligner_state)
+            self._fine_tune(utterance['melspec'], utterance['tokens'])
+
+        return self._extract_from_alignment(utterance)
+
+    def _aligner_tensors(self):
+        # everything the fine-tuning changes: the parameters and the running statistics of the batch norms
+        return {**dict(self.acoustic_model.named_parameters()), **dict(self.acoustic_model.named_buffers())}
 
-        wave, sr = sf.read(ref_audio_path)
-        if len(wave.shape) == 2:
-            wave = wave.squeeze(0)
+    @torch.no_grad()
+    def _load_aligner_state(self, state):
+        for name, tensor in self._aligner_tensors().items():
+            tensor.copy_(state[name])
+
+    def _prepare_utterance(self, transcript, ref_audio_path, lang="en", input_is_phones=False):
+        wave, sr = load_wav_from_scp(ref_audio_path)
+        wave = wave[0].double().numpy()
         if self.tf.language != lang:
             self.tf = ArticulatoryCombinedTextFrontend(language=lang)
         if self.ap.sr != sr:
@@ -72,40 +88,41 @@ class ImsProsodyExtractor:
         end_silence = len(norm_wave) - speech_timestamps[-1]['end']
         norm_wave = norm_wave[speech_timestamps[0]['start']:speech_timestamps[-1]['end']]
 
-        norm_wave_length = torch.LongTensor([len(norm_wave)])
         text = self.tf.string_to_tensor(transcript, handle_missing=True, input_phonemes=input_is_phones).squeeze(
             0)
         melspec = self.ap.audio_to_mel_spec_tensor(audio=norm_wave, normalize=False, explicit_sampling_rate=16000).transpose(0, 1)
-        melspec_length = torch.LongTensor([len(melspec)]).numpy()
 
+        tokens = list()  # we need an ID sequence for training rather than a sequence of phonological features
         if self.on_line_fine_tune:
-            # we fine-tune the aligner for a couple steps using SGD. This makes cloning pretty slow, but the results are greatly improved.
-            steps = 3
-            tokens = list()  # we need an ID sequence for training rather than a sequence of phonological features
-            for vector in text:
-                if vector[21] == 0:  # we don't include word boundaries when performing alignment, since they are not always present in audio.
-                    for phone in self.tf.phone_to_vector:
-                        if vector.numpy().tolist()[13:] == self.tf.phone_to_vector[phone][13:]:
-                            # the first 12 dimensions are for modifiers, so we ignore those when trying to find the phoneme in the ID lookup
-                            tokens.append(self.tf.phone_to_id[phone])
-                            # this is terribly inefficient, but it's fine
-                            break
-            tokens = torch.LongTensor(tokens).squeeze().to(self.device)
-            tokens_len = torch.LongTensor([len(tokens)]).to(self.device)
-            mel = melspec.unsqueeze(0).to(self.device)
-            #mel.requires_grad = True
-            mel_len = torch.LongTensor([len(mel[0])]).to(self.device)
-            # actual fine-tuning starts here
-            optim_asr = SGD(self.acoustic_model.parameters(), lr=0.1)
-            self.acoustic_model.train()
-            for _ in list(range(steps)):
-                pred = self.acoustic_model(mel.clone())
-                loss = self.acoustic_model.ctc_loss(pred.transpose(0, 1).log_softmax(2), tokens, mel_len, tokens_len)
-                optim_asr.zero_grad()
-                loss.backward()
-                torch.nn.utils.clip_grad_norm_(self.acoustic_model.parameters(), 1.0)
-                optim_asr.step()
-            self.acoustic_model.eval()
+            tokens = self.tf.vectors_to_ids(text).tolist()
+
+        return {'norm_wave': norm_wave, 'text': text, 'melspec': melspec, 'tokens': tokens,
+                'start_silence': start_silence, 'end_silence': end_silence}
+
+    def _fine_tune(self, melspec, tokens):
+        # we fine-tune the aligner for a couple steps using SGD. This makes cloning pretty slow, but the results are greatly improved.
+        steps = 3
+        tokens = torch.LongTensor(tokens).squeeze().to(self.device)
+        tokens_len = torch.LongTensor([len(tokens)]).to(self.device)
+        mel = melspec.unsqueeze(0).to(self.device)
+        #mel.requires_grad = True
+        mel_len = torch.LongTensor([len(mel[0])]).to(self.device)
+        # actual fine-tuning starts here
+        self.acoustic_model.train()
+        for _ in list(range(steps)):
+            pred = self.acoustic_model(mel.clone())
+            loss = self.acoustic_model.ctc_loss(pred.transpose(0, 1).log_softmax(2), tokens, mel_len, tokens_len)
+            self.optim_asr.zero_grad()
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(self.acoustic_model.parameters(), 1.0)
+            self.optim_asr.step()
+        self.acoustic_model.eval()
+
+    def _extract_from_alignment(self, utterance):
+        norm_wave, text, melspec = utterance['norm_wave'], utterance['text'], utterance['melspec']
+        start_silence, end_silence = utterance['start_silence'], utterance['end_silence']
+        norm_wave_length = torch.LongTensor([len(norm_wave)])
+        melspec_length = torch.LongTensor([len(melspec)]).numpy()
 
         # We deal with the word boundaries by having 2 versions of text: with and without word boundaries.
         # We note the index of word boundaries and insert durations of 0 afterwards
@@ -160,3 +177,43 @@ class ImsProsodyExtractor:
                            durations_lengths=torch.LongTensor([len(duration)]))[0].squeeze(0).cpu()
 
         return duration, pitch, energy, start_silence, end_silence
+
+
+def benchmark_prosody_extraction(aligner_path, data_dir, device='cpu', n_utts=16, seed=0):
+    """Utterances/sec of extract_prosody() with the former load_state_dict
+    reset and with the in-place reset, on the first n_utts utterances of the
+    Kaldi data dir data_dir (wav.scp, text). Reports the share of durations
+    equal to those of the former path, which must be 100% for the in-place
+    reset (same dropout seeds).
+    """
+    import time
+    from pathlib import Path
+    from utils import read_kaldi_format
+
+    wav_scp = read_kaldi_format(Path(data_dir) / 'wav.scp')
+    text = read_kaldi_format(Path(data_dir) / 'text', values_as_string=True)
+    utts = [utt for utt in wav_scp if utt in text][:n_utts]
+    extractor = ImsProsodyExtractor(aligner_path=aligner_path, device=device)
+    aligner_weights = torch.load(aligner_path, map_location='cpu')["asr_model"]
+
+    def run(reset):
+        start = time.perf_counter()
+        durations = []
+        for i, utt in enumerate(utts):
+            torch.manual_seed(seed + i)
+            utterance = extractor._prepare_utterance(text[utt], wav_scp[utt])
+            reset()
+            extractor._fine_tune(utterance['melspec'], utterance['tokens'])
+            durations.append(extractor._extract_from_alignment(utterance)[0])
+        return durations, time.perf_counter() - start
+
+    def load_state_dict_reset():
+        extractor.acoustic_model.load_state_dict(aligner_weights)
+        extractor.optim_asr = SGD(extractor.acoustic_model.parameters(), lr=0.1)
+
+    reference, elapsed = run(load_state_dict_reset)
+    print(f'load_state_dict reset: {len(utts) / elapsed:.2f} utt/s')
+    durations, elapsed = run(lambda: extractor._load_aligner_state(extractor.aligner_state))
+    equal = sum(torch.equal(a, b) for a, b in zip(reference, durations)) / len(utts)
+    print(f'in-place reset: {len(utts) / elapsed:.2f} utt/s, {100 * equal:.0f}% equal durations')
+
@@ -1,3 +1,5 @@
+import shutil
+
 import numpy as np
 import torch
 
@@ -115,3 +117,34 @@ class Prosody:
                 self.utterances[line.strip()] = i
                 i += 1
         self.idx2utt = {idx: utt for utt, idx in self.utterances.items()}
+
+    def append_checkpoint(self, out_dir, start):
+        # checkpoint costing O(new instances): the instances from index start on are saved to their own file,
+        # written under a temporary name so that every part is complete (see load_checkpoint)
+        out_dir.mkdir(exist_ok=True, parents=True)
+        part = out_dir / f'prosody.{start}.pt'
+        torch.save({'utterances': [self.idx2utt[i] for i in range(start, len(self))],
+                    'duration': self.durations[start:], 'pitch': self.pitches[start:],
+                    'energy': self.energies[start:], 'start_silence': self.start_silences[start:],
+                    'end_silence': self.end_silences[start:]}, part.with_suffix('.tmp'))
+        part.with_suffix('.tmp').replace(part)
+
+    @staticmethod
+    def checkpoint_exists(in_dir):
+        return in_dir.is_dir() and any(in_dir.glob('prosody.*.pt'))
+
+    def load_checkpoint(self, in_dir):
+        # adds the instances of all checkpoint parts which are not known yet
+        for part in sorted(in_dir.glob('prosody.*.pt'), key=lambda part: int(part.suffixes[0][1:])):
+            instances = torch.load(part, map_location='cpu')
+            for i, utt in enumerate(instances['utterances']):
+                if utt not in self.utterances:
+                    self.add_instance(utterance=utt, duration=instances['duration'][i],
+                                      pitch=instances['pitch'][i], energy=instances['energy'][i],
+                                      start_silence=instances['start_silence'][i],
+                                      end_silence=instances['end_silence'][i])
+
+    @staticmethod
+    def remove_checkpoint(in_dir):
+        if in_dir.is_dir():
+            shutil.rmtree(in_dir)
@@ -3,20 +3,26 @@ torch.set_num_threads(1)
 
 from tqdm import tqdm
 from pathlib import Path
+from itertools import cycle
+import queue
+import traceback
+import torch.multiprocessing as mp
 
 from .prosody import Prosody
 from .extraction import *
-from utils import read_kaldi_format, setup_logger
+from utils import KaldiDataDir, setup_logger
 
 logger = setup_logger(__name__)
 
 class ProsodyExtraction:
 
-    def __init__(self, device, settings, results_dir=None, save_intermediate=True, force_compute=False):
-        self.device = device
+    def __init__(self, devices, settings, results_dir=None, save_intermediate=True, force_compute=False):
+        self.devices = devices
         self.save_intermediate = save_intermediate
         self.force_compute = force_compute if force_compute else settings.get('force_compute_extraction', False)
         extractor_type = settings.get('extractor_type', 'ims')
+        # the extraction is mostly CPU-bound, several processes can share a device
+        self.n_processes = settings.get('n_processes', len(self.devices))
 
         if results_dir:
             self.results_dir = results_dir
@@ -31,47 +37,185 @@ class ProsodyExtraction:
         if extractor_type == 'ims':
             self.aligner_path = settings.get('aligner_model_path')
             self.on_line_fine_tune = settings.get('on_line_fine_tune', True)
-            self.extractor = ImsProsodyExtractor(aligner_path=self.aligner_path, device=self.device,
-                                                 on_line_fine_tune=self.on_line_fine_tune)
+            self.extractor_params = {'aligner_path': self.aligner_path, 'on_line_fine_tune': self.on_line_fine_tune}
+            if self.n_processes == 1:
+                self.extractor = ImsProsodyExtractor(device=self.devices[0], **self.extractor_params)
+            else:
+                # one long-lived worker per process loads its own extractor, see ProsodyWorkers
+                self.extractor = None
+                self.workers = ProsodyWorkers(extractor_params=self.extractor_params,
+                                              devices=[device for device, _ in zip(cycle(self.devices),
+                                                                                   range(self.n_processes))])
 
     def extract_prosody(self, dataset_path: Path, texts, dataset_name=None):
         dataset_name = dataset_name if dataset_name else dataset_path.name
         dataset_results_dir = self.results_dir / dataset_name if self.save_intermediate else Path('')
-        wav_scp = read_kaldi_format(dataset_path / 'wav.scp')
+        # without intermediate results, there is no dataset dir to checkpoint in
+        checkpoint_dir = dataset_results_dir / 'checkpoint' if self.save_intermediate else None
+        wav_scp = KaldiDataDir(dataset_path)['wav.scp']
 
         data_prosody = Prosody()
         text_is_phones = texts.is_phones
 
-        if (dataset_results_dir / 'utterances').exists() and not self.force_compute:
-            data_prosody.load_prosody(dataset_results_dir)
-            unprocessed_utts = wav_scp.keys() - data_prosody.utterances.keys()
-            wav_scp = {utt: wav_scp[utt] for utt in unprocessed_utts}
+        if self.force_compute:
+            if checkpoint_dir:
+                Prosody.remove_checkpoint(checkpoint_dir)
+        else:
+            if self.save_intermediate and (dataset_results_dir / 'utterances').exists():
+                data_prosody.load_prosody(dataset_results_dir)
+            if checkpoint_dir and Prosody.checkpoint_exists(checkpoint_dir):
+                # interrupted run, keep the utterances it finished
+                data_prosody.load_checkpoint(checkpoint_dir)
+            wav_scp = {utt: wav_path for utt, wav_path in wav_scp.items() if utt not in data_prosody.utterances}
 
         if wav_scp:
             logger.info(f'Extract prosody for {len(wav_scp)} of {len(wav_scp) + len(data_prosody)} utterances')
             data_prosody.new = True
-            i = 0
-            for utt, wav_path in tqdm(wav_scp.items()):
-                text = texts[utt]
-                try:
-                    utt_prosody = self.extractor.extract_prosody(transcript=text, ref_audio_path=wav_path,
-                                                                 input_is_phones=text_is_phones)
-                except IndexError as e:
-                    logger.warn(f'IndexError for {utt}')
-                    continue
-                duration, pitch, energy, start_silence, end_silence = utt_prosody
-                data_prosody.add_instance(utterance=utt, duration=duration, pitch=pitch, energy=energy,
-                                          start_silence=start_silence, end_silence=end_silence)
-                i += 1
-                if self.save_intermediate and i > 0 and i % 100 == 0:
-                    data_prosody.save_prosody(dataset_results_dir)
+            # windows of 100 utterances, one checkpoint each
+            utterances = [(utt, texts[utt], wav_path) for utt, wav_path in wav_scp.items()]
+            windows = [utterances[i:i + 100] for i in range(0, len(utterances), 100)]
+            if self.extractor is not None:
+                results = (prosody_window_job(self.extractor, window, text_is_phones) for window in windows)
+            else:
+                results = self.workers.extract(windows, text_is_phones)
+
+            saved = len(data_prosody)
+            with tqdm(total=len(utterances)) as progress:
+                for window_prosody in results:
+                    for utt, utt_prosody in window_prosody:
+                        if utt_prosody is None:
+                            logger.warn(f'IndexError for {utt}')
+                            continue
+                        duration, pitch, energy, start_silence, end_silence = utt_prosody
+                        data_prosody.add_instance(utterance=utt, duration=duration, pitch=pitch, energy=energy,
+                                                  start_silence=start_silence, end_silence=end_silence)
+                    if self.save_intermediate:
+                        data_prosody.append_checkpoint(checkpoint_dir, start=saved)
+                        saved = len(data_prosody)
+                    progress.update(len(window_prosody))
 
             if self.save_intermediate:
                 data_prosody.save_prosody(dataset_results_dir)
+                Prosody.remove_checkpoint(checkpoint_dir)
 
         elif len(data_prosody.utterances) > 0:
             logger.info('No prosody extraction necessary; load stored values instead...')
+            if checkpoint_dir and Prosody.checkpoint_exists(checkpoint_dir):
+                data_prosody.save_prosody(dataset_results_dir)
+                Prosody.remove_checkpoint(checkpoint_dir)
         else:
             logger.warn(f'No utterances could be found in {dataset_path}!')
 
         return data_prosody
+
+    def close(self):
+        # stops the worker processes and frees their devices, they are started again if needed
+        if getattr(self, 'workers', None) is not None:
+            self.workers.close()
+
+
+class ProsodyWorkers:
+    """
+        One extraction process per entry of devices, started on the first use
+        and kept for all datasets. Each worker loads its extractor once, then
+        pulls windows of utterances from a shared queue and streams their
+        prosody back.
+    """
+
+    def __init__(self, extractor_params, devices):
+        self.extractor_params = extractor_params
+        self.devices = devices
+        self.processes = []
+
+    def _start(self):
+        ctx = mp.get_context('spawn')
+        self.task_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        for device in self.devices:
+            process = ctx.Process(target=prosody_worker,
+                                  args=(self.extractor_params, device, self.task_queue, self.result_queue),
+                                  daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def extract(self, windows, input_is_phones):
+        """Yields the prosody_window_job() results of the windows, in completion order"""
+        if not self.processes:
+            self._start()
+        for window in windows:
+            self.task_queue.put((window, input_is_phones))
+
+        done = 0
+        try:
+            for _ in windows:
+                results = self._get_result()
+                if isinstance(results, str):
+                    raise RuntimeError(f'Prosody worker failed:\n{results}')
+                yield results
+                done += 1
+        finally:
+            if done < len(windows):
+                # error or abandoned extraction, the workers would first process all queued windows
+                self.terminate()
+
+    def _get_result(self):
+        # a worker killed by the OS (e.g. out of memory) never answers, its exit is detected instead
+        while True:
+            dead = [process for process in self.processes if not process.is_alive()]
+            if dead:
+                raise RuntimeError(f'Prosody worker died with exit code {dead[0].exitcode}')
+            try:
+                return self.result_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+
+    def close(self):
+        for _ in self.processes:
+            self.task_queue.put(None)
+        for process in self.processes:
+            process.join(timeout=60)
+        self.terminate()
+
+    def terminate(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        if self.processes:
+            # unsent windows must not keep the parent from exiting
+            self.task_queue.cancel_join_thread()
+        self.processes = []
+
+
+def prosody_worker(extractor_params, device, task_queue, result_queue):
+    try:
+        extractor = ImsProsodyExtractor(device=device, **extractor_params)
+    except Exception:
+        result_queue.put(traceback.format_exc())
+        return
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        try:
+            result_queue.put(prosody_window_job(extractor, *task))
+        except Exception:
+            result_queue.put(traceback.format_exc())
+
+
+def prosody_window_job(extractor, window, input_is_phones):
+    """
+        Extracts the prosody of a window of (utt, text, wav_path) utterances.
+
+        Returns:
+            (utt, prosody) pairs, prosody is None for the utterances failing with an IndexError
+    """
+    results = []
+    for utt, text, wav_path in window:
+        try:
+            utt_prosody = extractor.extract_prosody(transcript=text, ref_audio_path=wav_path,
+                                                    input_is_phones=input_is_phones)
+        except IndexError:
+            utt_prosody = None
+        results.append((utt, utt_prosody))
+    return results
@@ -1,7 +1,6 @@
 from pathlib import Path
 import torch
 import numpy as np
-from scipy.spatial.distance import cosine
 from os import PathLike
 from tqdm import tqdm
 from typing import Union
@@ -19,6 +18,11 @@ class GANAnonymizer(BaseAnonymizer):
         speech with generative adversarial networks to preserve speaker
         privacy" (https://arxiv.org/pdf/2210.07002.pdf).
     """
+    # GAN vectors tried per speaker before keeping the last one regardless of sim_threshold
+    MAX_TRIES = 20
+    # speakers whose similarities to the GAN vectors are computed at once
+    BLOCK_SIZE = 1024
+
     def __init__(
         self,
         vec_type: str = "xvector",
@@ -63,8 +67,8 @@ class GANAnonymizer(BaseAnonymizer):
         if self.vectors_file.is_file():
             self.gan_vectors = torch.load(self.vectors_file, map_location=self.device)
             if self.unused_indices_file.is_file():
-                self.unused_indices = torch.load(
-                    self.unused_indices_file, map_location="cpu"
+                self.unused_indices = np.asarray(
+                    torch.load(self.unused_indices_file, map_location="cpu")
                 )
             else:
                 self.unused_indices = np.arange(len(self.gan_vectors))
@@ -90,32 +94,20 @@ class GANAnonymizer(BaseAnonymizer):
         elif emb_level == "utt":
             logger.info(f"Anonymize embeddings of {len(speaker_embeddings)} utterances...")
 
-        identifiers = []
-        speakers = []
-        anon_vectors = []
-        genders = []
-        for i in tqdm(range(len(speaker_embeddings))):
-            identifier, vector = speaker_embeddings[i]
-            speaker = speaker_embeddings.original_speakers[i]
-            gender = speaker_embeddings.genders[i]
-            anon_vec = self._select_gan_vector(spk_vec=vector)
-            identifiers.append(identifier)
-            speakers.append(speaker)
-            anon_vectors.append(anon_vec)
-            genders.append(gender)
+        identifiers = [speaker_embeddings.idx2identifiers[i] for i in range(len(speaker_embeddings))]
+        speakers = list(speaker_embeddings.original_speakers)
+        genders = list(speaker_embeddings.genders)
+        anon_vectors = self._select_gan_vectors(spk_vectors=speaker_embeddings.vectors)
 
         anon_embeddings = SpeakerEmbeddings(
             vec_type=self.vec_type, device=self.device, emb_level=emb_level
         )
         anon_embeddings.set_vectors(
             identifiers=identifiers,
-            vectors=torch.stack(anon_vectors, dim=0),
+            vectors=anon_vectors,
             speakers=speakers,
             genders=genders,
         )
-        if self.save_intermediate:
-            torch.save(self.unused_indices, self.unused_indices_file)
-
         return anon_embeddings
 
     def _generate_artificial_embeddings(self, gan_model_path: Path, n: int):
@@ -126,23 +118,55 @@ class GANAnonymizer(BaseAnonymizer):
 
         if self.save_intermediate:
             torch.save(gan_vectors, self.vectors_file)
-            torch.save(unused_indices, self.unused_indices_file)
+            # a tensor, torch.load only unpickles numpy arrays with weights_only=False
+            torch.save(torch.from_numpy(unused_indices), self.unused_indices_file)
         return gan_vectors, unused_indices
 
-    def _select_gan_vector(self, spk_vec: torch.Tensor):
-        i = 0
-        limit = 20
-        while i < limit:
-            if len(self.unused_indices) == 0:
-                self._reset_unused_indices()
-            idx = np.random.choice(self.unused_indices)
-            anon_vec = self.gan_vectors[idx]
-            sim = 1 - cosine(spk_vec.cpu().numpy(), anon_vec.cpu().numpy())
-            if sim < self.sim_threshold:
-                break
-            i += 1
-        self.unused_indices = self.unused_indices[self.unused_indices != idx]
-        return anon_vec
+    def _select_gan_vectors(self, spk_vectors: torch.Tensor):
+        """
+            Draws an unused GAN vector with a cosine similarity below
+            sim_threshold for every speaker, in order. The unused vectors are
+            visited in the order of a random permutation: each speaker tries
+            the next MAX_TRIES vectors not taken yet and takes the first valid
+            one, or the last one tried. Rejected vectors stay available.
+        Returns:
+            [n_embeddings, n_channels] selected GAN vectors
+        """
+        gan_vectors = torch.nn.functional.normalize(self.gan_vectors.to(torch.float64), dim=1)
+        order = np.random.permutation(self.unused_indices)
+        available = np.ones(len(order), dtype=bool)
+        selected = np.empty(len(spk_vectors), dtype=np.int64)
+        rejections, fallbacks = 0, 0
+
+        for start in tqdm(range(0, len(spk_vectors), self.BLOCK_SIZE)):
+            block = spk_vectors[start:start + self.BLOCK_SIZE].to(gan_vectors.device, torch.float64)
+            block = torch.nn.functional.normalize(block, dim=1)
+            valid = ((block @ gan_vectors.T) < self.sim_threshold).cpu().numpy()
+
+            for i, valid_gan_vectors in enumerate(valid):
+                if not available.any():
+                    # all GAN vectors are used, start over
+                    self._reset_unused_indices()
+                    order = np.random.permutation(self.unused_indices)
+                    available = np.ones(len(order), dtype=bool)
+                tries = np.flatnonzero(available)[:self.MAX_TRIES]
+                accepted = np.flatnonzero(valid_gan_vectors[order[tries]])
+                if len(accepted) > 0:
+                    k = accepted[0]
+                else:
+                    k = len(tries) - 1
+                    fallbacks += 1
+                rejections += k
+                selected[start + i] = order[tries[k]]
+                available[tries[k]] = False
+
+        self.unused_indices = np.sort(order[available])
+        if self.save_intermediate:
+            # a restart must not draw the selected vectors again
+            torch.save(torch.from_numpy(self.unused_indices), self.unused_indices_file)
+        logger.info(f"GAN vector selection: {rejections} rejections, {fallbacks} of {len(spk_vectors)} vectors "
+                    f"above sim_threshold={self.sim_threshold}")
+        return self.gan_vectors[torch.from_numpy(selected).to(self.gan_vectors.device)]
 
     def _reset_unused_indices(self):
         self.unused_indices = np.arange(len(self.gan_vectors))
\ No newline at end of file
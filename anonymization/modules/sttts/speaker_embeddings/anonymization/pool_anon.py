@@ -6,7 +6,6 @@ from tqdm import tqdm
 from typing import Union
 
 from os import PathLike
-from sklearn.metrics.pairwise import cosine_distances
 from sklearn.preprocessing import minmax_scale, StandardScaler
 
 from .base_anon import BaseAnonymizer
@@ -35,6 +34,9 @@ class PoolAnonymizer(BaseAnonymizer):
         N = 200,
         N∗ = 100.
     """
+    # distances per block of queries, bounds the memory of the selection
+    MAX_BLOCK_ELEMENTS = 2 ** 22
+
     def __init__(
         self,
         vec_type: str = "xvector",
@@ -169,72 +171,91 @@ class PoolAnonymizer(BaseAnonymizer):
         return pool_embeddings
 
     def anonymize_embeddings(self, speaker_embeddings: torch.Tensor, emb_level: str = "spk"):
-        distance_matrix = self._compute_distances(
-            vectors_a=self.pool_embeddings.vectors, vectors_b=speaker_embeddings.vectors
-        )
-
         logger.info(f"Anonymize embeddings of {len(speaker_embeddings)} speakers...")
-        identifiers = []
-        speakers = []
-        anon_vectors = []
-        genders = []
-
-        for i in tqdm(range(len(speaker_embeddings))):
-            identifier, _ = speaker_embeddings[i]
-            speaker = speaker_embeddings.original_speakers[i]
-            gender = speaker_embeddings.genders[i]
-            distances_to_speaker = distance_matrix[:, i]
-            candidates = self._get_pool_candidates(distances_to_speaker, gender)
-            selected_anon_pool = np.random.choice(
-                candidates, self.N_star, replace=False
-            )
-            anon_vec = torch.mean(
-                self.pool_embeddings.speaker_vectors[selected_anon_pool], dim=0
-            )
-            identifiers.append(identifier)
-            speakers.append(speaker)
-            anon_vectors.append(anon_vec)
-            genders.append(
-                gender if not self.cross_gender else REVERSED_GENDERS[gender]
-            )
+        identifiers = [speaker_embeddings.idx2identifiers[i] for i in range(len(speaker_embeddings))]
+        speakers = list(speaker_embeddings.original_speakers)
+        genders = [
+            gender if not self.cross_gender else REVERSED_GENDERS[gender]
+            for gender in speaker_embeddings.genders
+        ]
+
+        anon_vectors = self._select_pool_vectors(speaker_embeddings.vectors, genders)
 
         anon_embeddings = SpeakerEmbeddings(
             vec_type=self.vec_type, device=self.device, emb_level=emb_level
         )
         anon_embeddings.set_vectors(
             identifiers=identifiers,
-            vectors=torch.stack(anon_vectors, dim=0),
+            vectors=anon_vectors,
             speakers=speakers,
             genders=genders,
         )
 
         return anon_embeddings
 
+    def _select_pool_vectors(self, vectors, target_genders):
+        """
+        Averages N_star vectors drawn at random among the N fittest pool
+        vectors of the target gender, for all input vectors at once. Queries
+        are processed in blocks of at most MAX_BLOCK_ELEMENTS distances, and
+        the random draw of each block is a single call to the numpy global
+        random generator, so np.random.seed makes the selection reproducible.
+        """
+        # every row of anon_vectors is filled by the loop over the pool genders
+        missing_genders = set(target_genders) - set(self.pool_genders)
+        if missing_genders:
+            raise ValueError(
+                f"No pool vectors of gender {', '.join(sorted(missing_genders))}, "
+                f"the pool has {', '.join(sorted(self.pool_genders))}"
+            )
+        pool_vectors = self.pool_embeddings.vectors.to(self.device)
+        vectors = vectors.to(self.device)
+        anon_vectors = torch.empty(
+            (len(vectors), pool_vectors.shape[1]), dtype=pool_vectors.dtype, device=self.device
+        )
+
+        for gender, pool_indices in sorted(self.pool_genders.items()):
+            queries = [i for i, target_gender in enumerate(target_genders) if target_gender == gender]
+            pool_indices = torch.tensor(pool_indices, device=self.device)
+            block_size = max(1, self.MAX_BLOCK_ELEMENTS // len(pool_indices))
+            for start in tqdm(range(0, len(queries), block_size), disable=len(queries) <= block_size):
+                block = torch.tensor(queries[start : start + block_size], device=self.device)
+                distances = self._compute_distances(
+                    vectors_a=pool_vectors[pool_indices], vectors_b=vectors[block]
+                )
+                candidates = pool_indices[self._get_pool_candidates(distances)]  # (block, N)
+                # N_star distinct candidates per query: the ones with the smallest random keys
+                keys = torch.from_numpy(np.random.random_sample(tuple(candidates.shape)))
+                selected = torch.gather(
+                    candidates, 1, torch.topk(keys, self.N_star, dim=1, largest=False).indices.to(self.device)
+                )
+                anon_vectors[block] = pool_vectors[selected].mean(dim=1)
+
+        return anon_vectors
+
     def _compute_distances(self, vectors_a, vectors_b):
+        # (len(vectors_a), len(vectors_b)) distance matrix
         if self.distance == "plda":
-            return 1 - self.distance_model.compute_distance(
+            return 1 - self.distance_model.compute_scores(
                 enrollment_vectors=vectors_a, trial_vectors=vectors_b
             )
         elif self.distance == "cosine":
-            return cosine_distances(X=vectors_a.cpu(), Y=vectors_b.cpu())
-        else:
-            return []
-
-    def _get_pool_candidates(self, distances, gender):
-        if self.cross_gender is True:
-            distances = distances[self.pool_genders[REVERSED_GENDERS[gender]]]
+            vectors_a = torch.nn.functional.normalize(vectors_a.to(torch.float64), dim=1)
+            vectors_b = torch.nn.functional.normalize(vectors_b.to(torch.float64), dim=1)
+            return torch.clamp(1 - vectors_a @ vectors_b.T, 0, 2)
         else:
-            distances = distances[self.pool_genders[gender]]
+            raise ValueError(f"Invalid distance {self.distance}, expected 'plda' or 'cosine'")
 
+    def _get_pool_candidates(self, distances):
+        # row indices of the N fittest pool vectors for each column of distances, (n_columns, N)
+        distances = distances.T
         if self.proximity == "farthest":
-            return np.argpartition(distances, -self.N)[-self.N :]
+            return torch.topk(distances, self.N, dim=1, largest=True).indices
         elif self.proximity == "nearest":
-            return np.argpartition(distances, self.N)[: self.N]
+            return torch.topk(distances, self.N, dim=1, largest=False).indices
         elif self.proximity == "center":
-            sorted_distances = np.sort(distances)
-            return sorted_distances[
-                len(sorted_distances) // 2 : (len(sorted_distances) // 2) + self.N
-            ]
+            middle = distances.shape[1] // 2
+            return torch.argsort(distances, dim=1)[:, middle : middle + self.N]
 
     def _load_scaling_ranges(self, stats_per_dim_path):
         if stats_per_dim_path and Path(stats_per_dim_path).exists():
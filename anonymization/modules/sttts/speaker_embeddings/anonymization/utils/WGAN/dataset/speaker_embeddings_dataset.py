@@ -65,6 +65,8 @@ class SpeakerEmbeddingsDataset(torch.utils.data.Dataset):
             self.mean = torch.mean(vectors)
             self.std = torch.std(vectors)
             return vectors, torch.zeros(vectors.size(0))
+        elif (feature_path / 'speaker_vectors.npy').exists():
+            vectors = torch.from_numpy(np.load(feature_path / 'speaker_vectors.npy')).to(self.device)
         else:
             vectors = torch.load(feature_path / 'speaker_vectors.pt', map_location=self.device)
 
@@ -18,9 +18,7 @@ class StyleEmbeddings:
                                                     device=self.device)
 
     def extract_vector(self, audio, sr):
-        if sr != self.audio_preprocessor.sr:
-            self.audio_preprocessor = AudioPreprocessor(input_sr=sr, output_sr=16000, cut_silence=True,
-                                                        device=self.device)
+        self._set_input_sr(sr)
 
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
@@ -29,3 +27,23 @@ class StyleEmbeddings:
             spec_len = torch.LongTensor([len(spec)])
             vector = self.extractor(spec.unsqueeze(0).to(self.device), spec_len.unsqueeze(0).to(self.device))
         return vector.squeeze().detach()
+
+    def extract_vectors(self, audios, sr):
+        """Batched extract_vector(): audios is a list of 1-D waveforms, the result is (B, 128)"""
+        self._set_input_sr(sr)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            specs = []
+            for audio in audios:
+                audio = self.audio_preprocessor.cut_silence_from_audio(audio.to(self.device)).cpu()
+                specs.append(self.audio_preprocessor.logmelfilterbank(audio, 16000).transpose(0, 1))
+            spec_lens = torch.LongTensor([len(spec) for spec in specs])
+            specs = torch.nn.utils.rnn.pad_sequence(specs, batch_first=True)
+            vectors = self.extractor(specs.to(self.device), spec_lens.unsqueeze(1).to(self.device))
+        return vectors.detach()
+
+    def _set_input_sr(self, sr):
+        if sr != self.audio_preprocessor.sr:
+            self.audio_preprocessor = AudioPreprocessor(input_sr=sr, output_sr=16000, cut_silence=True,
+                                                        device=self.device)
@@ -1,21 +1,31 @@
 import torch
 torch.set_num_threads(1)
 from espnet2.bin.asr_inference import Speech2Text
-import soundfile
-import resampy
 from espnet_model_zoo.downloader import ModelDownloader, str_to_hash
 
-from utils.data_io import parse_yaml
+from utils.data_io import parse_yaml, load_wav_from_scp
+from utils.resampling import resample
 
 
 class ImsASR:
 
-    def __init__(self, model_path, device, ctc_weight=0.2, utt_start_token='', utt_end_token='', **kwargs):
+    def __init__(self, model_path, device, ctc_weight=0.2, utt_start_token='', utt_end_token='', decoding='beam',
+                 beam_size=15, batch_size=1, **kwargs):
+        """
+            decoding: 'beam' (joint attention/CTC beam search of beam_size, one utterance at a time) or
+                'ctc_greedy' (best path of the CTC output, no decoder)
+            batch_size: with ctc_greedy, number of utterances of similar length encoded at once by
+                recognize_speech_of_audios()
+        """
+        if decoding not in ('beam', 'ctc_greedy'):
+            raise ValueError(f'Unknown decoding {decoding}, expected beam or ctc_greedy')
         self.device = device
         self.model_path = model_path
         self.ctc_weight = ctc_weight
         self.utt_start_token = utt_start_token
         self.utt_end_token = utt_end_token
+        self.decoding = decoding
+        self.batch_size = batch_size
 
 
         # It is not sufficient to simply unzip the model.zip folder because this would not set up the environment
@@ -42,7 +52,7 @@ class ImsASR:
                                        minlenratio=0.0,
                                        maxlenratio=0.0,
                                        ctc_weight=ctc_weight,
-                                       beam_size=15,
+                                       beam_size=beam_size,
                                        batch_size=1,
                                        nbest=1,
                                        quantize_asr_model=False)
@@ -50,12 +60,113 @@ class ImsASR:
         self.output = 'phones' if '-phn' in model_path.name else 'text'
 
     def recognize_speech_of_audio(self, audio_file):
-        speech, rate = soundfile.read(audio_file)
-        if len(speech.shape) == 2:
-            speech = speech.squeeze(0)
-        speech = torch.tensor(resampy.resample(speech, rate, 16000), device=self.device)
+        return self.recognize_speech_of_audios([audio_file])[0]
 
-        nbests = self.speech2text(speech)
+    def recognize_speech_of_audios(self, audio_files):
+        """Recognizes a list of wav.scp entries and returns their texts, in the
+        order of audio_files. With ctc_greedy decoding, the utterances are
+        sorted by duration and encoded in zero-padded buckets of
+        self.batch_size utterances."""
+        speeches = [self._load_speech(audio_file) for audio_file in audio_files]
+        if self.decoding == 'beam':
+            texts = [self._recognize_beam(speech) for speech in speeches]
+        else:
+            texts = [None] * len(speeches)
+            order = sorted(range(len(speeches)), key=lambda i: len(speeches[i]))
+            for start in range(0, len(order), self.batch_size):
+                bucket = order[start:start + self.batch_size]
+                for i, text in zip(bucket, self._recognize_ctc_greedy([speeches[i] for i in bucket])):
+                    texts[i] = text
+        return [self.utt_start_token + text + self.utt_end_token for text in texts]
+
+    def _load_speech(self, audio_file):
+        speech, rate = load_wav_from_scp(audio_file)
+        return resample(speech[0], rate, 16000)
+
+    def _recognize_beam(self, speech):
+        nbests = self.speech2text(speech.to(self.device))
         text, *_ = nbests[0]
-        text = self.utt_start_token + text + self.utt_end_token
         return text
+
+    @torch.no_grad()
+    def _recognize_ctc_greedy(self, speeches):
+        # one encoder call for the padded bucket, then the best CTC path of each utterance without its padding
+        asr_model = self.speech2text.asr_model
+        lengths = torch.tensor([len(speech) for speech in speeches], dtype=torch.long, device=self.device)
+        speech = torch.nn.utils.rnn.pad_sequence(speeches, batch_first=True)
+        speech = speech.to(self.device, dtype=next(asr_model.parameters()).dtype)
+        enc, enc_lens = asr_model.encode(speech=speech, speech_lengths=lengths)
+        if isinstance(enc, tuple):  # intermediate CTC outputs
+            enc = enc[0]
+
+        texts = []
+        for token_ids, length in zip(asr_model.ctc.argmax(enc).cpu(), enc_lens.tolist()):
+            # collapse the repeated tokens, then drop the blanks
+            token_ids = torch.unique_consecutive(token_ids[:length])
+            token_ids = token_ids[token_ids != asr_model.blank_id].tolist()
+            tokens = self.speech2text.converter.ids2tokens(token_ids)
+            if self.speech2text.tokenizer is not None:
+                texts.append(self.speech2text.tokenizer.tokens2text(tokens))
+            else:
+                texts.append(''.join(tokens))
+        return texts
+
+
+def _edit_distance(ref, hyp):
+    distances = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, start=1):
+        previous, distances[0] = distances[0], i
+        for j, h in enumerate(hyp, start=1):
+            previous, distances[j] = distances[j], min(distances[j] + 1, distances[j - 1] + 1, previous + (r != h))
+    return distances[-1]
+
+
+def benchmark_ims_asr(model_path, device='cpu', wav_scp=None, n_utts=16, batch_size=8, seed=0):
+    """Real-time factor of the default beam-15 search, of a beam-4 search and
+    of the batched CTC-greedy decoding, and the token error rate of their
+    outputs against the beam-15 outputs (drift). Runs on the utterances of
+    wav_scp, or on a synthetic fixture of harmonic signals.
+    """
+    import tempfile
+    import time
+    from pathlib import Path
+    import numpy as np
+    import soundfile
+    from utils import read_kaldi_format
+
+    modes = {
+        'beam-15': dict(beam_size=15),
+        'beam-4': dict(beam_size=4),
+        f'ctc-greedy x{batch_size}': dict(decoding='ctc_greedy', batch_size=batch_size),
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if wav_scp is None:
+            rng = np.random.default_rng(seed)
+            audio_files = []
+            for i in range(n_utts):
+                t = np.arange(int(16000 * rng.uniform(1, 6))) / 16000
+                f0 = rng.uniform(90, 220) * (1 + 0.2 * np.sin(2 * np.pi * rng.uniform(0.5, 3) * t))
+                phase = 2 * np.pi * np.cumsum(f0) / 16000
+                signal = sum(np.sin(k * phase) / k for k in range(1, 8)) * (0.6 + 0.4 * np.sin(2 * np.pi * 4 * t))
+                signal = 0.1 * signal + 0.005 * rng.standard_normal(len(t))
+                audio_files.append(str(Path(tmp_dir) / f'utt{i}.wav'))
+                soundfile.write(audio_files[-1], signal, 16000, subtype='PCM_16')
+        else:
+            audio_files = list(read_kaldi_format(wav_scp).values())[:n_utts]
+        duration = 0
+        for audio_file in audio_files:
+            speech, rate = load_wav_from_scp(audio_file)
+            duration += speech.shape[-1] / rate
+
+        outputs = {}
+        for name, mode in modes.items():
+            asr = ImsASR(model_path=Path(model_path), device=device, **mode)
+            start = time.perf_counter()
+            outputs[name] = asr.recognize_speech_of_audios(audio_files)
+            elapsed = time.perf_counter() - start
+            # phone models output characters, text models words
+            tokenize = list if asr.output == 'phones' else str.split
+            reference = outputs['beam-15']
+            errors = sum(_edit_distance(tokenize(ref), tokenize(hyp)) for ref, hyp in zip(reference, outputs[name]))
+            drift = errors / max(1, sum(len(tokenize(ref)) for ref in reference))
+            print(f'{name}: {elapsed:.1f}s, RTF {elapsed / duration:.3f}, drift vs beam-15 {100 * drift:.2f}%')
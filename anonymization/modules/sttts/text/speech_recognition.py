@@ -1,14 +1,13 @@
 from tqdm import tqdm
-from tqdm.contrib.concurrent import process_map
+import queue
 import time
+import traceback
+import torch.multiprocessing as mp
 from torch.multiprocessing import set_start_method
-from itertools import cycle, repeat
-import numpy as np
 from pathlib import Path
 
 from .text import Text
-from .recognition.ims_asr import ImsASR
-from utils import read_kaldi_format, setup_logger
+from utils import KaldiDataDir, setup_logger
 
 set_start_method('spawn', force=True)
 logger = setup_logger(__name__)
@@ -33,30 +32,46 @@ class SpeechRecognition:
             if self.save_intermediate:
                 raise ValueError('Results dir must be specified in parameters or settings!')
 
-        self.asr_models = [create_model_instance(hparams=self.model_hparams, device=device) for device, process in zip(cycle(devices), range(len(devices)))]
-        self.is_phones = (self.asr_models[0].output == 'phones')
+        if self.n_processes == 1:
+            self.asr_models = [create_model_instance(hparams=self.model_hparams, device=self.devices[0])]
+            self.is_phones = (self.asr_models[0].output == 'phones')
+        else:
+            # one long-lived worker per device loads its own model, see ASRWorkers
+            self.asr_models = []
+            self.workers = ASRWorkers(hparams=self.model_hparams, devices=self.devices)
+            self.is_phones = '-phn' in Path(self.model_hparams['model_path']).name
 
     def recognize_speech(self, dataset_path, dataset_name=None, utterance_list=None):
         dataset_name = dataset_name if dataset_name else dataset_path.name
         dataset_results_dir = self.results_dir / dataset_name if self.save_intermediate else Path('')
 
-        utt2spk = read_kaldi_format(dataset_path / 'utt2spk')
+        data_dir = KaldiDataDir(dataset_path)
+        utt2spk = data_dir['utt2spk']
         texts = Text(is_phones=self.is_phones)
 
         if (dataset_results_dir / 'text').exists() and not self.force_compute:
             # if the text created from this ASR model already exists for this dataset and a computation is not
             # forced, simply load the text
             texts.load_text(in_dir=dataset_results_dir)
+        # utterances checkpointed by an interrupted run are kept, and so is their checkpoint
+        resume = self.save_intermediate and not self.force_compute and not utterance_list
+        resumed = resume and texts.load_checkpoint(in_dir=dataset_results_dir)
+        if resumed:
+            logger.info(f'Resume speech recognition from checkpoint with {len(texts)} utterances')
 
         if len(texts) == len(utt2spk):
             logger.info('No speech recognition necessary; load existing text instead...')
+            if resumed:
+                # interrupted after its last checkpoint
+                texts.save_text(out_dir=dataset_results_dir)
+                self._remove_temp_files(out_dir=dataset_results_dir)
         else:
             if len(texts) > 0:
                 logger.info(f'No speech recognition necessary for {len(texts)} of {len(utt2spk)} utterances')
             # otherwise, recognize the speech
             dataset_results_dir.mkdir(exist_ok=True, parents=True)
             logger.info(f'Recognize speech of {len(utt2spk)} utterances...')
-            wav_scp = read_kaldi_format(dataset_path / 'wav.scp')
+            wav_scp = data_dir['wav.scp']
 
             utterances = []
             for utt, spk in utt2spk.items():
@@ -71,18 +86,11 @@ class SpeechRecognition:
             start = time.time()
 
             if self.n_processes == 1:
-                new_texts = [recognition_job([utterances, self.asr_models[0],
-                                             dataset_results_dir, 0, self.devices[0], self.model_hparams, None,
-                                             save_intermediate])]
+                new_texts = [recognition_job([utterances, self.asr_models[0], dataset_results_dir, None,
+                                              save_intermediate, resume])]
             else:
-                sleeps = [10 * i for i in range(self.n_processes)]
-                indices = np.array_split(np.arange(len(utterances)), self.n_processes)
-                utterance_jobs = [[utterances[ind] for ind in chunk] for chunk in indices]
-                # multiprocessing
-                job_params = zip(utterance_jobs, repeat(self.asr_models), repeat(dataset_results_dir), sleeps,
-                                 self.devices, repeat(self.model_hparams), list(range(self.n_processes)),
-                                 repeat(save_intermediate))
-                new_texts = process_map(recognition_job, job_params, max_workers=self.n_processes)
+                new_texts = [self.workers.recognize(utterances, is_phones=self.is_phones, out_dir=dataset_results_dir,
+                                                    save_intermediate=save_intermediate, resume=resume)]
 
             end = time.time()
             total_time = round(end - start, 2)
@@ -96,6 +104,11 @@ class SpeechRecognition:
 
         return texts
 
+    def close(self):
+        # stops the worker processes and frees their devices, they are started again if needed
+        if self.n_processes > 1:
+            self.workers.close()
+
     def _combine_texts(self, main_text_instance, additional_text_instances):
         for add_text_instance in additional_text_instances:
             main_text_instance.add_instances(sentences=add_text_instance.sentences,
@@ -112,32 +125,136 @@ class SpeechRecognition:
             file.unlink()
 
 
+class ASRWorkers:
+    """
+        One recognizer process per device, started on the first use and kept
+        for all datasets. Each worker loads its model once, then pulls windows
+        of utterances from a shared queue and streams the texts back.
+    """
+
+    def __init__(self, hparams, devices):
+        self.hparams = hparams
+        self.devices = devices
+        self.processes = []
+
+    def _start(self):
+        ctx = mp.get_context('spawn')
+        self.task_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        for device in self.devices:
+            process = ctx.Process(target=asr_worker, args=(self.hparams, device, self.task_queue, self.result_queue),
+                                  daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def recognize(self, utterances, is_phones, out_dir, save_intermediate, resume=False):
+        if not self.processes:
+            self._start()
+        windows = [utterances[i:i + 100] for i in range(0, len(utterances), 100)]
+        for window in windows:
+            self.task_queue.put(window)
+
+        # results arrive in completion order, the parent checkpoints them
+        texts = Text(is_phones=is_phones)
+        try:
+            with tqdm(total=len(utterances), desc='ASR workers', leave=True) as progress:
+                for _ in windows:
+                    results = self._get_result()
+                    if isinstance(results, str):
+                        raise RuntimeError(f'ASR worker failed:\n{results}')
+                    start = len(texts)
+                    for utt, spk, sentence in results:
+                        texts.add_instance(sentence=sentence, utterance=utt, speaker=spk)
+                    if save_intermediate:
+                        texts.append_text(out_dir=out_dir, start=start, resume=resume)
+                    progress.update(len(results))
+        except BaseException:
+            # the workers would first recognize all queued windows
+            self.terminate()
+            raise
+
+        if save_intermediate:
+            texts.append_text(out_dir=out_dir, start=len(texts), commit=True, resume=resume)
+        return texts
+
+    def _get_result(self):
+        # a worker killed by the OS (e.g. out of memory) never answers, its exit is detected instead
+        while True:
+            dead = [process for process in self.processes if not process.is_alive()]
+            if dead:
+                raise RuntimeError(f'ASR worker died with exit code {dead[0].exitcode}')
+            try:
+                return self.result_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+
+    def close(self):
+        for _ in self.processes:
+            self.task_queue.put(None)
+        for process in self.processes:
+            process.join(timeout=60)
+        self.terminate()
+
+    def terminate(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        if self.processes:
+            # unsent windows must not keep the parent from exiting
+            self.task_queue.cancel_join_thread()
+        self.processes = []
+
+
+def asr_worker(hparams, device, task_queue, result_queue):
+    try:
+        asr_model = create_model_instance(hparams=hparams, device=device)
+    except Exception:
+        result_queue.put(traceback.format_exc())
+        return
+    while True:
+        window = task_queue.get()
+        if window is None:
+            break
+        try:
+            sentences = asr_model.recognize_speech_of_audios([wav_path for _, _, wav_path in window])
+            result_queue.put([(utt, spk, sentence) for (utt, spk, _), sentence in zip(window, sentences)])
+        except Exception:
+            result_queue.put(traceback.format_exc())
+
+
 def create_model_instance(hparams, device):
     recognizer = hparams.get('recognizer')
     if recognizer == 'ims':
+        # ESPnet is only needed once a model is loaded
+        from .recognition.ims_asr import ImsASR
         return ImsASR(**hparams, device=device)
     else:
         raise ValueError(f'Invalid recognizer option: {recognizer}')
 
 
 def recognition_job(data):
-    utterances, asr_model, out_dir, sleep, device, model_hparams, job_id, save_intermediate = data
-    time.sleep(sleep)
+    utterances, asr_model, out_dir, job_id, save_intermediate, resume = data
 
     add_suffix = f'_{job_id}' if job_id is not None else None
     job_id = job_id or 0
 
     texts = Text(is_phones=(asr_model.output == 'phones'))
-    i = 0
-    for utt, spk, wav_path in tqdm(utterances, desc=f'Job {job_id}', leave=True):
-        sentence = asr_model.recognize_speech_of_audio(audio_file=wav_path)
-        texts.add_instance(sentence=sentence, utterance=utt, speaker=spk)
+    saved = 0
+    with tqdm(total=len(utterances), desc=f'Job {job_id}', leave=True) as progress:
+        # windows of 100 utterances, recognized together (see ImsASR.recognize_speech_of_audios), then checkpointed
+        for start in range(0, len(utterances), 100):
+            window = utterances[start:start + 100]
+            sentences = asr_model.recognize_speech_of_audios([wav_path for _, _, wav_path in window])
+            for (utt, spk, _), sentence in zip(window, sentences):
+                texts.add_instance(sentence=sentence, utterance=utt, speaker=spk)
+            progress.update(len(window))
 
-        i += 1
-        if i % 100 == 0 and save_intermediate:
-            texts.save_text(out_dir=out_dir, add_suffix=add_suffix)
+            if len(window) == 100 and save_intermediate:
+                texts.append_text(out_dir=out_dir, start=saved, add_suffix=add_suffix, resume=resume)
+                saved = len(texts)
 
     if save_intermediate:
-        texts.save_text(out_dir=out_dir, add_suffix=add_suffix)
+        texts.append_text(out_dir=out_dir, start=saved, add_suffix=add_suffix, commit=True, resume=resume)
 
     return texts
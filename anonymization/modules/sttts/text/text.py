@@ -1,7 +1,7 @@
 from pathlib import Path
 import numpy as np
 
-from utils import read_kaldi_format, save_kaldi_format
+from utils import read_kaldi_format, save_kaldi_format, KaldiWriter
 
 
 class Text:
@@ -102,6 +102,28 @@ class Text:
         save_kaldi_format(data=list(zip(self.utterances, self.speakers)),
                           filename=out_dir / f'utt2spk{add_suffix}')
 
+    def append_text(self, out_dir: Path, start, add_suffix=None, commit=False, resume=False):
+        # checkpoint of save_text() costing O(new instances): appends the instances from index start on,
+        # commit=True then writes the final sorted files. The first append (start=0) discards the checkpoint of an
+        # interrupted run unless resume=True
+        out_dir.mkdir(exist_ok=True, parents=True)
+        add_suffix = add_suffix if add_suffix is not None else ""
+        for name, values in (('text', self.sentences), ('utt2spk', self.speakers)):
+            writer = KaldiWriter(out_dir / f'{name}{add_suffix}', resume=start > 0 or resume)
+            writer.append(list(zip(self.utterances[start:], values[start:])))
+            if commit:
+                writer.commit()
+
+    def load_checkpoint(self, in_dir, add_suffix=None):
+        # adds the instances of an interrupted append_text() run, returns their number
+        add_suffix = add_suffix if add_suffix is not None else ""
+        sentences = KaldiWriter(in_dir / f'text{add_suffix}', resume=True).read(values_as_string=True)
+        speakers = KaldiWriter(in_dir / f'utt2spk{add_suffix}', resume=True).read()
+        utterances = [utt for utt in sentences if utt in speakers and utt not in self.utt2idx]
+        for utt in utterances:
+            self.add_instance(sentence=sentences[utt], utterance=utt, speaker=speakers[utt])
+        return len(utterances)
+
     def load_text(self, in_dir, add_suffix=None):
         self.new = False
         add_suffix = add_suffix if add_suffix is not None else ""
@@ -114,8 +136,8 @@ class Text:
             self.sentences = sentences
             self.speakers = speakers
         elif sorted(utt_1) == sorted(utt_2):
-            self.utterances, self.sentences = zip(*sorted(zip(utt_1, sentences), key=lambda x: x[0]))
-            _, self.speakers = zip(*sorted(zip(utt_2, speakers), key=lambda x: x[0]))
+            self.utterances, self.sentences = map(list, zip(*sorted(zip(utt_1, sentences), key=lambda x: x[0])))
+            self.speakers = [spk for _, spk in sorted(zip(utt_2, speakers), key=lambda x: x[0])]
         else:
             raise ValueError(f'{in_dir / f"text{add_suffix}"} and {in_dir / f"utt2spk{add_suffix}"} have mismatching '
                              f'utterance keys; sentences cannot be loaded!')
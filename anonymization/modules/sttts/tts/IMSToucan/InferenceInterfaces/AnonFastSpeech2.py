@@ -20,7 +20,8 @@ logger = logging.getLogger(__name__)
 
 class AnonFastSpeech2(torch.nn.Module):
 
-    def __init__(self, path_to_hifigan_model, path_to_fastspeech_model, path_to_embed_model, device="cpu", language="en", noise_reduce=False):
+    def __init__(self, path_to_hifigan_model, path_to_fastspeech_model, path_to_embed_model, device="cpu", language="en", noise_reduce=False,
+                 vocoder_chunk_size=None):
         super().__init__()
         self.device = device
         self.audio_preprocessor = AudioPreprocessor(input_sr=16000, output_sr=16000, cut_silence=True, device=self.device)
@@ -33,7 +34,7 @@ class AnonFastSpeech2(torch.nn.Module):
             print("Loading a multilingual model, which is strange for this purpose. Please double check that the correct model is being loaded.")
             self.use_lang_id = True
             self.phone2mel = FastSpeech2(weights=checkpoint["model"], lang_embs=1000).to(torch.device(device))
-        self.mel2wav = HiFiGANGenerator(path_to_weights=path_to_hifigan_model).to(torch.device(device))
+        self.mel2wav = HiFiGANGenerator(path_to_weights=path_to_hifigan_model, chunk_size=vocoder_chunk_size).to(torch.device(device))
         self.style_embedding_function = StyleEmbedding()
         check_dict = torch.load(path_to_embed_model, map_location="cpu")
         self.style_embedding_function.load_state_dict(check_dict["style_emb_func"])
@@ -89,8 +90,13 @@ class AnonFastSpeech2(torch.nn.Module):
                 durations=None,
                 pitch=None,
                 energy=None,
-                text_is_phonemes=False):
+                text_is_phonemes=False,
+                min_frames=0,
+                return_num_corrections=False):
         """
+        min_frames: if the spectrogram has fewer frames, the durations are stretched to min_frames frames in total
+                    and the spectrogram is generated once more (with the same pitch and energy) before vocoding.
+        return_num_corrections: whether to also return the number of such corrections (0 or 1)
         duration_scaling_factor: reasonable values are 0.5 < scale < 1.5.
                                      1.0 means no scaling happens, higher values increase durations for the whole
                                      utterance, lower values decrease durations for the whole utterance.
@@ -110,6 +116,16 @@ class AnonFastSpeech2(torch.nn.Module):
                                                            pitch=pitch,
                                                            energy=energy,
                                                            lang_id=self.lang_id)
+            num_corrections = 0
+            if len(mel) < min_frames:
+                mel, durations, pitch, energy = self.phone2mel(phones,
+                                                               return_duration_pitch_energy=True,
+                                                               utterance_embedding=self.default_utterance_embedding,
+                                                               durations=lengthen_durations(durations, min_frames),
+                                                               pitch=pitch,
+                                                               energy=energy,
+                                                               lang_id=self.lang_id)
+                num_corrections = 1
             mel = mel.transpose(0, 1)
             wave = self.mel2wav(mel)
         if view:
@@ -135,8 +151,77 @@ class AnonFastSpeech2(torch.nn.Module):
             plt.show()
         if self.noise_reduce:
             wave = torch.tensor(noisereduce.reduce_noise(y=wave.cpu().numpy(), y_noise=self.prototypical_noise, sr=48000, stationary=True), device=self.device)
+        if return_num_corrections:
+            return wave, num_corrections
         return wave
 
+    def batch_forward(self,
+                      texts,
+                      utterance_embeddings,
+                      durations=None,
+                      pitch=None,
+                      energy=None,
+                      text_is_phonemes=False,
+                      duration_scaling_factor=1.0,
+                      pitch_variance_scale=1.0,
+                      energy_variance_scale=1.0,
+                      min_frames=0,
+                      return_num_corrections=False):
+        """
+        Synthesizes a batch of texts at once: the phoneme sequences, the prosody and the spectrograms are padded
+        and masked, every wave matches the one of forward() for the single text.
+
+        texts: list of B texts
+        utterance_embeddings: speaker embedding of each text (B, utt_embed_dim)
+        durations, pitch, energy: lists of B prosody tensors, as for forward() (optional)
+        min_frames, return_num_corrections: see forward(), the spectrograms that are too short are generated again
+                                            together
+        returns: list of the B waves (and list of the B numbers of corrections)
+        """
+        with torch.inference_mode():
+            phones = [self.text2phone.string_to_tensor(text, input_phonemes=text_is_phonemes) for text in texts]
+            text_lens = torch.LongTensor([len(phone_seq) for phone_seq in phones]).to(self.device)
+
+            def pad(sequences):
+                if sequences is None:
+                    return None
+                return torch.nn.utils.rnn.pad_sequence([seq.to(self.device) for seq in sequences], batch_first=True)
+
+            utterance_embeddings = utterance_embeddings.to(self.device)
+            mels, mel_lens, durations, pitch, energy = self.phone2mel.batch_forward(pad(phones),
+                                                                                   text_lens,
+                                                                                   utterance_embeddings=utterance_embeddings,
+                                                                                   durations=pad(durations),
+                                                                                   pitch=pad(pitch),
+                                                                                   energy=pad(energy),
+                                                                                   lang_id=self.lang_id,
+                                                                                   duration_scaling_factor=duration_scaling_factor,
+                                                                                   pitch_variance_scale=pitch_variance_scale,
+                                                                                   energy_variance_scale=energy_variance_scale)
+            mels = [mel[:mel_len] for mel, mel_len in zip(mels, mel_lens.tolist())]
+            num_corrections = [0] * len(texts)
+            short = [i for i, mel in enumerate(mels) if len(mel) < min_frames]
+            if short:
+                short_lens = text_lens[short]
+                short_mels, short_mel_lens, _, _, _ = self.phone2mel.batch_forward(
+                    pad([phones[i] for i in short]),
+                    short_lens,
+                    utterance_embeddings=utterance_embeddings[short],
+                    durations=pad([lengthen_durations(durations[i, :length], min_frames) for i, length in zip(short, short_lens)]),
+                    pitch=pad([pitch[i, :length] for i, length in zip(short, short_lens)]),
+                    energy=pad([energy[i, :length] for i, length in zip(short, short_lens)]),
+                    lang_id=self.lang_id)
+                for i, mel, mel_len in zip(short, short_mels, short_mel_lens.tolist()):
+                    mels[i] = mel[:mel_len]
+                    num_corrections[i] = 1
+            waves = self.mel2wav.batch_forward(pad(mels).transpose(1, 2), torch.LongTensor([len(mel) for mel in mels]))
+        if self.noise_reduce:
+            waves = [torch.tensor(noisereduce.reduce_noise(y=wave.cpu().numpy(), y_noise=self.prototypical_noise, sr=48000, stationary=True), device=self.device)
+                     for wave in waves]
+        if return_num_corrections:
+            return waves, num_corrections
+        return waves
+
     def read_to_file(self,
                      text_list,
                      file_location,
@@ -223,3 +308,13 @@ class AnonFastSpeech2(torch.nn.Module):
         else:
             sounddevice.play(torch.cat((wav, torch.zeros([12000])), 0).numpy(), samplerate=48000)
             sounddevice.wait()
+
+
+def lengthen_durations(durations, min_frames):
+    """
+    Stretches the durations of the phonemes (T,) to at least min_frames frames in total, keeping their
+    proportions. Phonemes without frames (word boundaries) stay without, unless no phoneme has any frame.
+    """
+    if durations.sum() == 0:
+        durations = torch.ones_like(durations)
+    return torch.ceil(durations.float() * (min_frames / durations.sum().item())).long()
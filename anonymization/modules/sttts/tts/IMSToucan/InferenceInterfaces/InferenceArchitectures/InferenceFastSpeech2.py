@@ -9,6 +9,7 @@ from ...Layers.PostNet import PostNet
 from ...Layers.VariancePredictor import VariancePredictor
 from ...Utility.utils import make_non_pad_mask
 from ...Utility.utils import make_pad_mask
+from ...Utility.utils import masked_padding
 
 
 class FastSpeech2(torch.nn.Module, ABC):
@@ -292,6 +293,86 @@ class FastSpeech2(torch.nn.Module, ABC):
             return after_outs[0], d_outs[0], pitch_predictions[0], energy_predictions[0]
         return after_outs[0]
 
+    @torch.no_grad()
+    def batch_forward(self,
+                      texts,
+                      text_lens,
+                      utterance_embeddings,
+                      durations=None,
+                      pitch=None,
+                      energy=None,
+                      lang_id=None,
+                      duration_scaling_factor=1.0,
+                      pitch_variance_scale=1.0,
+                      energy_variance_scale=1.0):
+        """
+        Generate the spectrograms of a padded batch of vectorized phoneme sequences. The padded part is masked
+        in all layers, so that every spectrogram matches the one forward() generates for the single sequence.
+
+        Args:
+            texts: padded batch of vectorized phoneme sequences (B, Tmax, idim)
+            text_lens: number of phonemes of each sequence (B,)
+            utterance_embeddings: embedding of speaker information of each sequence (B, utt_embed_dim)
+            durations: padded durations to be used (B, Tmax) (optional, if not provided, they will be predicted)
+            pitch: padded token-averaged pitch curves to be used (B, Tmax, 1) (optional)
+            energy: padded token-averaged energy curves to be used (B, Tmax, 1) (optional)
+            lang_id: id to be fed into the embedding layer that contains language information, shared by the batch
+            duration_scaling_factor, pitch_variance_scale, energy_variance_scale: see forward()
+
+        Returns:
+            padded mel spectrograms (B, Lmax, odim), number of frames of each (B,), durations, pitch and energy
+            (padded, as predicted or given)
+        """
+        self.eval()
+        lang_ids = lang_id.view(1, -1).expand(len(texts), -1).to(texts.device) if lang_id is not None else None
+        if not self.multilingual_model:
+            lang_ids = None
+        if not self.multispeaker_model:
+            utterance_embeddings = None
+
+        text_masks = self._source_mask(text_lens)
+        duration_masks = make_pad_mask(text_lens, device=text_lens.device)
+        with masked_padding(self.encoder, text_lens), \
+                masked_padding(self.duration_predictor, text_lens), \
+                masked_padding(self.pitch_predictor, text_lens), \
+                masked_padding(self.energy_predictor, text_lens):
+            encoded_texts, _ = self.encoder(texts, text_masks, utterance_embedding=utterance_embeddings,
+                                            lang_ids=lang_ids)
+            pitch_predictions = self.pitch_predictor(encoded_texts, duration_masks.unsqueeze(-1))
+            energy_predictions = self.energy_predictor(encoded_texts, duration_masks.unsqueeze(-1))
+            if durations is not None:
+                duration_predictions = durations
+            else:
+                duration_predictions = self.duration_predictor.inference(encoded_texts, duration_masks)
+        if pitch is not None:
+            pitch_predictions = pitch.clone()
+        if energy is not None:
+            energy_predictions = energy
+
+        pitch_predictions[texts[:, :, 61] == 0] = 0.0
+        pitch_predictions = _scale_batch_variance(pitch_predictions, text_lens, pitch_variance_scale)
+        energy_predictions = _scale_batch_variance(energy_predictions, text_lens, energy_variance_scale)
+
+        pitch_embeddings = self.pitch_embed(pitch_predictions.transpose(1, 2)).transpose(1, 2)
+        energy_embeddings = self.energy_embed(energy_predictions.transpose(1, 2)).transpose(1, 2)
+        encoded_texts = encoded_texts + energy_embeddings + pitch_embeddings
+
+        if duration_scaling_factor != 1.0:
+            assert duration_scaling_factor > 0
+            duration_predictions = torch.round(duration_predictions.float() * duration_scaling_factor).long()
+        # like the length regulator, sequences without any frame get one frame per phoneme
+        without_frames = duration_predictions.sum(dim=1) == 0
+        duration_predictions[without_frames] = (~duration_masks[without_frames]).long()
+        encoded_texts = self.length_regulator(encoded_texts, duration_predictions)
+        speech_lens = duration_predictions.sum(dim=1)
+
+        with masked_padding(self.decoder, speech_lens), masked_padding(self.postnet, speech_lens):
+            zs, _ = self.decoder(encoded_texts, self._source_mask(speech_lens))
+            before_outs = self.feat_out(zs).view(zs.size(0), -1, self.odim)
+            after_outs = before_outs + self.postnet(before_outs.transpose(1, 2)).transpose(1, 2)
+        self.train()
+        return after_outs, speech_lens, duration_predictions, pitch_predictions, energy_predictions
+
     def _source_mask(self, ilens):
         x_masks = make_non_pad_mask(ilens).to(next(self.parameters()).device)
         return x_masks.unsqueeze(-2)
@@ -308,3 +389,13 @@ def _scale_variance(sequence, scale):
         if sequence[0][sequence_index] < 0.0:
             sequence[0][sequence_index] = 0.0
     return sequence
+
+
+def _scale_batch_variance(sequences, lengths, scale):
+    # _scale_variance of each unpadded sequence of the batch
+    if scale == 1.0:
+        return sequences
+    sequences = sequences.clone()
+    for index, length in enumerate(lengths.tolist()):
+        sequences[index, :length] = _scale_variance(sequences[index:index + 1, :length], scale)[0]
+    return sequences
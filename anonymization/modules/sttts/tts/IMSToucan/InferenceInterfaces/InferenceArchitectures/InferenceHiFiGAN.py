@@ -1,6 +1,10 @@
+import math
+
+import numpy as np
 import torch
 
 from ...Layers.ResidualBlock import HiFiGANResidualBlock as ResidualBlock
+from ...Utility.utils import masked_padding
 
 
 class HiFiGANGenerator(torch.nn.Module):
@@ -19,12 +23,23 @@ class HiFiGANGenerator(torch.nn.Module):
                  bias=True,
                  nonlinear_activation="LeakyReLU",
                  nonlinear_activation_params={"negative_slope": 0.1},
-                 use_weight_norm=True, ):
+                 use_weight_norm=True,
+                 chunk_size=None,
+                 chunk_crossfade=2, ):
+        """
+        chunk_size: if given, spectrograms of more frames are vocoded in chunks of chunk_size frames (see
+                    _chunked_generate), which bounds the activation memory for long utterances
+        chunk_crossfade: frames over which neighbouring chunks are cross-faded
+        """
         super().__init__()
+        assert chunk_size is None or chunk_size > 2 * chunk_crossfade, "Chunks must be longer than their cross-fades."
+        self.chunk_size = chunk_size
+        self.chunk_crossfade = chunk_crossfade
         assert kernel_size % 2 == 1, "Kernal size must be odd number."
         assert len(upsample_scales) == len(upsample_kernel_sizes)
         assert len(resblock_dilations) == len(resblock_kernel_sizes)
         self.num_upsamples = len(upsample_kernel_sizes)
+        self.upsample_factor = int(np.prod(upsample_scales))
         self.num_blocks = len(resblock_kernel_sizes)
         self.input_conv = torch.nn.Conv1d(in_channels,
                                           channels,
@@ -64,15 +79,82 @@ class HiFiGANGenerator(torch.nn.Module):
     def forward(self, c, normalize_before=False):
         if normalize_before:
             c = (c - self.mean) / self.scale
-        c = self.input_conv(c.unsqueeze(0))
+        c = c.unsqueeze(0)
+        if self.chunk_size and c.shape[-1] > self.chunk_size:
+            return self._chunked_generate(c)
+        return self._generate(c).squeeze(0).squeeze(0)
+
+    def batch_forward(self, c, lengths):
+        """
+        Vocodes a padded batch of spectrograms (B, in_channels, Tmax) with lengths frames (B,) each. The padded
+        part is masked in all layers, so every wave matches the one of forward() for the single spectrogram.
+
+        Returns:
+            list of the B waves, trimmed to lengths * upsample_factor samples
+        """
+        if self.chunk_size and c.shape[-1] > self.chunk_size:
+            # the padded batch would not bound the memory, vocode the spectrograms one by one in chunks
+            return [self.forward(mel[:, :length]) for mel, length in zip(c, lengths.tolist())]
+        with masked_padding(self, lengths):
+            waves = self._generate(c).squeeze(1)
+        return [wave[:length * self.upsample_factor] for wave, length in zip(waves, lengths.tolist())]
+
+    def _generate(self, c):
+        c = self.input_conv(c)
         for i in range(self.num_upsamples):
             c = self.upsamples[i](c)
             cs = 0.0  # initialize
             for j in range(self.num_blocks):
                 cs = cs + self.blocks[i * self.num_blocks + j](c)
             c = cs / self.num_blocks
-        c = self.output_conv(c)
-        return c.squeeze(0).squeeze(0)
+        return self.output_conv(c)
+
+    @property
+    def receptive_field(self):
+        """Number of spectrogram frames on each side of a frame that its samples depend on (upper bound)"""
+        def radius(conv):
+            return conv.dilation[0] * (conv.kernel_size[0] - 1) // 2
+
+        frames = radius(self.input_conv)
+        rate = 1  # samples per frame at the current layer
+        for i in range(self.num_upsamples):
+            upsample = self.upsamples[i][1]
+            frames += math.ceil(upsample.kernel_size[0] / upsample.stride[0]) / rate
+            rate *= upsample.stride[0]
+            # parallel blocks, each a chain of convolutions
+            blocks = self.blocks[i * self.num_blocks:(i + 1) * self.num_blocks]
+            frames += max(sum(radius(conv[1]) for conv in [*block.convs1, *getattr(block, 'convs2', [])])
+                          for block in blocks) / rate
+        frames += radius(self.output_conv[1]) / rate
+        return math.ceil(frames)
+
+    def _chunked_generate(self, c):
+        """
+        Vocodes c (1, in_channels, T) in chunks of chunk_size frames. Each chunk is extended by chunk_crossfade
+        frames and by the receptive field on both sides as context, so its samples are the ones of the full pass;
+        the extensions overlap those of the neighbouring chunks and are cross-faded linearly.
+        """
+        n_frames = c.shape[-1]
+        context = self.receptive_field + self.chunk_crossfade
+        fade = self.chunk_crossfade * self.upsample_factor
+        ramp = (torch.arange(2 * fade, device=c.device, dtype=c.dtype) + 0.5) / (2 * fade)
+        wave = c.new_zeros(n_frames * self.upsample_factor)
+        starts = list(range(0, n_frames, self.chunk_size))
+        if len(starts) > 1 and n_frames - starts[-1] <= self.chunk_crossfade:
+            starts.pop()  # too short to be cross-faded, joins the previous chunk
+        for start, end in zip(starts, starts[1:] + [n_frames]):
+            first, last = max(0, start - context), min(n_frames, end + context)
+            chunk = self._generate(c[..., first:last]).view(-1)
+            # the samples of the chunk and of its cross-fade extensions
+            keep_start = max(0, start - self.chunk_crossfade) * self.upsample_factor
+            keep_end = min(n_frames, end + self.chunk_crossfade) * self.upsample_factor
+            chunk = chunk[keep_start - first * self.upsample_factor:keep_end - first * self.upsample_factor]
+            if start > 0:
+                chunk[:2 * fade] *= ramp
+            if end < n_frames:
+                chunk[-2 * fade:] *= ramp.flip(0)
+            wave[keep_start:keep_end] += chunk
+        return wave
 
     def remove_weight_norm(self):
         def _remove_weight_norm(m):
@@ -89,3 +171,38 @@ class HiFiGANGenerator(torch.nn.Module):
                 torch.nn.utils.weight_norm(m)
 
         self.apply(_apply_weight_norm)
+
+
+def benchmark_chunked_vocoding(path_to_weights, n_frames=2000, chunk_sizes=(None, 1000, 250), seed=0):
+    """Time, peak RSS increase and largest sample difference to the full pass
+    of vocoding a random spectrogram of n_frames frames with each chunk size
+    (None is the full pass). Each run is a fresh process on the CPU, so that
+    its peak RSS is the one of its own vocoding.
+    """
+    import torch.multiprocessing as mp
+
+    ctx = mp.get_context('spawn')
+    reference = None
+    for chunk_size in chunk_sizes:
+        with ctx.Pool(1) as pool:
+            elapsed, peak_increase, wave = pool.apply(_vocoding_run, (path_to_weights, n_frames, chunk_size, seed))
+        reference = wave if reference is None else reference
+        print(f'chunk size {chunk_size}: {elapsed:.2f} s, peak RSS +{peak_increase / 2 ** 20:.0f} MiB, '
+              f'max sample difference {(wave - reference).abs().max().item():.2e}')
+
+
+def _vocoding_run(path_to_weights, n_frames, chunk_size, seed):
+    import resource
+    import time
+
+    torch.manual_seed(seed)
+    generator = HiFiGANGenerator(path_to_weights=path_to_weights, chunk_size=chunk_size).eval()
+    c = torch.randn(generator.input_conv.in_channels, n_frames)
+    with torch.inference_mode():
+        generator(c[:, :20])  # warm-up
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        wave = generator(c)
+        elapsed = time.perf_counter() - start
+    # ru_maxrss is in KiB on Linux
+    return elapsed, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) * 1024, wave
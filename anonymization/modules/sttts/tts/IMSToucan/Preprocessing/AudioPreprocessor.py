@@ -6,7 +6,9 @@ import numpy
 import numpy as np
 import pyloudnorm as pyln
 import torch
-from torchaudio.transforms import Resample
+from functools import partial
+
+from utils import resample
 
 
 class AudioPreprocessor:
@@ -45,7 +47,8 @@ class AudioPreprocessor:
             # this to false globally during model loading rather than using inference mode or no_grad
             self.silero_model = self.silero_model.to(self.device)
         if output_sr is not None and output_sr != input_sr:
-            self.resample = Resample(orig_freq=input_sr, new_freq=output_sr).to(self.device)
+            # cached kernels shared by all preprocessors, same filter as torchaudio's Resample
+            self.resample = partial(resample, orig_sr=input_sr, target_sr=output_sr, method='sinc_hann')
             self.final_sr = output_sr
         else:
             self.resample = lambda x: x
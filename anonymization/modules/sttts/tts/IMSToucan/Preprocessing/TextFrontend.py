@@ -179,6 +179,21 @@ class ArticulatoryCombinedTextFrontend:
         self.phone_to_id = get_phone_to_id()
         self.id_to_phone = {v: k for k, v in self.phone_to_id.items()}
 
+        # lookup tables, so that the conversions are gathers instead of scans of the phone inventory
+        # row of each phone in phone_vectors and id of each row (-1 for the word boundary, which has no id)
+        self.phone_to_row = {phone: row for row, phone in enumerate(self.phone_to_vector)}
+        self.phone_vectors = torch.Tensor(list(self.phone_to_vector.values()))
+        self.phone_ids = torch.LongTensor([self.phone_to_id.get(phone, -1) for phone in self.phone_to_vector])
+        # id -> articulatory vector, zero for ids without a vector
+        self.id_to_vector = torch.zeros(len(self.phone_to_id), self.phone_vectors.shape[1])
+        self.id_to_vector[self.phone_ids[self.phone_ids >= 0]] = self.phone_vectors[self.phone_ids >= 0]
+        # hashed vector -> id: the phonological features of a vector (without the 13 modifiers) packed into an
+        # int64 key, the keys are sorted for torch.searchsorted
+        self._feature_weights = 2 ** torch.arange(self.phone_vectors.shape[1] - 13, dtype=torch.int64)
+        keys = self._vector_keys(self.phone_vectors[self.phone_ids >= 0])
+        self._sorted_keys, order = torch.sort(keys)
+        self._sorted_key_ids = self.phone_ids[self.phone_ids >= 0][order]
+
     def string_to_tensor(self, text, view=False, device="cpu", handle_missing=True, input_phonemes=False):
         """
         Fixes unicode errors, expands some abbreviations,
@@ -192,8 +207,9 @@ class ArticulatoryCombinedTextFrontend:
         phones = phones.replace("ɚ", "ə").replace("ᵻ", "ɨ")
         if view:
             print("Phonemes: \n{}\n".format(phones))
-        phones_vector = list()
-        # turn into numeric vectors
+        # rows of the phones in phone_vectors and (position, dimension) of the modifiers set on top of them
+        rows = list()
+        modifiers = list()
         stressed_flag = False
 
         for char in phones:
@@ -202,56 +218,44 @@ class ArticulatoryCombinedTextFrontend:
                 # primary stress
                 stressed_flag = True
             # affects previous phoneme -----------------
-            elif char == '\u02D0':
-                # lengthened
-                phones_vector[-1][10] = 1
-            elif char == '\u02D1':
-                # half length
-                phones_vector[-1][11] = 1
-            elif char == '\u0306':
-                # shortened
-                phones_vector[-1][12] = 1
-            elif char == "˥":
-                # very high tone
-                phones_vector[-1][1] = 1
-            elif char == "˦":
-                # high tone
-                phones_vector[-1][2] = 1
-            elif char == "˧":
-                # mid tone
-                phones_vector[-1][3] = 1
-            elif char == "˨":
-                # low tone
-                phones_vector[-1][4] = 1
-            elif char == "˩":
-                # very low tone
-                phones_vector[-1][5] = 1
-            elif char == "⭧":
-                # rising tone
-                phones_vector[-1][6] = 1
-            elif char == "⭨":
-                # falling tone
-                phones_vector[-1][7] = 1
-            elif char == "⮁":
-                # peaking tone
-                phones_vector[-1][8] = 1
-            elif char == "⮃":
-                # dipping tone
-                phones_vector[-1][9] = 1
+            elif char in MODIFIER_TO_INDEX:
+                if not rows:
+                    raise IndexError("modifier {} without a preceding phoneme".format(char))
+                modifiers.append((len(rows) - 1, MODIFIER_TO_INDEX[char]))
             else:
                 if handle_missing:
                     try:
-                        phones_vector.append(self.phone_to_vector[char].copy())
+                        rows.append(self.phone_to_row[char])
                     except KeyError:
                         print("unknown phoneme: {}".format(char))
                 else:
-                    phones_vector.append(self.phone_to_vector[char].copy())  # leave error handling to elsewhere
+                    rows.append(self.phone_to_row[char])  # leave error handling to elsewhere
 
                 if stressed_flag:
                     stressed_flag = False
-                    phones_vector[-1][0] = 1
+                    modifiers.append((len(rows) - 1, 0))
+
+        phones_vector = self.phone_vectors[rows]
+        if modifiers:
+            positions, dimensions = zip(*modifiers)
+            phones_vector[list(positions), list(dimensions)] = 1
+        return phones_vector.to(device)
+
+    def vectors_to_ids(self, vectors):
+        """
+        IDs of the phones of a sequence of articulatory vectors, as needed by the aligner.
+        Modifiers are ignored, word boundaries and vectors without a phone are skipped.
+        """
+        vectors = vectors.cpu()
+        # we don't include word boundaries when performing alignment, since they are not always present in audio.
+        vectors = vectors[vectors[:, 21] == 0]
+        keys = self._vector_keys(vectors)
+        positions = torch.searchsorted(self._sorted_keys, keys).clamp(max=len(self._sorted_keys) - 1)
+        found = self._sorted_keys[positions] == keys
+        return self._sorted_key_ids[positions[found]]
 
-        return torch.Tensor(phones_vector, device=device)
+    def _vector_keys(self, vectors):
+        return ((vectors[:, 13:] != 0).long() * self._feature_weights).sum(dim=1)
 
     def get_phone_string(self, text, include_eos_symbol=True, for_feature_extraction=False, for_plot_labels=False):
         # expand abbreviations
@@ -400,6 +404,64 @@ class ArticulatoryCombinedTextFrontend:
         return phones
 
 
+def benchmark_text_frontend(language="en", n_phones=(100, 1000, 10000), n_trials=5, seed=0):
+    """
+    Phones/sec of string_to_tensor() and of vectors_to_ids() compared to the
+    former scan of the phone inventory for every vector, on random phone
+    strings of n_phones phones. Checks that both lookups give the same ids.
+    """
+    import random
+    import time
+
+    tf = ArticulatoryCombinedTextFrontend(language=language)
+    rng = random.Random(seed)
+    inventory = [phone for phone in tf.phone_to_vector if phone not in "~# "]
+
+    def scan_to_ids(vectors):
+        tokens = list()
+        for vector in vectors:
+            if vector[21] == 0:
+                for phone in tf.phone_to_vector:
+                    if vector.numpy().tolist()[13:] == tf.phone_to_vector[phone][13:]:
+                        tokens.append(tf.phone_to_id[phone])
+                        break
+        return torch.LongTensor(tokens)
+
+    for n in n_phones:
+        phones = "~" + "".join(rng.choice(inventory) + rng.choice(["", "", " ", "ː", "˥"]) for _ in range(n)) + "~#"
+        start = time.perf_counter()
+        for _ in range(n_trials):
+            vectors = tf.string_to_tensor(phones, input_phonemes=True)
+        tensor_time = (time.perf_counter() - start) / n_trials
+        start = time.perf_counter()
+        reference = scan_to_ids(vectors)
+        scan_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(n_trials):
+            ids = tf.vectors_to_ids(vectors)
+        lookup_time = (time.perf_counter() - start) / n_trials
+        assert torch.equal(reference, ids), "ids differ from the former lookup"
+        print(f"{n} phones: string_to_tensor {n / tensor_time:.0f} phones/s, "
+              f"ids: scan {n / scan_time:.0f} phones/s, lookup {n / lookup_time:.0f} phones/s "
+              f"(x{scan_time / lookup_time:.0f})")
+
+
+MODIFIER_TO_INDEX = {
+    '\u02D0': 10,  # lengthened
+    '\u02D1': 11,  # half length
+    '\u0306': 12,  # shortened
+    "˥": 1,  # very high tone
+    "˦": 2,  # high tone
+    "˧": 3,  # mid tone
+    "˨": 4,  # low tone
+    "˩": 5,  # very low tone
+    "⭧": 6,  # rising tone
+    "⭨": 7,  # falling tone
+    "⮁": 8,  # peaking tone
+    "⮃": 9,  # dipping tone
+    }
+
+
 def english_text_expansion(text):
     """
     Apply as small part of the tacotron style text cleaning pipeline, suitable for e.g. LJSpeech.
@@ -97,16 +97,8 @@ class Aligner(torch.nn.Module):
     @torch.inference_mode()
     def inference(self, mel, tokens, save_img_for_debug=None, train=False, pathfinding="MAS", return_ctc=False):
         if not train:
-            tokens_indexed = list()  # first we need to convert the articulatory vectors to IDs, so we can apply dijkstra or viterbi
-            for vector in tokens:
-                if vector[21] == 0:  # we don't include word boundaries when performing alignment, since they are not always present in audio.
-                    for phone in self.tf.phone_to_vector:
-                        if vector.cpu().numpy().tolist()[13:] == self.tf.phone_to_vector[phone][13:]:
-                            # the first 12 dimensions are for modifiers, so we ignore those when trying to find the phoneme in the ID lookup
-                            tokens_indexed.append(self.tf.phone_to_id[phone])
-                            # this is terribly inefficient, but it's fine
-                            break
-            tokens = np.asarray(tokens_indexed)
+            # first we need to convert the articulatory vectors to IDs, so we can apply dijkstra or viterbi
+            tokens = self.tf.vectors_to_ids(tokens).numpy()
         else:
             tokens = tokens.cpu().detach().numpy()
 
@@ -117,18 +109,13 @@ class Aligner(torch.nn.Module):
         pred = pred.squeeze().cpu().detach().numpy()
         pred_max = pred[:, tokens]
         path_probs = 1. - pred_max
-        adj_matrix = to_adj_matrix(path_probs)
 
         if pathfinding == "MAS":
 
             alignment_matrix = binarize_alignment(pred_max)
 
             if save_img_for_debug is not None:
-                phones = list()
-                for index in tokens:
-                    for phone in self.tf.phone_to_id:
-                        if self.tf.phone_to_id[phone] == index:
-                            phones.append(phone)
+                phones = [self.tf.id_to_phone[index] for index in tokens]
                 fig, ax = plt.subplots(nrows=2, ncols=1, figsize=(10, 9))
 
                 ax[0].imshow(pred_max, interpolation='nearest', aspect='auto', origin="lower")
@@ -157,6 +144,7 @@ class Aligner(torch.nn.Module):
 
         elif pathfinding == "dijkstra":
 
+            adj_matrix = to_adj_matrix(path_probs)
             dist_matrix, predecessors, *_ = dijkstra(csgraph=adj_matrix,
                                                      directed=True,
                                                      indices=0,
@@ -184,11 +172,7 @@ class Aligner(torch.nn.Module):
 
             if save_img_for_debug is not None:
 
-                phones = list()
-                for index in tokens:
-                    for phone in self.tf.phone_to_id:
-                        if self.tf.phone_to_id[phone] == index:
-                            phones.append(phone)
+                phones = [self.tf.id_to_phone[index] for index in tokens]
                 fig, ax = plt.subplots(nrows=2, ncols=1, figsize=(10, 9))
 
                 ax[0].imshow(pred_max, interpolation='nearest', aspect='auto', origin="lower")
@@ -222,26 +206,25 @@ def binarize_alignment(alignment_prob):
     # https://github.com/NVIDIA/DeepLearningExamples/blob/master/PyTorch/SpeechSynthesis/FastPitch/fastpitch/alignment.py
     # https://github.com/NVIDIA/DeepLearningExamples/blob/master/PyTorch/SpeechSynthesis/FastPitch/fastpitch/attn_loss_function.py
 
-    Binarizes alignment with MAS.
+    Binarizes alignment with MAS. The DP only depends on the previous mel frame,
+    so every frame is computed at once over all text positions; the result is
+    identical to the cell by cell loop (see benchmark_alignment).
     """
     # assumes mel x text
     opt = np.zeros_like(alignment_prob)
     alignment_prob = alignment_prob + (np.abs(alignment_prob).max() + 1.0)  # make all numbers positive and add an offset to avoid log of 0 later
-    alignment_prob * alignment_prob * (1.0 / alignment_prob.max())  # normalize to (0,  1]
     attn_map = np.log(alignment_prob)
     attn_map[0, 1:] = -np.inf
     log_p = np.zeros_like(attn_map)
     log_p[0, :] = attn_map[0, :]
     prev_ind = np.zeros_like(attn_map, dtype=np.int64)
+    text_idx = np.arange(attn_map.shape[1])
     for i in range(1, attn_map.shape[0]):
-        for j in range(attn_map.shape[1]):  # for each text dim
-            prev_log = log_p[i - 1, j]
-            prev_j = j
-            if j - 1 >= 0 and log_p[i - 1, j - 1] >= log_p[i - 1, j]:
-                prev_log = log_p[i - 1, j - 1]
-                prev_j = j - 1
-            log_p[i, j] = attn_map[i, j] + prev_log
-            prev_ind[i, j] = prev_j
+        # coming from the previous text position wins ties
+        from_prev_j = np.zeros(attn_map.shape[1], dtype=bool)
+        from_prev_j[1:] = log_p[i - 1, :-1] >= log_p[i - 1, 1:]
+        prev_ind[i] = text_idx - from_prev_j
+        log_p[i] = attn_map[i] + log_p[i - 1, prev_ind[i]]
     # now backtrack
     curr_text_idx = attn_map.shape[1] - 1
     for i in range(attn_map.shape[0] - 1, -1, -1):
@@ -260,38 +243,108 @@ def from_node_index(node_index, cols):
 
 
 def to_adj_matrix(mat):
+    """
+    Graph of the (mel, text) cells for dijkstra: each cell has an edge to its
+    right, bottom and bottom right neighbour, weighted with the value of the
+    neighbour. The edges are listed in the order of a row-major scan of the
+    cells, as in the former loop, so the CSR matrix is the same.
+    """
     rows = mat.shape[0]
     cols = mat.shape[1]
 
+    i, j = np.meshgrid(np.arange(rows), np.arange(cols), indexing='ij')
+    node = to_node_index(i, j, cols)
+    # (rows, cols, 3): right, bottom and bottom right edge of each cell
+    row_ind = np.stack([node, node, node], axis=-1)
+    col_ind = np.stack([node + 1, node + cols, node + cols + 1], axis=-1)
+    valid = np.stack([j < cols - 1, i < rows - 1, (i < rows - 1) & (j < cols - 1)], axis=-1)
+    data = mat.reshape(-1)[np.where(valid, col_ind, 0)]
+
+    adj_mat = coo_matrix((data[valid], (row_ind[valid], col_ind[valid])), shape=(rows * cols, rows * cols))
+    return adj_mat.tocsr()
+
+
+def _binarize_alignment_loop(alignment_prob):
+    # former cell by cell MAS, reference for benchmark_alignment
+    opt = np.zeros_like(alignment_prob)
+    alignment_prob = alignment_prob + (np.abs(alignment_prob).max() + 1.0)
+    attn_map = np.log(alignment_prob)
+    attn_map[0, 1:] = -np.inf
+    log_p = np.zeros_like(attn_map)
+    log_p[0, :] = attn_map[0, :]
+    prev_ind = np.zeros_like(attn_map, dtype=np.int64)
+    for i in range(1, attn_map.shape[0]):
+        for j in range(attn_map.shape[1]):
+            prev_log = log_p[i - 1, j]
+            prev_j = j
+            if j - 1 >= 0 and log_p[i - 1, j - 1] >= log_p[i - 1, j]:
+                prev_log = log_p[i - 1, j - 1]
+                prev_j = j - 1
+            log_p[i, j] = attn_map[i, j] + prev_log
+            prev_ind[i, j] = prev_j
+    curr_text_idx = attn_map.shape[1] - 1
+    for i in range(attn_map.shape[0] - 1, -1, -1):
+        opt[i, curr_text_idx] = 1
+        curr_text_idx = prev_ind[i, curr_text_idx]
+    opt[0, curr_text_idx] = 1
+    return opt
+
+
+def _to_adj_matrix_loop(mat):
+    # former cell by cell graph construction, reference for benchmark_alignment
+    rows = mat.shape[0]
+    cols = mat.shape[1]
     row_ind = []
     col_ind = []
     data = []
-
     for i in range(rows):
         for j in range(cols):
-
             node = to_node_index(i, j, cols)
-
             if j < cols - 1:
-                right_node = to_node_index(i, j + 1, cols)
-                weight_right = mat[i, j + 1]
                 row_ind.append(node)
-                col_ind.append(right_node)
-                data.append(weight_right)
-
-            if i < rows - 1 and j < cols:
-                bottom_node = to_node_index(i + 1, j, cols)
-                weight_bottom = mat[i + 1, j]
+                col_ind.append(to_node_index(i, j + 1, cols))
+                data.append(mat[i, j + 1])
+            if i < rows - 1:
                 row_ind.append(node)
-                col_ind.append(bottom_node)
-                data.append(weight_bottom)
-
+                col_ind.append(to_node_index(i + 1, j, cols))
+                data.append(mat[i + 1, j])
             if i < rows - 1 and j < cols - 1:
-                bottom_right_node = to_node_index(i + 1, j + 1, cols)
-                weight_bottom_right = mat[i + 1, j + 1]
                 row_ind.append(node)
-                col_ind.append(bottom_right_node)
-                data.append(weight_bottom_right)
-
+                col_ind.append(to_node_index(i + 1, j + 1, cols))
+                data.append(mat[i + 1, j + 1])
     adj_mat = coo_matrix((data, (row_ind, col_ind)), shape=(rows * cols, rows * cols))
     return adj_mat.tocsr()
+
+
+def benchmark_alignment(n_frames=625, n_tokens=100, n_trials=5, seed=0):
+    """Speed-up of binarize_alignment() and to_adj_matrix() over the former
+    loops on random aligner outputs, by default of the size of a 10 second
+    utterance (16kHz, hop length 256). Checks that the MAS paths, the graphs
+    and the dijkstra distances are identical.
+    """
+    import time
+
+    rng = np.random.default_rng(seed)
+    timings = {'binarize_alignment': [0., 0.], 'to_adj_matrix': [0., 0.]}
+
+    def timed(name, k, fn, arg):
+        start = time.perf_counter()
+        result = fn(arg)
+        timings[name][k] += time.perf_counter() - start
+        return result
+
+    for _ in range(n_trials):
+        pred_max = rng.random((n_frames, n_tokens), dtype=np.float32)
+        path = timed('binarize_alignment', 0, _binarize_alignment_loop, pred_max)
+        assert np.array_equal(path, timed('binarize_alignment', 1, binarize_alignment, pred_max)), 'MAS paths differ'
+
+        path_probs = 1. - pred_max
+        graph = timed('to_adj_matrix', 0, _to_adj_matrix_loop, path_probs)
+        new_graph = timed('to_adj_matrix', 1, to_adj_matrix, path_probs)
+        assert (graph != new_graph).nnz == 0 and np.array_equal(graph.indices, new_graph.indices), 'graphs differ'
+        assert np.array_equal(dijkstra(csgraph=graph, directed=True, indices=0),
+                              dijkstra(csgraph=new_graph, directed=True, indices=0)), 'dijkstra distances differ'
+
+    for name, (loop, vectorized) in timings.items():
+        print(f'{name} ({n_frames} x {n_tokens}): loop {1000 * loop / n_trials:.1f} ms, '
+              f'vectorized {1000 * vectorized / n_trials:.1f} ms, speed-up x{loop / vectorized:.1f}')
@@ -13,7 +13,6 @@ from tqdm import tqdm
 
 from ....Preprocessing.AudioPreprocessor import AudioPreprocessor
 from ....Preprocessing.TextFrontend import ArticulatoryCombinedTextFrontend
-from ....Preprocessing.articulatory_features import get_feature_to_index_lookup
 
 
 class AlignerDataset(Dataset):
@@ -168,17 +167,7 @@ class AlignerDataset(Dataset):
 
     def __getitem__(self, index):
         text_vector = self.datapoints[index][0]
-        tokens = list()
-        for vector in text_vector:
-            if vector[get_feature_to_index_lookup()[
-                "word-boundary"]] == 0:  # we don't include word boundaries when performing alignment, since they are not always present in audio.
-                for phone in self.tf.phone_to_vector:
-                    if vector.numpy().tolist()[13:] == self.tf.phone_to_vector[phone][13:]:
-                        # the first 12 dimensions are for modifiers, so we ignore those when trying to find the phoneme in the ID lookup
-                        tokens.append(self.tf.phone_to_id[phone])
-                        # this is terribly inefficient, but it's fine
-                        break
-        tokens = torch.LongTensor(tokens)
+        tokens = self.tf.vectors_to_ids(text_vector)
         return tokens, \
                torch.LongTensor([len(tokens)]), \
                self.datapoints[index][2], \
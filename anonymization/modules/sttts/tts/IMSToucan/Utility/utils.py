@@ -4,6 +4,7 @@ Taken from ESPNet, modified by Florian Lux
 
 import os
 from abc import ABC
+from contextlib import contextmanager
 import logging
 import torch
 
@@ -172,6 +173,55 @@ def pad_list(xs, pad_value):
     return pad
 
 
+@contextmanager
+def masked_padding(module, lengths):
+    """
+    Makes the convolutions and group norms of module ignore the padded part of batches.
+
+    Within the context, the input of every Conv1d and ConvTranspose1d with a kernel wider than one is
+    zeroed after the lengths of the batch, and GroupNorm statistics are computed on the non-padded part
+    only. The outputs for the non-padded part then match those of the unpadded sequences, as for those
+    the convolutions pad with zeros. Inputs may be longer than max(lengths) by an integer factor
+    (upsampling), the lengths are scaled accordingly.
+
+    Args:
+        module (torch.nn.Module): Module whose submodules are masked.
+        lengths (LongTensor): Lengths of the sequences of the batch (B,), in the time resolution of the input.
+    """
+    max_len = int(lengths.max())
+
+    def non_pad_mask(x):
+        scaled_lengths = lengths.to(x.device) * (x.shape[-1] // max_len)
+        return (torch.arange(x.shape[-1], device=x.device)[None, :] < scaled_lengths[:, None]).unsqueeze(1)
+
+    def mask_input(conv, inputs):
+        return (inputs[0] * non_pad_mask(inputs[0]),) + tuple(inputs[1:])
+
+    def masked_group_norm(norm, inputs, output):
+        x = inputs[0]
+        mask = non_pad_mask(x).unsqueeze(1)  # (B, 1, 1, T)
+        groups = x.view(x.shape[0], norm.num_groups, -1, x.shape[-1])
+        count = mask.sum(dim=(2, 3), keepdim=True) * groups.shape[2]
+        mean = (groups * mask).sum(dim=(2, 3), keepdim=True) / count
+        var = (((groups - mean) * mask) ** 2).sum(dim=(2, 3), keepdim=True) / count
+        x = ((groups - mean) / torch.sqrt(var + norm.eps)).view_as(x)
+        if norm.affine:
+            x = x * norm.weight[None, :, None] + norm.bias[None, :, None]
+        return x
+
+    handles = list()
+    for submodule in module.modules():
+        if isinstance(submodule, (torch.nn.Conv1d, torch.nn.ConvTranspose1d)) and submodule.kernel_size[0] > 1:
+            handles.append(submodule.register_forward_pre_hook(mask_input))
+        elif isinstance(submodule, torch.nn.GroupNorm):
+            handles.append(submodule.register_forward_hook(masked_group_norm))
+    try:
+        yield
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
 def subsequent_mask(size, device="cpu", dtype=torch.bool):
     """
     Create mask for subsequent steps (size, size).
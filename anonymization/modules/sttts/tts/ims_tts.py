@@ -1,46 +1,96 @@
+import math
+
 import torch
-import resampy
 
 from .IMSToucan.InferenceInterfaces.AnonFastSpeech2 import AnonFastSpeech2
-from utils import setup_logger
+from utils import setup_logger, resample
 
 logger = setup_logger(__name__)
 
+PROSODY_KEYS = ('duration', 'pitch', 'energy')
+MIN_SAMPLES = 24000  # 0.5 s at 48 kHz, shorter outputs are practically empty
+
 class ImsTTS:
 
-    def __init__(self, hifigan_path, fastspeech_path, device, embedding_path=None, output_sr=16000, lang='en'):
+    def __init__(self, hifigan_path, fastspeech_path, device, embedding_path=None, output_sr=16000, lang='en',
+                 vocoder_chunk_size=None):
         self.device = device
         self.output_sr = output_sr
 
         self.model = AnonFastSpeech2(device=self.device, path_to_hifigan_model=hifigan_path,
                                      path_to_fastspeech_model=fastspeech_path, path_to_embed_model=embedding_path,
-                                     language=lang)
+                                     language=lang, vocoder_chunk_size=vocoder_chunk_size)
+        # spectrograms too short for MIN_SAMPLES get stretched durations before vocoding
+        self.min_frames = math.ceil(MIN_SAMPLES / self.model.mel2wav.upsample_factor)
 
     def read_text(self, text, speaker_embedding, text_is_phones=True, duration=None, pitch=None, energy=None,
-                  start_silence=None, end_silence=None):
-
+                  start_silence=None, end_silence=None, return_num_corrections=False):
+        """
+        Synthesizes text with the speaker embedding and, if given, the prosody. If the predicted or given durations
+        are too short for a wav of MIN_SAMPLES samples, they are stretched once (see AnonFastSpeech2.forward), the
+        number of such corrections (0 or 1) is returned with the wav if return_num_corrections.
+        """
         speaker_embedding = speaker_embedding.to(self.device)
         self.model.default_utterance_embedding = speaker_embedding
-        wav = self.model(text=text, text_is_phonemes=text_is_phones, durations=duration, pitch=pitch, energy=energy)
-
-        # TODO: this is not an ideal solution, but must work for now
-        i = 0
-        while wav.shape[0] < 24000:  # 0.5 s
-            # sometimes, the speaker embedding is so off that it leads to a practically empty audio
-            # then, we need to sample a new embedding
-            if i > 0 and i % 10 == 0:
-                mask = torch.zeros(speaker_embedding.shape[0]).float().random_(-40, 40).to(self.device)
-            else:
-                mask = torch.zeros(speaker_embedding.shape[0]).float().random_(-2, 2).to(self.device)
-            speaker_embedding = speaker_embedding * mask
-            self.model.default_utterance_embedding = speaker_embedding.to(self.device)
-            wav = self.model(text=text, text_is_phonemes=text_is_phones, durations=duration, pitch=pitch, energy=energy)
-            i += 1
-            if i > 30:
-                break
-        if i > 0:
-            logger.info(f'Synthesized utt in {i} takes')
+        wav, num_corrections = self.model(text=text, text_is_phonemes=text_is_phones, durations=duration,
+                                          pitch=pitch, energy=energy, min_frames=self.min_frames,
+                                          return_num_corrections=True)
+        wav = self._add_silence_and_resample(wav, start_silence, end_silence)
+        if return_num_corrections:
+            return wav, num_corrections
+        return wav
+
+    def read_texts(self, texts, speaker_embeddings, text_is_phones=True, prosody=None, batch_size=8,
+                   return_num_corrections=False):
+        """
+        read_text() for a list of texts, synthesized in batches of batch_size texts with similar numbers of
+        phones. The padding is masked, so each wav is the one read_text() returns for the single text.
+
+        Args:
+            texts: list of texts
+            speaker_embeddings: list of the speaker embedding of each text
+            prosody: list of the read_text() keyword arguments of each text (duration, pitch, energy,
+                start_silence, end_silence), optional
+        Returns:
+            list of the wavs, in the order of texts (and list of their numbers of corrections)
+        """
+        prosody = prosody if prosody is not None else [{} for _ in texts]
+        # the durations give the number of phones, the text length is a proxy when they are predicted
+        order = sorted(range(len(texts)), key=lambda i: len(prosody[i]['duration']) if prosody[i].get('duration')
+                       is not None else len(texts[i]))
+        wavs = [None] * len(texts)
+        num_corrections = [0] * len(texts)
+
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            given = [tuple(prosody[i].get(key) is not None for key in PROSODY_KEYS) for i in batch]
+            if len(set(given)) > 1:
+                # prosody given for some texts only, cannot be padded together
+                for i in batch:
+                    wavs[i], num_corrections[i] = self.read_text(texts[i], speaker_embeddings[i], text_is_phones,
+                                                                 return_num_corrections=True, **prosody[i])
+                continue
 
+            batch_prosody = {key: [prosody[i][key] for i in batch] if is_given else None
+                             for key, is_given in zip(PROSODY_KEYS, given[0])}
+            batch_embeddings = torch.stack([speaker_embeddings[i].to(self.device) for i in batch])
+            batch_wavs, batch_corrections = self.model.batch_forward(texts=[texts[i] for i in batch],
+                                                                     utterance_embeddings=batch_embeddings,
+                                                                     durations=batch_prosody['duration'],
+                                                                     pitch=batch_prosody['pitch'],
+                                                                     energy=batch_prosody['energy'],
+                                                                     text_is_phonemes=text_is_phones,
+                                                                     min_frames=self.min_frames,
+                                                                     return_num_corrections=True)
+            for i, wav, corrections in zip(batch, batch_wavs, batch_corrections):
+                wavs[i] = self._add_silence_and_resample(wav, prosody[i].get('start_silence'),
+                                                         prosody[i].get('end_silence'))
+                num_corrections[i] = corrections
+        if return_num_corrections:
+            return wavs, num_corrections
+        return wavs
+
+    def _add_silence_and_resample(self, wav, start_silence, end_silence):
         # start and end silence are computed for 16000, so we have to adapt this to different output sr
         factor = self.output_sr // 16000
         if start_silence is not None:
@@ -50,9 +100,39 @@ class ImsTTS:
             end_sil = torch.zeros([end_silence * factor]).to(self.device)
             wav = torch.cat((wav, end_sil), dim=0)
 
-        if self.output_sr != 48000:
-            wav = resampy.resample(wav.cpu().numpy(), 48000, self.output_sr)
-        else:
-            wav = wav.cpu().numpy()
+        return resample(wav, 48000, self.output_sr).cpu().numpy()
 
-        return wav
+
+def benchmark_tts(hifigan_path, fastspeech_path, embedding_path, device='cpu', n_utts=16, batch_sizes=(1, 4, 8),
+                  n_phones=(20, 120), seed=0):
+    """Utterances/sec and real-time factor of read_text() and of read_texts()
+    for each batch size, on n_utts random phone strings of n_phones phones
+    and random speaker embeddings, with predicted prosody. Reports the
+    largest sample difference of the batched wavs to the read_text() ones.
+    """
+    import random
+    import time
+
+    tts = ImsTTS(hifigan_path=hifigan_path, fastspeech_path=fastspeech_path, embedding_path=embedding_path,
+                 device=device, output_sr=48000)
+    rng = random.Random(seed)
+    torch.manual_seed(seed)
+    inventory = [phone for phone in tts.model.text2phone.phone_to_id if phone in tts.model.text2phone.phone_to_vector
+                 and phone not in '~#?!.']
+    texts = ['~' + ''.join(rng.choice(inventory) for _ in range(rng.randint(*n_phones))) + '~#' for _ in range(n_utts)]
+    embeddings = [tts.model.default_utterance_embedding * (1 + 0.1 * torch.randn_like(
+        tts.model.default_utterance_embedding)) for _ in range(n_utts)]
+
+    start = time.perf_counter()
+    reference = [tts.read_text(text, embedding) for text, embedding in zip(texts, embeddings)]
+    elapsed = time.perf_counter() - start
+    audio_seconds = sum(len(wav) for wav in reference) / tts.output_sr
+    print(f'read_text: {n_utts / elapsed:.2f} utt/s, RTF {elapsed / audio_seconds:.3f}')
+
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        wavs = tts.read_texts(texts, embeddings, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        max_diff = max(abs(a - b).max() if len(a) == len(b) else float('inf') for a, b in zip(reference, wavs))
+        print(f'read_texts x{batch_size}: {n_utts / elapsed:.2f} utt/s, RTF {elapsed / audio_seconds:.3f}, '
+              f'max sample difference {max_diff:.2e}')
@@ -1,11 +1,11 @@
 from tqdm import tqdm
-import soundfile
 import time
 from torch.multiprocessing import Pool, set_start_method
 from itertools import repeat
 
 from .ims_tts import ImsTTS
-from utils import create_clean_dir, setup_logger
+from utils import create_clean_dir, setup_logger, get_audio_sink, scan_audio_sink, load_wav_from_scp, \
+    read_kaldi_format, save_kaldi_format
 
 set_start_method('spawn', force=True)
 logger = setup_logger(__name__)
@@ -15,6 +15,11 @@ class SpeechSynthesis:
     def __init__(self, devices, settings, model_dir=None, results_dir=None, save_output=True, force_compute=False):
         self.devices = devices
         self.output_sr = settings.get('output_sr', 16000)
+        self.output_format = settings.get('output_format', 'wav')
+        # > 1 synthesizes batches of utterances with similar numbers of phones at once
+        self.batch_size = settings.get('batch_size', 1)
+        # spectrogram frames vocoded at once, bounds the memory for long utterances (None: whole utterances)
+        self.vocoder_chunk_size = settings.get('vocoder_chunk_size', None)
         self.save_output = save_output
         self.force_compute = force_compute if force_compute else settings.get('force_compute_synthesis', False)
 
@@ -28,7 +33,8 @@ class SpeechSynthesis:
             for device in self.devices:
                 self.tts_models.append(ImsTTS(hifigan_path=hifigan_path, fastspeech_path=fastspeech_path,
                                               embedding_path=embedding_path, device=device,
-                                              output_sr=self.output_sr, lang=settings.get('lang', 'en')))
+                                              output_sr=self.output_sr, lang=settings.get('lang', 'en'),
+                                              vocoder_chunk_size=self.vocoder_chunk_size))
 
         if results_dir:
             self.results_dir = results_dir
@@ -45,11 +51,13 @@ class SpeechSynthesis:
         # saved wavs (wav.scp) or the wavs themselves
         dataset_results_dir = self.results_dir / dataset_name if self.save_output else ''
         wavs = {}
+        num_corrections = {}
 
         if dataset_results_dir.exists() and not self.force_compute:
-            already_synthesized_utts = {wav_file.stem: str(wav_file.absolute())
-                                        for wav_file in dataset_results_dir.glob('*.wav')
-                                        if wav_file.stem in texts.utterances}
+            already_synthesized_utts = {utt: scp_value
+                                        for utt, scp_value in scan_audio_sink(self.output_format,
+                                                                              dataset_results_dir).items()
+                                        if utt in texts.utterances}
 
             if len(already_synthesized_utts):
                 logger.info(f'No synthesis necessary for {len(already_synthesized_utts)} of {len(texts)} utterances...')
@@ -58,9 +66,9 @@ class SpeechSynthesis:
                     wavs = already_synthesized_utts
                 else:
                     wavs = {}
-                    for utt, wav_file in already_synthesized_utts.items():
-                        wav, _ = soundfile.read(wav_file)
-                        wavs[utt] = wav
+                    for utt, scp_value in already_synthesized_utts.items():
+                        wav, _ = load_wav_from_scp(scp_value)
+                        wavs[utt] = wav.squeeze(0).numpy()
 
         if texts:
             logger.info(f'Synthesize {len(texts)} utterances...')
@@ -86,9 +94,13 @@ class SpeechSynthesis:
                     except KeyError:
                         logger.warn(f'Key error at {utt}')
                         continue
-                wavs.update(synthesis_job(instances=instances, tts_model=self.tts_models[0],
-                                          out_dir=dataset_results_dir, sleep=0, text_is_phones=text_is_phones,
-                                          save_output=self.save_output))
+                new_wavs, num_corrections = synthesis_job(instances=instances, tts_model=self.tts_models[0],
+                                                          out_dir=dataset_results_dir, sleep=0,
+                                                          text_is_phones=text_is_phones,
+                                                          save_output=self.save_output,
+                                                          output_format=self.output_format,
+                                                          batch_size=self.batch_size)
+                wavs.update(new_wavs)
 
             else:
                 num_processes = len(self.tts_models)
@@ -118,28 +130,70 @@ class SpeechSynthesis:
                 # multiprocessing
                 with Pool(processes=num_processes) as pool:
                     job_params = zip(instances, self.tts_models, repeat(dataset_results_dir), sleeps,
-                                     repeat(text_is_phones), repeat(self.save_output))
-                    new_wavs = pool.starmap(tqdm(synthesis_job), job_params)
+                                     repeat(text_is_phones), repeat(self.save_output), repeat(self.output_format),
+                                     [f'synthesis{i}' for i in range(num_processes)], repeat(self.batch_size))
+                    job_results = pool.starmap(tqdm(synthesis_job), job_params)
 
-                for new_wav_dict in new_wavs:
+                for new_wav_dict, job_corrections in job_results:
                     wavs.update(new_wav_dict)
-        return wavs
+                    num_corrections.update(job_corrections)
 
+            self._report_corrections(num_corrections, dataset_results_dir)
+        return wavs
 
-def synthesis_job(instances, tts_model, out_dir, sleep, text_is_phones=False, save_output=False):
+    def _report_corrections(self, num_corrections, dataset_results_dir):
+        # number of duration corrections of each utterance (see ImsTTS.read_text), kept next to the wavs so that
+        # the extra synthesis cost of a dataset is visible
+        corrected = sum(1 for n in num_corrections.values() if n > 0)
+        if corrected:
+            logger.info(f'Stretched too short durations of {corrected} of {len(num_corrections)} utterances')
+        if self.save_output:
+            corrections_file = dataset_results_dir / 'duration_corrections'
+            if corrections_file.exists() and not self.force_compute:
+                num_corrections = {**read_kaldi_format(corrections_file), **num_corrections}
+            save_kaldi_format(num_corrections, corrections_file)
+
+
+def synthesis_job(instances, tts_model, out_dir, sleep, text_is_phones=False, save_output=False,
+                  output_format='wav', sink_name='synthesis0', batch_size=1):
     time.sleep(sleep)
 
+    # parallel jobs use different sink names so that they never append to the same shard
+    sink = get_audio_sink(output_format, out_dir, name=sink_name) if save_output else None
     wavs = {}
-    for text, utt, speaker_embedding, utt_prosody_dict in tqdm(instances):
-        wav = tts_model.read_text(text=text, speaker_embedding=speaker_embedding, text_is_phones=text_is_phones,
-                                  **utt_prosody_dict)
-
-        if save_output:
-            out_file = str((out_dir / f'{utt}.wav').absolute())
-            soundfile.write(file=out_file, data=wav, samplerate=tts_model.output_sr)
-            wavs[utt] = out_file
-        else:
-            wavs[utt] = wav
-    return wavs
+    num_corrections = {}
+    if batch_size > 1:
+        # windows of utterances, sorted by length in read_texts and synthesized in batches of batch_size
+        window_size = 8 * batch_size
+        windows = (instances[i:i + window_size] for i in range(0, len(instances), window_size))
+        results = (zip([utt for _, utt, _, _ in window],
+                       *tts_model.read_texts(texts=[text for text, _, _, _ in window],
+                                             speaker_embeddings=[emb for _, _, emb, _ in window],
+                                             text_is_phones=text_is_phones,
+                                             prosody=[utt_prosody_dict for _, _, _, utt_prosody_dict in window],
+                                             batch_size=batch_size, return_num_corrections=True))
+                   for window in windows)
+    else:
+        results = ([(utt, *tts_model.read_text(text=text, speaker_embedding=speaker_embedding,
+                                               text_is_phones=text_is_phones, return_num_corrections=True,
+                                               **utt_prosody_dict))]
+                   for text, utt, speaker_embedding, utt_prosody_dict in instances)
+
+    try:
+        with tqdm(total=len(instances)) as progress:
+            for window_wavs in results:
+                window_wavs = list(window_wavs)
+                for utt, wav, utt_corrections in window_wavs:
+                    if save_output:
+                        wavs[utt], _ = sink.write(utt, wav, tts_model.output_sr)
+                    else:
+                        wavs[utt] = wav
+                    num_corrections[utt] = utt_corrections
+                progress.update(len(window_wavs))
+    finally:
+        # also on errors, so that the utterances written so far stay in the shard index
+        if sink:
+            sink.close()
+    return wavs, num_corrections
 
 
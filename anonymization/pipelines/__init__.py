@@ -1,2 +1,2 @@
 from .pipeline import Pipeline
-from .utils import get_anon_level_from_config
+from .utils import get_anon_level_from_config, run_stage_graph
@@ -24,10 +24,12 @@ class McAdamsPipeline(Pipeline):
             config (dict): a configuration dictionary, e.g., see anon_*.yaml
             force_compute (bool): if True, forces re-computation of
                 all steps. otherwise uses saved results.
-            devices (list): a list of torch-interpretable devices
+            devices (list): a list of torch-interpretable devices, the first
+                one is used by the torch backend (modules.backend: torch)
         """
         self.config = config
         self.force_compute = force_compute
+        self.devices = devices
         self.modules_config = config['modules']
 
     def run_anonymization_pipeline(self, datasets):
@@ -40,4 +42,5 @@ class McAdamsPipeline(Pipeline):
                          results_dir=self.config['results_dir'],
                          settings=self.modules_config,
                          force_compute=self.force_compute,
+                         device=self.devices[0],
                          )
@@ -4,6 +4,8 @@ import os
 import random
 import json
 
+from utils import parse_scp_pipe
+
 
 class SCPPathDataset(Dataset):
     def __init__(
@@ -18,7 +20,8 @@ class SCPPathDataset(Dataset):
         """
         Literally just takes a Kaldi-format scp file (damn you Kaldi!) and returns utterance ids and paths.
         Optionally returns basename. Optionally appends root to the path.
-        Don't use this with scp files that have fancy piping, it will not work.
+        Piped entries are only supported for the plain `flac -c -d -s <file> |` / `sox <file> ... |` decoding
+        commands (see utils.parse_scp_pipe), whose input file is used.
 
         @param scp_file: path to scp file
         @param ds_type: Either 'libri' or 'vctk'.
@@ -47,12 +50,10 @@ class SCPPathDataset(Dataset):
         self.data = []
         for line in scp_lines:
             # utt_id, path = line.strip().split()
-            parsed_line = line.strip().split()
-            if len(parsed_line) == 2:
-                utt_id, path = parsed_line
-            else:
-                #this is the case of train-360
-                utt_id, _, _, _, _, path, _ = parsed_line
+            utt_id, entry = line.strip().split(maxsplit=1)
+            pipe = parse_scp_pipe(entry)
+            #this is the case of train-360
+            path = pipe['path'] if pipe else entry
             basename = os.path.basename(path)
             if root:
                 path = os.path.join(root, path)
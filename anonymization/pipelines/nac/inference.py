@@ -2,16 +2,16 @@ import torch
 from torch.utils.data import DataLoader
 from accelerate import PartialState
 
-import soundfile as sf
-import librosa
 import os
 import sys
 # relative paths don't seem to work in Accelerate and i have no idea how else to solve this, lord forgive me
 sys.path.append(os.path.join(os.getcwd(), 'anonymization/modules/nac'))
+sys.path.append(os.getcwd())
 from argparse import ArgumentParser
 
 from anonymizer import Anonymizer
 from data import SCPPathDataset
+from utils import get_audio_sink, resample
 
 parser = ArgumentParser(description="Perform inference with the anonymizer.")
 parser.add_argument('scp_path', help='A Kaldi-like .scp file that contains the utterances to anonymize.')
@@ -26,6 +26,7 @@ parser.add_argument('--speaker_level', default=False, action='store_true',
                     help='Whether to use speaker-level anon or utterance-level anon. Ignored if mapping_file is given.')
 parser.add_argument('--ds_type', help="Either 'libri' or 'vctk'. Defaults to the former.", default='libri')
 parser.add_argument('--target_rate', type=int, help="Resample output audio to this sampling rate. If not given, does not resample", default=None)
+parser.add_argument('--output_format', help="Output format: 'wav', 'flac', 'shard' or 'shard_flac'. Defaults to the former.", default='wav')
 args = parser.parse_args()
 
 
@@ -80,6 +81,9 @@ dl = DataLoader(
 )
 len_dl = len(dl)
 
+# each process writes its own shard when writing shards
+sink = get_audio_sink(args.output_format, args.output_folder, name=f'process{distributed_state.process_index}')
+
 print(f'({device}) Starting inference')
 for i, batch in enumerate(dl, 1):
     with distributed_state.split_between_processes(batch) as single_item:
@@ -93,14 +97,14 @@ for i, batch in enumerate(dl, 1):
             with torch.no_grad():
                 anon_wav = anonymizer(path, target_voice_id=proxy_speaker)
 
-            # we save the output in wav regardless of what the input format was
+            # we save the output in args.output_format regardless of what the input format was
             basename_file, _ = os.path.splitext(basename)
-            new_basename = f'{basename_file}.wav'
-            out_path = os.path.join(args.output_folder, new_basename)
             if args.target_rate is None:
-                sf.write(out_path, anon_wav, samplerate=anonymizer.sample_rate)
+                sink.write(basename_file, anon_wav, anonymizer.sample_rate)
             else:
-                anon_wav = librosa.resample(anon_wav, orig_sr=anonymizer.sample_rate, target_sr=args.target_rate)
-                sf.write(out_path, anon_wav, samplerate=args.target_rate)
+                anon_wav = resample(anon_wav, orig_sr=anonymizer.sample_rate, target_sr=args.target_rate)
+                sink.write(basename_file, anon_wav, args.target_rate)
         else:
             print(f'[{i}/{len_dl}] {device}\t| Received item {single_item}, this is probably the last batch. Skipping.')
+
+sink.close()
@@ -1,11 +1,9 @@
 from ...pipelines.pipeline import  Pipeline
 from ...modules.nac.anonymizer import Anonymizer as NACanonymizer
 from .data import SCPPathDataset
-from utils import setup_logger
+from utils import setup_logger, get_audio_sink, resample
 
 import os
-import soundfile as sf
-from librosa import resample
 
 logger = setup_logger(__name__)
 
@@ -62,6 +60,8 @@ class NACPipeline(Pipeline):
             # could be sped up by using multiple jobs or sharing across gpus
             # this implementation is more basic, see original repo to run across multiple gpus with Accelerate
             tot_files = len(scp_dataset)
+            wav_scp = {}
+            sink = get_audio_sink(self.config.get('output_format', 'wav'), ds_out_folder)
             for i, (utt_id, file_path, basename, proxy_speaker) in enumerate(scp_dataset, start=1):
                 logger.info(f'[{i}/{tot_files}] Anonymizing {utt_id}\t| proxy spk {proxy_speaker}')
 
@@ -69,8 +69,14 @@ class NACPipeline(Pipeline):
                 # encodec operates at 24k, needs resampling
                 anon_wav_16k = resample(anon_wav, orig_sr=self.anonymizer.model.config.sample_rate, target_sr=16000)
 
-                out_path = os.path.join(ds_out_folder, basename)
-                logger.info(f'Saving to {out_path}')
-                sf.write(out_path, anon_wav_16k, samplerate=16000)
+                basename_file, _ = os.path.splitext(basename)
+                wav_scp[utt_id], _ = sink.write(basename_file, anon_wav_16k, 16000)
+                logger.info(f'Saved to {wav_scp[utt_id]}')
+            sink.close()
 
+            # wav.scp goes to the anonymized data dir, like with the accelerate pipeline, the audio stays in results_dir
+            ds_data_dir = os.path.join(self.config['data_dir'], f"{dataset_name}{self.config['anon_suffix']}")
+            os.makedirs(ds_data_dir, exist_ok=True)
+            with open(os.path.join(ds_data_dir, 'wav.scp'), 'w', encoding='utf-8') as f:
+                f.writelines(f'{utt_id} {scp_value}\n' for utt_id, scp_value in wav_scp.items())
             logger.info('Done.')
@@ -1,6 +1,7 @@
 from ...pipelines.pipeline import Pipeline
 from ...modules.nac.anonymizer import Anonymizer as NACAnonymizer
-from utils import setup_logger
+from .data import SCPPathDataset
+from utils import setup_logger, scan_audio_sink
 import subprocess
 
 import os
@@ -33,6 +34,7 @@ class NACPipeline(Pipeline):
         voice_dir = self.config['modules']['model']['voice_dir']  # only one voice dir for now
         results_dir = self.config['data_dir']
         anon_suffix = self.config['anon_suffix']
+        output_format = self.config.get('output_format', 'wav')
 
         # create result folder if needed
         if not os.path.isdir(results_dir):
@@ -58,11 +60,18 @@ class NACPipeline(Pipeline):
                 '--data_root', root,
                 '--voice_dir', str(voice_dir),
                 '--ds_type', ds_type,
-                '--target_rate', '16000'
+                '--target_rate', '16000',
+                '--output_format', output_format
             ]
             if len(self.devices) > 1:
                 args_to_run.append(f'--gpu_ids=' + ','.join([str(dv.index) for dv in self.devices]))
 
             if subprocess.run(args_to_run).returncode != 0:
                 exit(1)
+
+            # outputs are named after the input basenames, map them back to the utterance ids
+            written = scan_audio_sink(output_format, ds_out_folder)
+            with open(os.path.join(os.path.dirname(ds_out_folder), 'wav.scp'), 'w', encoding='utf-8') as f:
+                for utt_id, _, basename in SCPPathDataset(scp_file, root=root, ds_type=ds_type).data:
+                    f.write(f'{utt_id} {written[os.path.splitext(basename)[0]]}\n')
             logger.info('Done.')
@@ -2,7 +2,7 @@ from pathlib import Path
 from datetime import datetime
 import time
 
-from .. import Pipeline, get_anon_level_from_config
+from .. import Pipeline, get_anon_level_from_config, run_stage_graph
 from utils import read_kaldi_format, copy_data_dir, save_kaldi_format, check_dependencies, setup_logger
 
 from ...modules.sttts.tts import SpeechSynthesis
@@ -74,7 +74,7 @@ class STTTSPipeline(Pipeline):
         # Prosody component
         if "prosody" in modules_config:
             self.prosody_extraction = ProsodyExtraction(
-                device=devices[0],
+                devices=devices,
                 save_intermediate=save_intermediate,
                 settings=modules_config["prosody"],
                 #force_compute=force_compute,
@@ -111,72 +111,122 @@ class STTTSPipeline(Pipeline):
             Args:
                 datasets (dict of str -> Path): The datasets on which the
                     anonymization pipeline should be runned on. These dataset
-                    will be processed sequentially.
+                    will be processed sequentially, or with overlapping stages
+                    if concurrent_stages is set in the config.
         """
         anon_wav_scps = {}
-
-        for i, (dataset_name, dataset_path) in enumerate(datasets.items()):
-            logger.info(f"{i + 1}/{len(datasets)}: Processing {dataset_name}...")
-            # Step 1: Recognize speech, extract speaker embeddings, extract prosody
-            start_time = time.time()
-            texts = self.speech_recognition.recognize_speech(dataset_path=dataset_path, dataset_name=dataset_name)
-            logger.info("--- Speech recognition time: %f min ---" % (float(time.time() - start_time) / 60))
-
-            start_time = time.time()
-            anon_level = get_anon_level_from_config(self.modules_config["speaker_embeddings"], dataset_name)
-            spk_embeddings = self.speaker_extraction[anon_level].extract_speakers(dataset_path=dataset_path,
-                                                                      dataset_name=dataset_name)
-            logger.info(f"--- Speaker extraction anon_level ({anon_level}) time: {(float(time.time() - start_time) / 60)} min ---")
-
-            if self.prosody_extraction:
-                start_time = time.time()
-                prosody = self.prosody_extraction.extract_prosody(dataset_path=dataset_path, dataset_name=dataset_name,
-                                                                  texts=texts)
-                logger.info(f"--- Prosody extraction time: {(float(time.time() - start_time) / 60)} min ---")
-            else:
-                prosody = None
-
-            # Step 2: Anonymize speaker, change prosody
-            if self.speaker_anonymization and anon_level in self.speaker_anonymization:
-                start_time = time.time()
-                anon_embeddings = self.speaker_anonymization[anon_level].anonymize_embeddings(speaker_embeddings=spk_embeddings,
-                                                                                  dataset_name=dataset_name)
-                logger.info(f"--- Speaker anonymization at anon_level ({anon_level}) time: {(float(time.time() - start_time) / 60)} min ---")
-            else:
-                anon_embeddings = spk_embeddings
-
-            if self.prosody_anonymization:
-                start_time = time.time()
-                anon_prosody = self.prosody_anonymization.anonymize_prosody(prosody=prosody, dataset_name=dataset_name)
-                logger.info("--- Prosody anonymization time: %f min ---" % (float(time.time() - start_time) / 60))
-            else:
-                anon_prosody = prosody
-
-            # Step 3: Synthesize
-            start_time = time.time()
-            wav_scp = self.speech_synthesis.synthesize_speech(dataset_name=dataset_name, texts=texts,
-                                                              speaker_embeddings=anon_embeddings,
-                                                              prosody=anon_prosody, emb_level=anon_embeddings.emb_level)
-            logger.info("--- Synthesis time: %f min ---" % (float(time.time() - start_time) / 60))
-
-            anon_wav_scps[dataset_name] = wav_scp
-            logger.info("Anonymization pipeline completed.")
-
-            if self.speaker_anonymization:
-                anon_vectors_path = self.speaker_anonymization[anon_level].results_dir
-            else:
-                anon_vectors_path = self.speaker_extraction[anon_level].results_dir
-
-            logger.info(f"{i + 1}/{len(datasets)}: Preparing kaldi {dataset_name}...")
-
-            output_path = Path(str(dataset_path) + self.anon_suffix)
-            copy_data_dir(dataset_path, output_path)
-            # Overwrite spk2gender if it has been modify
-            spk2gender_anon = read_kaldi_format(anon_vectors_path / dataset_name / 'spk2gender')
-            save_kaldi_format(spk2gender_anon, output_path / 'spk2gender')
-            # Overwrite wav.scp with the paths to the anonymized wavs
-            save_kaldi_format(wav_scp, output_path / 'wav.scp')
-
+        # ASR and speaker extraction are independent, prosody extraction needs the texts and TTS all the results
+        stages = {
+            "asr": (self._recognize_speech, []),
+            "speaker_extraction": (self._extract_speakers, []),
+            "prosody_extraction": (self._extract_prosody, ["asr"]),
+            "speaker_anonymization": (self._anonymize_speakers, ["speaker_extraction"]),
+            "prosody_anonymization": (self._anonymize_prosody, ["prosody_extraction"]),
+            "tts": (self._synthesize_speech, ["asr", "speaker_anonymization", "prosody_anonymization"]),
+        }
+        start_time = time.time()
+        first_output_time = None
+        # the extraction workers are stopped after the last dataset, so that they do not hold their devices during TTS
+        self._last_dataset = list(datasets.items())[-1] if datasets else None
+        results = run_stage_graph(stages, list(datasets.items()),
+                                  concurrent=self.config.get("concurrent_stages", False))
+        try:
+            for i, ((dataset_name, dataset_path), outputs) in enumerate(results):
+                wav_scp = outputs["tts"]
+                anon_wav_scps[dataset_name] = wav_scp
+                if first_output_time is None:
+                    first_output_time = time.time() - start_time
+                logger.info(f"Anonymization pipeline completed for {dataset_name}.")
+
+                anon_level = get_anon_level_from_config(self.modules_config["speaker_embeddings"], dataset_name)
+                if self.speaker_anonymization:
+                    anon_vectors_path = self.speaker_anonymization[anon_level].results_dir
+                else:
+                    anon_vectors_path = self.speaker_extraction[anon_level].results_dir
+
+                logger.info(f"{i + 1}/{len(datasets)}: Preparing kaldi {dataset_name}...")
+
+                output_path = Path(str(dataset_path) + self.anon_suffix)
+                copy_data_dir(dataset_path, output_path)
+                # Overwrite spk2gender if it has been modify
+                spk2gender_anon = read_kaldi_format(anon_vectors_path / dataset_name / 'spk2gender')
+                save_kaldi_format(spk2gender_anon, output_path / 'spk2gender')
+                # Overwrite wav.scp with the paths to the anonymized wavs
+                save_kaldi_format(wav_scp, output_path / 'wav.scp')
+        finally:
+            # waits for the running stages first
+            results.close()
+            self._close_extraction_workers()
+
+        if first_output_time is not None:
+            logger.info("--- Time to first anonymized dataset: %f min ---" % (first_output_time / 60))
+        logger.info("--- Anonymization wall time of %d datasets: %f min ---" % (len(datasets),
+                                                                             float(time.time() - start_time) / 60))
         logger.info("--- Total computation time: %f min ---" % (float(time.time() - self.total_start_time) / 60))
 
         return anon_wav_scps
+
+    def _close_extraction_workers(self):
+        self.speech_recognition.close()
+        if self.prosody_extraction:
+            self.prosody_extraction.close()
+
+    def _recognize_speech(self, dataset):
+        dataset_name, dataset_path = dataset
+        logger.info(f"Processing {dataset_name}...")
+        start_time = time.time()
+        texts = self.speech_recognition.recognize_speech(dataset_path=dataset_path, dataset_name=dataset_name)
+        if dataset == self._last_dataset:
+            self.speech_recognition.close()
+        logger.info(f"--- Speech recognition time ({dataset_name}): %f min ---" % (float(time.time() - start_time) / 60))
+        return texts
+
+    def _extract_speakers(self, dataset):
+        dataset_name, dataset_path = dataset
+        start_time = time.time()
+        anon_level = get_anon_level_from_config(self.modules_config["speaker_embeddings"], dataset_name)
+        spk_embeddings = self.speaker_extraction[anon_level].extract_speakers(dataset_path=dataset_path,
+                                                                  dataset_name=dataset_name)
+        logger.info(f"--- Speaker extraction anon_level ({anon_level}) time ({dataset_name}): {(float(time.time() - start_time) / 60)} min ---")
+        return spk_embeddings
+
+    def _extract_prosody(self, dataset, texts):
+        dataset_name, dataset_path = dataset
+        if not self.prosody_extraction:
+            return None
+        start_time = time.time()
+        prosody = self.prosody_extraction.extract_prosody(dataset_path=dataset_path, dataset_name=dataset_name,
+                                                          texts=texts)
+        if dataset == self._last_dataset:
+            self.prosody_extraction.close()
+        logger.info(f"--- Prosody extraction time ({dataset_name}): {(float(time.time() - start_time) / 60)} min ---")
+        return prosody
+
+    def _anonymize_speakers(self, dataset, spk_embeddings):
+        dataset_name, _ = dataset
+        anon_level = get_anon_level_from_config(self.modules_config["speaker_embeddings"], dataset_name)
+        if not (self.speaker_anonymization and anon_level in self.speaker_anonymization):
+            return spk_embeddings
+        start_time = time.time()
+        anon_embeddings = self.speaker_anonymization[anon_level].anonymize_embeddings(speaker_embeddings=spk_embeddings,
+                                                                          dataset_name=dataset_name)
+        logger.info(f"--- Speaker anonymization at anon_level ({anon_level}) time ({dataset_name}): {(float(time.time() - start_time) / 60)} min ---")
+        return anon_embeddings
+
+    def _anonymize_prosody(self, dataset, prosody):
+        dataset_name, _ = dataset
+        if not (self.prosody_extraction and self.prosody_anonymization):
+            return prosody
+        start_time = time.time()
+        anon_prosody = self.prosody_anonymization.anonymize_prosody(prosody=prosody, dataset_name=dataset_name)
+        logger.info(f"--- Prosody anonymization time ({dataset_name}): %f min ---" % (float(time.time() - start_time) / 60))
+        return anon_prosody
+
+    def _synthesize_speech(self, dataset, texts, anon_embeddings, anon_prosody):
+        dataset_name, _ = dataset
+        start_time = time.time()
+        wav_scp = self.speech_synthesis.synthesize_speech(dataset_name=dataset_name, texts=texts,
+                                                          speaker_embeddings=anon_embeddings,
+                                                          prosody=anon_prosody, emb_level=anon_embeddings.emb_level)
+        logger.info(f"--- Synthesis time ({dataset_name}): %f min ---" % (float(time.time() - start_time) / 60))
+        return wav_scp
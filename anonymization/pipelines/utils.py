@@ -1,3 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
 def get_anon_level_from_config(module_config, dataset_name):
     for k, v in module_config.items():
         if k.startswith("anon_level_"):
@@ -5,3 +8,46 @@ def get_anon_level_from_config(module_config, dataset_name):
                 if dname_short in dataset_name:
                     return k.replace("anon_level_", "")
     raise ValueError("anon_level not implemented")
+
+
+def run_stage_graph(stages, items, concurrent=False):
+    """
+    Runs a graph of stages on each item and yields (item, outputs) in the order of items, outputs being the dict of
+    stage name -> result.
+
+    Args:
+        stages (dict of str -> (function, list of str)): the function of each stage and the names of the stages whose
+            results it takes, in topological order; the function is called as function(item, *dependency results)
+        items (list): the items, e.g. datasets
+        concurrent (bool): if True, every stage runs in its own thread, so that independent stages run at the same
+            time and each stage starts on the next item while the later stages still process the current one. A stage
+            processes one item at a time, in the order of items. Otherwise, all stages of an item run one after another
+            before the next item.
+    """
+    if not concurrent:
+        for item in items:
+            outputs = {}
+            for name, (function, dependencies) in stages.items():
+                outputs[name] = function(item, *[outputs[dependency] for dependency in dependencies])
+            yield item, outputs
+        return
+
+    executors = {name: ThreadPoolExecutor(max_workers=1, thread_name_prefix=name) for name in stages}
+    try:
+        futures = []
+        for item in items:
+            item_futures = {}
+            for name, (function, dependencies) in stages.items():
+                item_futures[name] = executors[name].submit(_run_stage, function, item,
+                                                            [item_futures[dependency] for dependency in dependencies])
+            futures.append((item, item_futures))
+        for item, item_futures in futures:
+            yield item, {name: future.result() for name, future in item_futures.items()}
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _run_stage(function, item, dependency_futures):
+    # raises the exception of a failed dependency, so that it reaches the caller through all later stages
+    return function(item, *[future.result() for future in dependency_futures])
@@ -8,7 +8,7 @@ import pandas as pd
 
 from .utils import PLDAModel
 from .speaker_extraction import SpeakerExtraction
-from utils import write_table, read_kaldi_format, save_kaldi_format, setup_logger
+from utils import write_table, KaldiDataDir, save_kaldi_format, setup_logger
 
 logger = setup_logger(__name__)
 
@@ -70,9 +70,10 @@ class ASV:
         df = pd.read_csv(selected_data_dir / 'train.csv', sep=',')
         selected_utts = set([change_id_format(segment.split('_')[0]) for segment in df['ID'].to_list()])
 
-        wav_scp = read_kaldi_format(all_data_dir / 'wav.scp')
-        utt2spk = change_id_format(read_kaldi_format(all_data_dir / 'utt2spk'))
-        spk2gender = change_id_format(read_kaldi_format(all_data_dir / 'spk2gender'))
+        all_data = KaldiDataDir(all_data_dir)
+        wav_scp = all_data['wav.scp']
+        utt2spk = change_id_format(all_data['utt2spk'])
+        spk2gender = change_id_format(all_data['spk2gender'])
 
         selected_wav_scp = {utt: wav for utt, wav in wav_scp.items() if utt in selected_utts}
         selected_utt2spk = {utt: spk for utt, spk in utt2spk.items() if utt in selected_utts}
@@ -2,9 +2,10 @@
 # https://github.com/speechbrain/speechbrain/blob/develop/recipes/VoxCeleb/SpeakerRec/train_speaker_embeddings.py
 import os
 import random
-import torchaudio
 import speechbrain as sb
 
+from utils import load_wav_from_scp
+
 
 class ASVDatasetGenerator:
 
@@ -49,7 +50,7 @@ class ASVDatasetGenerator:
                 start = int(start)
                 stop = int(stop)
             num_frames = stop - start
-            sig, fs = torchaudio.load(wav, num_frames=num_frames, frame_offset=start)
+            sig, fs = load_wav_from_scp(wav, num_frames=num_frames, frame_offset=start)
             sig = sig.transpose(0, 1).squeeze(1)
             return sig
         sb.dataio.dataset.add_dynamic_item(datasets, audio_pipeline)
@@ -1,8 +1,8 @@
-from collections import defaultdict
 from pathlib import Path
+import numpy as np
 import torch
 
-from utils import read_kaldi_format, save_kaldi_format, create_clean_dir
+from utils import read_kaldi_format, save_kaldi_format, create_clean_dir, KaldiWriter
 
 
 class SpeakerEmbeddings:
@@ -14,7 +14,9 @@ class SpeakerEmbeddings:
 
         self.identifiers2idx = {}
         self.idx2identifiers = {}
-        self.vectors = None
+        # rows [0, len(self)) of a buffer with spare capacity, so that appending is amortised O(new vectors)
+        self._buffer = None
+        self._num_vectors = 0
         self.original_speakers = []
         self.genders = []
 
@@ -30,6 +32,31 @@ class SpeakerEmbeddings:
     def __len__(self):
         return len(self.identifiers2idx)
 
+    @property
+    def vectors(self):
+        if self._buffer is None:
+            return None
+        return self._buffer[:self._num_vectors]
+
+    @vectors.setter
+    def vectors(self, vectors):
+        self._buffer = vectors
+        self._num_vectors = len(vectors) if vectors is not None else 0
+
+    def _reserve(self, num_vectors, like):
+        # grows the buffer geometrically to hold num_vectors rows
+        if self._buffer is not None and len(self._buffer) >= num_vectors:
+            return
+        capacity = max(num_vectors, 2 * len(self._buffer) if self._buffer is not None else 0)
+        buffer = torch.empty((capacity,) + tuple(like.shape[1:]), dtype=like.dtype, device=self.device)
+        if self._buffer is not None:
+            buffer[:self._num_vectors] = self.vectors
+        self._buffer = buffer
+
+    @staticmethod
+    def vectors_exist(in_dir: Path):
+        return (in_dir / 'speaker_vectors.npy').exists() or (in_dir / 'speaker_vectors.pt').exists()
+
     def __getitem__(self, item):
         assert (self.identifiers2idx is not None) and (self.vectors is not None), \
             'Speaker vectors need to be extracted or loaded before they can be accessed!'
@@ -37,15 +64,8 @@ class SpeakerEmbeddings:
         return self.idx2identifiers[item], self.vectors[item]
 
     def add_vector(self, identifier, vector, speaker, gender):
-        idx = len(self)
-        if not self.vectors:
-            self.vectors = torch.tensor(vector)
-        else:
-            self.vectors = torch.cat((self.vectors, vector), 0)
-        self.identifiers2idx[identifier] = idx
-        self.idx2identifiers[idx] = identifier
-        self.original_speakers.append(speaker)
-        self.genders.append(gender)
+        self.add_vectors(identifiers=[identifier], vectors=torch.as_tensor(vector).reshape(1, -1),
+                         speakers=[speaker], genders=[gender])
 
     def set_vectors(self, identifiers, vectors, speakers, genders):
         if not isinstance(identifiers, dict):
@@ -61,7 +81,7 @@ class SpeakerEmbeddings:
         if not isinstance(identifiers, dict):
             identifiers = {identifier: idx for idx, identifier in enumerate(identifiers)}
 
-        new_identifiers = list(identifiers.keys() - self.identifiers2idx.keys())
+        new_identifiers = [iden for iden in identifiers if iden not in self.identifiers2idx]
         indices = [identifiers[iden] for iden in new_identifiers]
         last_known_index = len(self)
 
@@ -70,24 +90,27 @@ class SpeakerEmbeddings:
         self.idx2identifiers.update({idx: iden for iden, idx in new_iden_dict.items()})
         if isinstance(vectors, list):
             vectors = torch.stack(vectors, dim=0).to(self.device)
-        if self.vectors is None:
-            self.vectors = torch.index_select(vectors.clone().detach(),
-                                   0,
-                                   torch.LongTensor(indices).clone().detach().to(self.device)).clone().detach()
-        else:
-            self.vectors = torch.cat((self.vectors, torch.index_select(vectors, 0, torch.LongTensor(indices).to(self.device))), dim=0)
+        vectors = torch.index_select(vectors.detach().to(self.device), 0, torch.LongTensor(indices).to(self.device))
+        self._reserve(self._num_vectors + len(indices), like=vectors)
+        self._buffer[self._num_vectors:self._num_vectors + len(indices)] = vectors
+        self._num_vectors += len(indices)
         self.genders.extend([genders[idx] for idx in indices])
         self.original_speakers.extend([speakers[idx] for idx in indices])
 
     def load_vectors(self, in_dir: Path):
-        assert (in_dir / f'id2idx').exists() and (in_dir / f'speaker_vectors.pt').exists(), \
-            f'speaker_vectors.pt and id2idx must exist in {in_dir}!'
+        assert (in_dir / f'id2idx').exists() and self.vectors_exist(in_dir), \
+            f'speaker_vectors.npy and id2idx must exist in {in_dir}!'
 
         idx2spk = read_kaldi_format(in_dir / 'idx2spk')
         spk2gender = read_kaldi_format(in_dir / 'spk2gender')
-        self.original_speakers = [spk for idx, spk in sorted(idx2spk.items(), key=lambda x: x[0])]
+        self.original_speakers = [spk for idx, spk in sorted(idx2spk.items(), key=lambda x: int(x[0]))]
         self.genders = [spk2gender[spk] for spk in self.original_speakers]
-        self.vectors = torch.load(in_dir / f'speaker_vectors.pt', map_location=self.device)
+        if (in_dir / 'speaker_vectors.npy').exists():
+            # memory-mapped copy-on-write, zero-copy on cpu
+            vectors = torch.from_numpy(np.load(in_dir / 'speaker_vectors.npy', mmap_mode='c'))
+            self.vectors = vectors.to(self.device) if torch.device(self.device).type != 'cpu' else vectors
+        else:
+            self.vectors = torch.load(in_dir / f'speaker_vectors.pt', map_location=self.device)
 
         self.identifiers2idx = {id: int(idx) for id, idx in read_kaldi_format(in_dir / f'id2idx').items()}
         self.idx2identifiers = {idx: identifier for identifier, idx in self.identifiers2idx.items()}
@@ -107,7 +130,46 @@ class SpeakerEmbeddings:
         spk2gender = self.get_spk2gender()
         save_kaldi_format(spk2gender, out_dir / 'spk2gender')
 
-        torch.save(self.vectors, out_dir / f'speaker_vectors.pt')
+        # raw float32 matrix, see load_vectors
+        np.save(out_dir / 'speaker_vectors.npy', self.vectors.detach().cpu().float().numpy())
+
+    def append_checkpoint(self, out_dir: Path, start):
+        # checkpoint costing O(new vectors): the vectors from index start on are saved to their own file and their
+        # ids appended to the .partial files of id2idx, idx2spk and spk2gender (see load_checkpoint). start=0 begins a
+        # new checkpoint and cleans out_dir, never pass the dir of a loaded checkpoint (see extraction_job)
+        if start == 0:
+            create_clean_dir(out_dir)
+        part = out_dir / f'speaker_vectors.{start}.npy'
+        with open(part.with_suffix('.tmp'), 'wb') as f:
+            np.save(f, self.vectors[start:].detach().cpu().float().numpy())
+        part.with_suffix('.tmp').replace(part)
+        indices = range(start, len(self))
+        KaldiWriter(out_dir / 'id2idx', resume=True).append([(self.idx2identifiers[i], i) for i in indices])
+        KaldiWriter(out_dir / 'idx2spk', resume=True).append([(i, self.original_speakers[i]) for i in indices])
+        KaldiWriter(out_dir / 'spk2gender', resume=True).append([(self.original_speakers[i], self.genders[i])
+                                                                 for i in indices])
+
+    @staticmethod
+    def checkpoint_exists(in_dir: Path):
+        return (in_dir / 'id2idx.partial').exists()
+
+    def load_checkpoint(self, in_dir: Path):
+        # vectors are saved before their ids, keep the complete rows only
+        parts = sorted(in_dir.glob('speaker_vectors.*.npy'), key=lambda part: int(part.suffixes[0][1:]))
+        vectors = torch.from_numpy(np.concatenate([np.load(part) for part in parts])).to(self.device)
+        idx2spk = KaldiWriter(in_dir / 'idx2spk', resume=True).read()
+        spk2gender = KaldiWriter(in_dir / 'spk2gender', resume=True).read()
+        id2idx = KaldiWriter(in_dir / 'id2idx', resume=True).read()
+        identifiers2idx = {id: int(idx) for id, idx in id2idx.items()
+                           if int(idx) < len(vectors) and idx in idx2spk and idx2spk[idx] in spk2gender}
+        num_vectors = len(identifiers2idx)
+
+        self.vectors = vectors[:num_vectors]
+        self.identifiers2idx = identifiers2idx
+        self.idx2identifiers = {idx: identifier for identifier, idx in identifiers2idx.items()}
+        self.original_speakers = [idx2spk[str(idx)] for idx in range(num_vectors)]
+        self.genders = [spk2gender[spk] for spk in self.original_speakers]
+        self.new = False
 
     def get_embedding_for_identifier(self, identifier):
         idx = self.identifiers2idx[identifier]
@@ -128,20 +190,24 @@ class SpeakerEmbeddings:
             'Speaker embeddings must be on utterance level to be able to convert them to speaker level!'
 
         if method == 'average':
-            spk2idx = defaultdict(list)
+            # speakers in order of their first utterance, averaged as one segment mean
+            first_idx = {}
             for i, speaker in enumerate(self.original_speakers):
-                spk2idx[speaker].append(i)
+                first_idx.setdefault(speaker, i)
+            speakers = list(first_idx)
+            genders = [self.genders[i] for i in first_idx.values()]
+            spk2idx = {speaker: i for i, speaker in enumerate(speakers)}
+
+            vectors = self.vectors if isinstance(self.vectors, torch.Tensor) else torch.tensor(self.vectors)
+            segments = torch.tensor([spk2idx[speaker] for speaker in self.original_speakers], device=vectors.device)
+            sums = torch.zeros((len(speakers),) + tuple(vectors.shape[1:]), dtype=vectors.dtype, device=vectors.device)
+            sums.index_add_(0, segments, vectors)
+            counts = torch.bincount(segments, minlength=len(speakers)).to(vectors.dtype)
+            spk_vectors = sums / counts.reshape((-1,) + (1,) * (vectors.dim() - 1))
 
             spk_level_embeddings = SpeakerEmbeddings(vec_type=self.vec_type, emb_level='spk', device=self.device)
-            spk_vectors, speakers, genders = [], [], []
-            if not isinstance(self.vectors, torch.Tensor):
-                self.vectors = torch.tensor(self.vectors)
-            for speaker, idx_list in spk2idx.items():
-                spk_vectors.append(torch.mean(self.vectors[idx_list], dim=0))
-                speakers.append(speaker)
-                genders.append(self.genders[idx_list[0]])
-            spk_level_embeddings.set_vectors(identifiers=speakers, vectors=torch.stack(spk_vectors, dim=0),
-                                             speakers=speakers, genders=genders)
+            spk_level_embeddings.set_vectors(identifiers=speakers, vectors=spk_vectors, speakers=speakers,
+                                             genders=genders)
 
             return spk_level_embeddings
         else:
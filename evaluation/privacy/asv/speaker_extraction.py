@@ -3,7 +3,7 @@ import shutil
 from tqdm import tqdm
 from pathlib import Path
 import torch
-import torchaudio
+from torch.utils.data import Dataset, DataLoader
 from tqdm.contrib.concurrent import process_map
 import time
 from torch.multiprocessing import set_start_method
@@ -12,61 +12,82 @@ from itertools import repeat
 from .speechbrain_vectors import SpeechBrainVectors
 from .utils import normalize_wave
 from .speaker_embeddings import SpeakerEmbeddings
-from utils import read_kaldi_format, remove_contents_in_dir, setup_logger
+from utils import KaldiDataDir, remove_contents_in_dir, setup_logger, load_wav_from_scp
 
 set_start_method('spawn', force=True)
 logger = setup_logger(__name__)
 
 
+class ExtractionDataset(Dataset):
+    """Loads and loudness-normalizes the utterances of utt_info, in the DataLoader workers"""
+
+    def __init__(self, utt_info):
+        self.utt_info = list(utt_info.items())
+
+    def __len__(self):
+        return len(self.utt_info)
+
+    def __getitem__(self, idx):
+        utt, info = self.utt_info[idx]
+        signal, fs = load_wav_from_scp(info['path'])
+        return utt, info, normalize_wave(signal, fs, device='cpu'), fs
+
+
 def extraction_job(params):
-    utt_info, speaker_extractors, sleep, device, vec_type, out_dir, save_intermediate, job_id = params
-    time.sleep(sleep)
+    utt_info, speaker_extractors, device, vec_type, out_dir, save_intermediate, job_id, batch_size, num_workers = \
+        params
 
     speaker_embeddings = SpeakerEmbeddings(vec_type=vec_type, emb_level='utt', device=device)
 
     add_suffix = f'_{job_id}' if job_id is not None else ''
-    out_dir = out_dir / f'temp{add_suffix}'
-
-    vectors = []
-    utts = []
-    speakers = []
-    genders = []
-    i = 0
-    for utt, info in tqdm(utt_info.items(), desc=f'Job {job_id or 0}', leave=True):
-        wav_path = info['path']
-        if isinstance(wav_path, list):
-            wav_path = wav_path[1]
-        signal, fs = torchaudio.load(wav_path)
-        # if len(signal.shape) == 2:
-        #     signal = signal.squeeze(0)
-        norm_wave = normalize_wave(signal, fs, device=device)
-
-        try:
-            spk_embs = [extractor.extract_vector(audio=norm_wave, sr=fs) for extractor in speaker_extractors]
-        except RuntimeError as e:
-            logger.warning(f'Runtime error: {utt}, {signal.shape}, {norm_wave.shape}')
-            raise e
-
-        if len(spk_embs) == 1:
-            vector = spk_embs[0]
-        else:
-            vector = torch.cat(spk_embs, dim=0)
-        vectors.append(vector)
-        utts.append(utt)
-        speakers.append(info['spk'])
-        genders.append(info['gender'])
-
-        i += 1
-        if i % 100 == 0:
-            speaker_embeddings.add_vectors(vectors=vectors, identifiers=utts, speakers=speakers, genders=genders)
+    # the temp dirs of an interrupted run were loaded by the caller and are kept until its results are saved, the
+    # first checkpoint cleans its dir so that dir has to be a new one
+    temp_dir = out_dir / f'temp{add_suffix}'
+    k = 0
+    while save_intermediate and temp_dir.exists() and any(temp_dir.iterdir()):
+        k += 1
+        temp_dir = out_dir / f'temp{add_suffix}.{k}'
+    out_dir = temp_dir
+
+    # utterances are sorted by length inside windows of at least 100 utterances (one checkpoint each) and split
+    # into padded batches of batch_size utterances
+    window_size = max(100, 8 * batch_size)
+    loader = DataLoader(ExtractionDataset(utt_info), batch_size=None, num_workers=num_workers,
+                        prefetch_factor=window_size // num_workers + 1 if num_workers > 0 else None)
+    loaded = iter(loader)
+
+    saved = 0
+    with tqdm(total=len(utt_info), desc=f'Job {job_id or 0}', leave=True) as progress:
+        for start in range(0, len(utt_info), window_size):
+            window = [next(loaded) for _ in range(min(window_size, len(utt_info) - start))]
+            window.sort(key=lambda x: (x[3], len(x[2])))
+
             vectors, utts, speakers, genders = [], [], [], []
-            if save_intermediate:
-                speaker_embeddings.save_vectors(out_dir)
+            for i in range(0, len(window), batch_size):
+                batch = window[i:i + batch_size]
+                for fs in sorted(set(x[3] for x in batch)):
+                    same_fs = [x for x in batch if x[3] == fs]
+                    norm_waves = [x[2].to(device) for x in same_fs]
+                    try:
+                        spk_embs = [extractor.extract_vectors(audios=norm_waves, sr=fs)
+                                    for extractor in speaker_extractors]
+                    except RuntimeError as e:
+                        logger.warning(f'Runtime error: {[x[0] for x in same_fs]}, {[x.shape for x in norm_waves]}')
+                        raise e
+
+                    vectors.extend(torch.cat(spk_embs, dim=1).to(device))
+                    utts.extend(x[0] for x in same_fs)
+                    speakers.extend(x[1]['spk'] for x in same_fs)
+                    genders.extend(x[1]['gender'] for x in same_fs)
+                progress.update(len(batch))
 
-    if vectors:
-        speaker_embeddings.add_vectors(vectors=vectors, identifiers=utts, speakers=speakers, genders=genders)
-        if save_intermediate:
-            speaker_embeddings.save_vectors(out_dir)
+            speaker_embeddings.add_vectors(vectors=vectors, identifiers=utts, speakers=speakers, genders=genders)
+            if save_intermediate and len(window) == window_size:
+                speaker_embeddings.append_checkpoint(out_dir, start=saved)
+                saved = len(speaker_embeddings)
+
+    if save_intermediate and len(speaker_embeddings) > 0:
+        speaker_embeddings.save_vectors(out_dir)
 
     return speaker_embeddings
 
@@ -83,6 +104,8 @@ class SpeakerExtraction:
         self.emb_model_path = settings['emb_model_path']
         self.vec_type = settings['vec_type']
         self.emb_level = settings['emb_level']
+        self.batch_size = settings.get('batch_size', 1)
+        self.num_workers = settings.get('num_workers', 2)
 
         if results_dir:
             self.results_dir = results_dir
@@ -112,7 +135,8 @@ class SpeakerExtraction:
         dataset_name = dataset_name if dataset_name is not None else dataset_path.name
         dataset_results_dir = self.results_dir / dataset_name if self.save_intermediate else Path('')
         emb_level = emb_level if emb_level is not None else self.emb_level
-        utt2spk = read_kaldi_format(dataset_path / 'utt2spk')
+        data_dir = KaldiDataDir(dataset_path)
+        utt2spk = data_dir['utt2spk']
 
         # we have to extract on utt level first and convert it to something else later
         if emb_level == 'spk':
@@ -125,6 +149,8 @@ class SpeakerExtraction:
         if self.force_compute:
             speaker_embeddings = SpeakerEmbeddings(vec_type=self.vec_type, emb_level='utt', device=self.devices[0])
             missing_utterances = list(utt2spk.keys())
+            if self.save_intermediate and utt_level_results_dir.exists():
+                self._remove_temp_files(out_dir=utt_level_results_dir)
         else:
             speaker_embeddings, missing_utterances = self._get_already_extracted_speakers(
                 utterances=list(utt2spk.keys()), emb_level=emb_level, final_results_dir=final_results_dir,
@@ -133,8 +159,8 @@ class SpeakerExtraction:
         if len(missing_utterances) > 0:
             logger.info(f'Extract embeddings of {len(missing_utterances)} utterances')
             speaker_embeddings.new = True
-            wav_scp = read_kaldi_format(dataset_path / 'wav.scp')
-            spk2gender = read_kaldi_format(dataset_path / 'spk2gender')
+            wav_scp = data_dir['wav.scp']
+            spk2gender = data_dir['spk2gender']
             # sometimes an utterance is skipped during synthesis
             previous_num_missing_utterances = len(missing_utterances)
             missing_utterances = [utt for utt in missing_utterances if utt in wav_scp.keys()]
@@ -147,22 +173,22 @@ class SpeakerExtraction:
                         for utt in missing_utterances}
 
             if self.n_processes > 1:
-                sleeps = [10 * i for i in range(self.n_processes)]
                 utt_info_jobs = [{k: v for k, v in list(utt_info.items())[i::self.n_processes]}
                                  for i in range(self.n_processes)]
                 # multiprocessing
                 params = zip(utt_info_jobs,  # utterances to extract speaker emb from
                              self.extractors, # extractors to use for extraction
-                             sleeps, # avoid starting all processes at same time
                              self.devices, # device for each process
                              repeat(self.vec_type),  # which vec_type to use for extraction
                              repeat(utt_level_results_dir),  # where to store utt level results
                              repeat(self.save_intermediate), # whether to save intermediate results
-                             list(range(self.n_processes)))  # job_id
+                             list(range(self.n_processes)),  # job_id
+                             repeat(self.batch_size),  # utterances per encoder call
+                             repeat(0))  # no DataLoader workers, the jobs already run in parallel processes
                 job_spk_embeddings = process_map(extraction_job, params, max_workers=self.n_processes)
             else:
-                params = [utt_info, self.extractors[0], 0, self.devices[0], self.vec_type, utt_level_results_dir,
-                          self.save_intermediate, None]
+                params = [utt_info, self.extractors[0], self.devices[0], self.vec_type, utt_level_results_dir,
+                          self.save_intermediate, None, self.batch_size, self.num_workers]
                 job_spk_embeddings = [extraction_job(params)]
 
             speaker_embeddings = self._combine_speaker_embeddings(main_emb_instance=speaker_embeddings,
@@ -181,14 +207,14 @@ class SpeakerExtraction:
         missing_utterances = []
         intermediate_results_dirs = list(utt_level_results_dir.glob('temp*'))
         device = self.devices[0]
-        if (final_results_dir / 'speaker_vectors.pt').exists():
+        if SpeakerEmbeddings.vectors_exist(final_results_dir):
             speaker_embeddings = SpeakerEmbeddings(vec_type=self.vec_type, emb_level=emb_level, device=device)
             speaker_embeddings.load_vectors(final_results_dir)
             # if the extraction is something else than utt-level and a final results dir exists, we assume that it is complete
             # if the extraction is on utt-level, we have to check that we extracted embeddings of all utterances
             if emb_level == 'utt':
                 missing_utterances = list(set(utterances) - set(speaker_embeddings.identifiers2idx.keys()))
-        elif (utt_level_results_dir / 'speaker_vectors.pt').exists():  # only possible if utt_level_results_dir != final_results_dir
+        elif SpeakerEmbeddings.vectors_exist(utt_level_results_dir):  # only possible if utt_level_results_dir != final_results_dir
             speaker_embeddings = SpeakerEmbeddings(vec_type=self.vec_type, emb_level='utt', device=device)
             speaker_embeddings.load_vectors(utt_level_results_dir)
             missing_utterances = list(set(utterances) - set(speaker_embeddings.identifiers2idx.keys()))
@@ -198,10 +224,15 @@ class SpeakerExtraction:
         elif len(intermediate_results_dirs) > 0:
             int_speaker_embeddings = []
             for intermediate_results_dir in intermediate_results_dirs:
-                if (intermediate_results_dir / 'speaker_vectors.pt').exists():
+                if SpeakerEmbeddings.vectors_exist(intermediate_results_dir):
                     emb = SpeakerEmbeddings(vec_type=self.vec_type, emb_level='utt', device=device)
                     emb.load_vectors(intermediate_results_dir)
                     int_speaker_embeddings.append(emb)
+                elif SpeakerEmbeddings.checkpoint_exists(intermediate_results_dir):
+                    # job interrupted between two checkpoints
+                    emb = SpeakerEmbeddings(vec_type=self.vec_type, emb_level='utt', device=device)
+                    emb.load_checkpoint(intermediate_results_dir)
+                    int_speaker_embeddings.append(emb)
             if len(int_speaker_embeddings) > 0:
                 speaker_embeddings = SpeakerEmbeddings(vec_type=self.vec_type, emb_level='utt', device=device)
                 speaker_embeddings = self._combine_speaker_embeddings(main_emb_instance=speaker_embeddings,
@@ -252,3 +283,56 @@ class SpeakerExtraction:
             remove_contents_in_dir(temp_dir)
             shutil.rmtree(temp_dir)
 
+
+
+def benchmark_speaker_extraction(model_path, vec_type='ecapa', device='cpu', wav_scp=None, n_utts=64,
+                                 batch_sizes=(1, 8, 32), num_workers=2, seed=0):
+    """Utterances/sec of the per-utterance path (extract_vector on each
+    utterance) and of extraction_job at several batch sizes, and the largest
+    cosine distance between their vectors. Runs on the utterances of wav_scp,
+    or on a synthetic fixture of harmonic signals of 1-6 s.
+    """
+    import tempfile
+    import numpy as np
+    import soundfile
+    from utils import read_kaldi_format
+
+    device = torch.device(device)
+    extraction = SpeakerExtraction(devices=[device], settings={'vec_type': vec_type, 'emb_level': 'utt',
+                                                               'emb_model_path': model_path},
+                                   save_intermediate=False)
+    extractors = extraction.extractors[0]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if wav_scp is None:
+            rng = np.random.default_rng(seed)
+            wav_paths = {}
+            for i in range(n_utts):
+                t = np.arange(int(16000 * rng.uniform(1, 6))) / 16000
+                phase = 2 * np.pi * np.cumsum(rng.uniform(90, 220) * (1 + 0.2 * np.sin(2 * np.pi * t))) / 16000
+                signal = 0.1 * sum(np.sin(k * phase) / k for k in range(1, 8)) + 0.005 * rng.standard_normal(len(t))
+                wav_paths[f'utt{i}'] = str(Path(tmp_dir) / f'utt{i}.wav')
+                soundfile.write(wav_paths[f'utt{i}'], signal, 16000, subtype='PCM_16')
+        else:
+            wav_paths = dict(list(read_kaldi_format(wav_scp).items())[:n_utts])
+        utt_info = {utt: {'path': path, 'spk': utt, 'gender': 'f'} for utt, path in wav_paths.items()}
+
+        start = time.perf_counter()
+        reference = {}
+        for utt, info in utt_info.items():
+            signal, fs = load_wav_from_scp(info['path'])
+            norm_wave = normalize_wave(signal, fs, device=device)
+            reference[utt] = torch.cat([extractor.extract_vector(audio=norm_wave, sr=fs)
+                                        for extractor in extractors], dim=0)
+        elapsed = time.perf_counter() - start
+        print(f'per utterance: {len(utt_info) / elapsed:.1f} utt/s')
+
+        for batch_size in batch_sizes:
+            start = time.perf_counter()
+            embeddings = extraction_job([utt_info, extractors, device, vec_type, Path(tmp_dir), False, None,
+                                         batch_size, num_workers])
+            elapsed = time.perf_counter() - start
+            distance = max(1 - torch.nn.functional.cosine_similarity(vector, reference[utt], dim=0).item()
+                           for utt, vector in embeddings)
+            print(f'batch size {batch_size}: {len(utt_info) / elapsed:.1f} utt/s, '
+                  f'max cosine distance {distance:.2e}')
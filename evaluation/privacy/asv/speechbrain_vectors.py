@@ -43,3 +43,20 @@ class SpeechBrainVectors:
         if len(audio.shape) == 1:
             audio = audio.unsqueeze(0)
         return self.extractor.encode_batch(wavs=audio).squeeze()
+
+    def extract_vectors(self, audios, sr):
+        """Batched extract_vector(): audios is a list of 1-D waveforms, the result is (B, dim)"""
+        # trimmed and padded on the device of the audios, the padded batch is moved to the model device at once
+        audios = [_trim_zeros(audio.float()) for audio in audios]
+        lengths = torch.tensor([len(audio) for audio in audios], dtype=torch.float)
+        wavs = torch.nn.utils.rnn.pad_sequence(audios, batch_first=True).to(self.device)
+        # relative lengths, so that padding is ignored by the normalization and the pooling
+        return self.extractor.encode_batch(wavs=wavs, wav_lens=lengths / lengths.max()).squeeze(1)
+
+
+def _trim_zeros(audio):
+    # np.trim_zeros on a torch tensor
+    nonzero = torch.nonzero(audio)
+    if len(nonzero) == 0:
+        return audio[:0]
+    return audio[nonzero[0, 0]:nonzero[-1, 0] + 1]
@@ -1,12 +1,11 @@
 import numpy as np
 import torch
-import torchaudio
 import pyloudnorm as pyln
 
 from pathlib import Path
 from speechbrain.processing.PLDA_LDA import PLDA, StatObject_SB, Ndx, fast_PLDA_scoring
 
-from utils import setup_logger
+from utils import setup_logger, resample
 
 logger = setup_logger(__name__)
 
@@ -15,6 +14,7 @@ class PLDAModel:
 
     def __init__(self, train_embeddings, results_path: Path=None, save_plda=True):
         self.mean, self.F, self.Sigma = None, None, None
+        self._transforms = None
 
         files_exist = False
         if results_path and results_path.exists():
@@ -42,6 +42,39 @@ class PLDAModel:
         else:
             return scores_plda.scoremat
 
+    def compute_scores(self, enrollment_vectors, trial_vectors):
+        """
+        Score matrix (E, T) of fast_PLDA_scoring as matrix products with the precomputed transforms of
+        get_scoring_transforms(), for scoring blocks of vectors without building StatObjects
+        """
+        mean, Phi, Psi, plda_cst = self.get_scoring_transforms(device=enrollment_vectors.device)
+        enrol_ctr = enrollment_vectors.to(torch.float64) - mean
+        trial_ctr = trial_vectors.to(torch.float64) - mean
+        model_part = 0.5 * torch.sum((enrol_ctr @ Phi) * enrol_ctr, dim=1)
+        seg_part = 0.5 * torch.sum((trial_ctr @ Phi) * trial_ctr, dim=1)
+        return model_part[:, None] + seg_part[None, :] + plda_cst + (enrol_ctr @ Psi) @ trial_ctr.T
+
+    def get_scoring_transforms(self, device='cpu'):
+        # mean, Phi, Psi and the constant of the two-covariance PLDA score, as in fast_PLDA_scoring
+        if self._transforms is None:
+            inv_sigma = np.linalg.inv(self.Sigma)
+            I_spk = np.eye(self.F.shape[1], dtype='float')
+            K = self.F.T.dot(inv_sigma).dot(self.F)
+            alpha1 = np.linalg.slogdet(np.linalg.inv(K + I_spk))[1]
+            alpha2 = np.linalg.slogdet(np.linalg.inv(2 * K + I_spk))[1]
+
+            sigma_ac = np.dot(self.F, self.F.T)
+            sigma_tot = sigma_ac + self.Sigma
+            sigma_tot_inv = np.linalg.inv(sigma_tot)
+            tmp = np.linalg.inv(sigma_tot - sigma_ac.dot(sigma_tot_inv).dot(sigma_ac))
+            Phi = sigma_tot_inv - tmp
+            Psi = sigma_tot_inv.dot(sigma_ac).dot(tmp)
+            self._transforms = (np.asarray(self.mean, dtype=np.float64).reshape(-1), Phi, Psi,
+                                alpha2 / 2.0 - alpha1)
+        mean, Phi, Psi, plda_cst = self._transforms
+        return (torch.from_numpy(mean).to(device), torch.from_numpy(Phi).to(device),
+                torch.from_numpy(Psi).to(device), plda_cst)
+
     def save_parameters(self, filename):
         filename.mkdir(parents=True, exist_ok=True)
         np.save(filename / 'plda_mean.npy', self.mean)
@@ -112,7 +145,7 @@ def normalize_wave(wave, sr, device):
     wave = torch.Tensor(norm_wave).to(device)
 
     if sr != 16000:
-        wave = torchaudio.transforms.Resample(orig_freq=sr, new_freq=16000).to(device)(wave)
+        wave = resample(wave, sr, 16000, method='sinc_hann')
 
     return wave
 
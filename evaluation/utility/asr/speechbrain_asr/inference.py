@@ -6,16 +6,15 @@ from speechbrain.pretrained import EncoderASR, EncoderDecoderASR
 from speechbrain.utils.metric_stats import ErrorRateStats
 import tqdm
 import torch
-import torchaudio
 
-from utils import read_kaldi_format
+from utils import read_kaldi_format, load_wav_from_scp
 
 
 class ASRDataset(torch.utils.data.Dataset):
     def __init__(self, wav_scp_file, asr_model):
         data = []
         for utt_id, wav_file in read_kaldi_format(wav_scp_file).items():
-            signal, sr = torchaudio.load(str(wav_file))
+            signal, sr = load_wav_from_scp(wav_file)
             wav = asr_model.audio_normalizer(signal.squeeze(), sr)
             #wav = asr_model.load_audio(wav_file)
             wav_len = len(wav.squeeze())
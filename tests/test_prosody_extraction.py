@@ -0,0 +1,49 @@
+import copy
+
+import pytest
+import torch
+from torch.optim import SGD
+
+try:
+    from anonymization.modules.sttts.prosody.extraction.ims_prosody_extraction import ImsProsodyExtractor
+    from anonymization.modules.sttts.tts.IMSToucan.TrainingInterfaces.Text_to_Spectrogram.AutoAligner.Aligner \
+        import Aligner
+except (ImportError, OSError) as e:  # IMS Toucan dependencies, e.g. parselmouth or the PortAudio library
+    pytest.skip(f'IMS Toucan dependencies are missing: {e}', allow_module_level=True)
+
+
+def make_extractor(aligner_weights):
+    # ImsProsodyExtractor.__init__ without the aligner checkpoint and the silero VAD
+    extractor = ImsProsodyExtractor.__new__(ImsProsodyExtractor)
+    extractor.device = 'cpu'
+    extractor.acoustic_model = Aligner()
+    extractor.acoustic_model.load_state_dict(aligner_weights)
+    extractor.aligner_state = {name: tensor.detach().clone() for name, tensor in extractor._aligner_tensors().items()}
+    extractor.optim_asr = SGD(extractor.acoustic_model.parameters(), lr=0.1)
+    return extractor
+
+
+def test_in_place_reset_fine_tunes_like_load_state_dict():
+    torch.manual_seed(0)
+    aligner_weights = copy.deepcopy(Aligner().state_dict())
+    utterances = [(torch.randn(n_frames, 80), torch.randint(0, 73, (n_tokens,)).tolist())
+                  for n_frames, n_tokens in [(40, 8), (25, 5), (60, 12)]]
+
+    reference = make_extractor(aligner_weights)
+    in_place = make_extractor(aligner_weights)
+    for seed, (melspec, tokens) in enumerate(utterances):
+        # former reset: the CPU state dict and a new optimizer before every utterance
+        reference.acoustic_model.load_state_dict(aligner_weights)
+        reference.optim_asr = SGD(reference.acoustic_model.parameters(), lr=0.1)
+        torch.manual_seed(seed)  # same dropout masks in both paths
+        reference._fine_tune(melspec, tokens)
+
+        in_place._load_aligner_state(in_place.aligner_state)
+        torch.manual_seed(seed)
+        in_place._fine_tune(melspec, tokens)
+
+        fine_tuned = in_place._aligner_tensors()
+        for name, tensor in reference._aligner_tensors().items():
+            assert torch.equal(tensor, fine_tuned[name]), name
+        # the fine-tuning changed the aligner, so the next reset is not a no-op
+        assert not torch.equal(fine_tuned['proj.weight'], in_place.aligner_state['proj.weight'])
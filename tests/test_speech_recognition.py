@@ -0,0 +1,47 @@
+import pytest
+
+from anonymization.modules.sttts.text import speech_recognition
+from anonymization.modules.sttts.text.speech_recognition import SpeechRecognition
+
+
+class InterruptedASR:
+    """Recognizes the wav.scp value as the text, raises after max_windows windows"""
+    output = 'phones'
+
+    def __init__(self, recognized, max_windows=None):
+        self.recognized = recognized
+        self.max_windows = max_windows
+
+    def recognize_speech_of_audios(self, audio_files):
+        if self.max_windows is not None:
+            if self.max_windows == 0:
+                raise KeyboardInterrupt
+            self.max_windows -= 1
+        self.recognized.extend(audio_files)
+        return [f'text of {audio_file}' for audio_file in audio_files]
+
+
+def test_restart_after_interruption_recognizes_each_utterance_once(tmp_path, monkeypatch):
+    dataset = tmp_path / 'data'
+    dataset.mkdir()
+    utterances = [f'utt{i:03d}' for i in range(250)]
+    (dataset / 'wav.scp').write_text(''.join(f'{utt} {utt}.wav\n' for utt in utterances))
+    (dataset / 'utt2spk').write_text(''.join(f'{utt} spk{i % 3}\n' for i, utt in enumerate(utterances)))
+
+    recognized = []
+    asr = InterruptedASR(recognized, max_windows=2)
+    monkeypatch.setattr(speech_recognition, 'create_model_instance', lambda hparams, device: asr)
+    recognition = SpeechRecognition(devices=['cpu'], settings={'recognizer': 'ims'}, results_dir=tmp_path / 'asr')
+    with pytest.raises(KeyboardInterrupt):
+        recognition.recognize_speech(dataset_path=dataset)
+    assert len(recognized) == 200
+
+    asr.max_windows = None
+    texts = SpeechRecognition(devices=['cpu'], settings={'recognizer': 'ims'},
+                              results_dir=tmp_path / 'asr').recognize_speech(dataset_path=dataset)
+
+    assert sorted(recognized) == sorted(f'{utt}.wav' for utt in utterances)
+    assert sorted(texts.utterances) == utterances
+    assert texts['utt123'] == 'text of utt123.wav'
+    saved = (tmp_path / 'asr' / 'data' / 'text').read_text().splitlines()
+    assert len(saved) == 250 and not list((tmp_path / 'asr' / 'data').glob('*.partial'))
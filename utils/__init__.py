@@ -1,6 +1,9 @@
-from .data_io import read_kaldi_format, save_kaldi_format, parse_yaml, save_yaml, write_table, load_wav_from_scp
+from .data_io import read_kaldi_format, save_kaldi_format, KaldiWriter, parse_yaml, save_yaml, write_table, load_wav_from_scp, load_wav_blocks_from_scp, \
+    parse_scp_pipe, read_kaldi_table, KaldiDataDir
 from .path_management import (create_clean_dir, remove_contents_in_dir, get_datasets,
                               scan_checkpoint, copy_data_dir)
 from .prepare_results_in_kaldi_format import combine_asr_data,check_kaldi_formart_data
+from .audio_sink import get_audio_sink, scan_audio_sink
 from .dependencies import check_dependencies
 from .logger import setup_logger
+from .resampling import resample, resampled_length
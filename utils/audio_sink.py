@@ -0,0 +1,191 @@
+from abc import ABC, abstractmethod
+from pathlib import Path
+import io
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+import soundfile
+
+# wav.scp value of an utterance stored in a shard: <shard_path>:<byte offset>:<byte length>
+SHARD_ENTRY = re.compile(r'^(?P<path>.+):(?P<offset>\d+):(?P<length>\d+)$')
+
+
+def _to_numpy(samples):
+    if hasattr(samples, 'detach'):  # torch.Tensor
+        samples = samples.detach().cpu().numpy()
+    samples = np.asarray(samples)
+    if samples.ndim == 2 and samples.shape[0] == 1:  # torchaudio layout (channel, time)
+        samples = samples[0]
+    if np.issubdtype(samples.dtype, np.floating):
+        # like torchaudio.save, avoid wrap-around in the int16 conversion
+        samples = np.clip(samples, -1, 1)
+    return samples
+
+
+class AudioSink(ABC):
+    """
+    Destination of the anonymized utterances of one dataset. Every write
+    returns the value of the utterance in wav.scp, which load_wav_from_scp()
+    can read back, whatever the storage format.
+    """
+
+    def __init__(self, out_dir):
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(exist_ok=True, parents=True)
+
+    @abstractmethod
+    def write(self, utid, samples, sr):
+        """
+        Writes one utterance.
+
+        Args:
+            utid: utterance id, also used as file name
+            samples: mono waveform, np.array or torch.Tensor, int16 or float in [-1, 1]
+            sr: sampling rate
+
+        Returns:
+            the wav.scp value and the number of bytes written
+        """
+        pass
+
+    @abstractmethod
+    def write_blocks(self, utid, blocks, sr):
+        """Like write() for an iterable of consecutive blocks of samples"""
+        pass
+
+    @classmethod
+    @abstractmethod
+    def scan(cls, out_dir):
+        """Returns a dict utid -> wav.scp value of the utterances already in out_dir"""
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class WavSink(AudioSink):
+    """One 16-bit PCM file per utterance, <out_dir>/<utid>.wav"""
+    extension = 'wav'
+    format = 'WAV'
+
+    def _output_file(self, utid):
+        return self.out_dir / f'{utid}.{self.extension}'
+
+    def write(self, utid, samples, sr):
+        return self.write_blocks(utid, [samples], sr)
+
+    def write_blocks(self, utid, blocks, sr):
+        output_file = self._output_file(utid)
+        # written under a temporary name so that output_file is never partial
+        partial_file = output_file.with_name(output_file.name + '.partial')
+        with soundfile.SoundFile(partial_file, 'w', samplerate=sr, channels=1,
+                                 format=self.format, subtype='PCM_16') as f:
+            for samples in blocks:
+                f.write(_to_numpy(samples))
+        os.replace(partial_file, output_file)
+        return str(output_file.absolute()), output_file.stat().st_size
+
+    @classmethod
+    def scan(cls, out_dir):
+        return {file.stem: str(file.absolute()) for file in Path(out_dir).glob(f'*.{cls.extension}')}
+
+
+class FlacSink(WavSink):
+    """One 16-bit FLAC file per utterance, <out_dir>/<utid>.flac"""
+    extension = 'flac'
+    format = 'FLAC'
+
+
+class ShardSink(AudioSink):
+    """
+    Utterances appended to a single file <out_dir>/<name>.shard, each one a
+    complete WAV (or FLAC, payload='flac') file. <out_dir>/<name>.index lists
+    `utid offset length` of every utterance and wav.scp values are
+    `<shard_path>:<offset>:<length>`.
+
+    Appends are not synchronised: processes writing concurrently must use
+    different names.
+    """
+
+    def __init__(self, out_dir, name='audio', payload='wav'):
+        super().__init__(out_dir)
+        self.format = payload.upper()
+        self.shard_path = (self.out_dir / f'{name}.shard').absolute()
+        self.index_path = self.out_dir / f'{name}.index'
+        self._shard = open(self.shard_path, 'ab')
+        self._index = open(self.index_path, 'a', encoding='utf-8')
+
+    def _append(self, utid, file):
+        offset = self._shard.tell()
+        shutil.copyfileobj(file, self._shard)
+        self._shard.flush()
+        length = self._shard.tell() - offset
+        self._index.write(f'{utid} {offset} {length}\n')
+        self._index.flush()
+        return f'{self.shard_path}:{offset}:{length}', length
+
+    def write(self, utid, samples, sr):
+        buffer = io.BytesIO()
+        soundfile.write(buffer, _to_numpy(samples), sr, format=self.format, subtype='PCM_16')
+        buffer.seek(0)
+        return self._append(utid, buffer)
+
+    def write_blocks(self, utid, blocks, sr):
+        # the header needs the final length, so encode to a temporary file first
+        with tempfile.TemporaryFile(dir=self.out_dir) as tmp:
+            with soundfile.SoundFile(tmp, 'w', samplerate=sr, channels=1, format=self.format,
+                                     subtype='PCM_16') as f:
+                for samples in blocks:
+                    f.write(_to_numpy(samples))
+            tmp.seek(0)
+            return self._append(utid, tmp)
+
+    @classmethod
+    def scan(cls, out_dir):
+        entries = {}
+        for index_path in Path(out_dir).glob('*.index'):
+            shard_path = index_path.with_suffix('.shard').absolute()
+            with open(index_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 3 and line.endswith('\n'):
+                        entries[fields[0]] = f'{shard_path}:{fields[1]}:{fields[2]}'
+        return entries
+
+    def close(self):
+        self._shard.close()
+        self._index.close()
+
+
+AUDIO_SINKS = {'wav': WavSink, 'flac': FlacSink, 'shard': ShardSink}
+
+
+def get_audio_sink(output_format, out_dir, name='audio'):
+    """
+    Instantiates the sink for output_format ('wav', 'flac', 'shard' or
+    'shard_flac'). name is the shard name, processes writing to the same
+    out_dir in parallel must use different names.
+    """
+    if output_format == 'shard':
+        return ShardSink(out_dir, name=name)
+    if output_format == 'shard_flac':
+        return ShardSink(out_dir, name=name, payload='flac')
+    if output_format not in AUDIO_SINKS:
+        raise ValueError(f'Unknown output_format {output_format}, expected one of {", ".join(AUDIO_SINKS)}, shard_flac')
+    return AUDIO_SINKS[output_format](out_dir)
+
+
+def scan_audio_sink(output_format, out_dir):
+    """Returns a dict utid -> wav.scp value of the utterances already written to out_dir"""
+    if not Path(out_dir).exists():
+        return {}
+    return AUDIO_SINKS[output_format.split('_')[0]].scan(out_dir)
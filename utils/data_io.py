@@ -4,34 +4,178 @@ import json
 import pandas as pd
 import logging
 
+from collections.abc import Mapping
+import hashlib
+import mmap
+from operator import itemgetter
+import numpy as np
+import shlex
+import soundfile
+import struct
+import torch
 import torchaudio
 import io
 import os
 import subprocess
+import tempfile
+import threading
+
+from .audio_sink import SHARD_ENTRY
+from .resampling import resample as resample_wave
 
 logger = logging.getLogger(__name__)
 
 def read_kaldi_format(filename, return_as_dict=True, values_as_string=False):
-    key_list = []
-    value_list = []
+    table = read_kaldi_table(filename)
+    if not return_as_dict:
+        return table.keys_list(), table.values_list(values_as_string)
+    return table.to_dict(values_as_string)
+
+
+class KaldiTable(Mapping):
+    """Read-only dict-like view of a parsed Kaldi file (wav.scp, utt2spk, ...),
+    stored as columns: keys, values joined by a space and their number of
+    tokens. Values of more than one token are returned as lists, like
+    read_kaldi_format()."""
+
+    def __init__(self, keys, values, ntokens):
+        self.keys_column = keys
+        self.values_column = values
+        self.ntokens_column = ntokens
+        self._index = None
+
+    @property
+    def index(self):
+        # last occurrence wins, like dict(zip(keys, values))
+        if self._index is None:
+            self._index = {key: i for i, key in enumerate(self.keys_column)}
+        return self._index
+
+    def __getitem__(self, key):
+        i = self.index[key]
+        value = self.values_column[i]
+        return value.split() if self.ntokens_column[i] > 1 else value
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys_list(self):
+        return list(self.keys_column)
+
+    def values_list(self, values_as_string=False):
+        values = list(self.values_column)
+        if not values_as_string:
+            for i in np.flatnonzero(self.ntokens_column > 1).tolist():
+                values[i] = values[i].split()
+        return values
+
+    def to_dict(self, values_as_string=False):
+        return dict(zip(self.keys_column, self.values_list(values_as_string)))
+
+
+class KaldiDataDir:
+    """Kaldi data dir whose files are parsed once, data_dir['utt2spk'] is a
+    KaldiTable (see read_kaldi_table())"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def __getitem__(self, name):
+        return read_kaldi_table(self.path / name)
+
+    def __contains__(self, name):
+        return (self.path / name).is_file()
+
+
+# tables parsed by this process, path -> (stat signature, KaldiTable), shared by the threads of the process (e.g. the
+# concurrent stages of a pipeline)
+_kaldi_tables = {}
+_kaldi_tables_lock = threading.Lock()
+
+def _kaldi_cache_file(filename):
+    # the on-disk cache is opt-in: VPC_KALDI_CACHE=<dir> keeps the parsed tables in dir (safe to delete any time)
+    cache_dir = os.environ.get('VPC_KALDI_CACHE', '')
+    if not cache_dir:
+        return None
+    return Path(cache_dir) / (hashlib.sha1(str(filename).encode('utf-8')).hexdigest() + '.npz')
+
+def read_kaldi_table(filename):
+    """Parses a Kaldi file into a KaldiTable. Tables are kept in memory and,
+    if the VPC_KALDI_CACHE environment variable names a directory, cached on
+    disk as .npz of utf-8 string columns, both keyed by path, mtime and size,
+    so a file is only split into lines once."""
+    filename = Path(filename).absolute()
+    stat = filename.stat()
+    signature = np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+    with _kaldi_tables_lock:
+        cached = _kaldi_tables.get(filename)
+    if cached is not None and np.array_equal(cached[0], signature):
+        return cached[1]
+
+    cache_file = _kaldi_cache_file(filename)
+    table = None
+    if cache_file is not None and cache_file.exists():
+        try:
+            with np.load(cache_file, allow_pickle=False) as cache:
+                if np.array_equal(cache['signature'], signature):
+                    ntokens = cache['ntokens']
+                    table = KaldiTable(_unpack_strings(cache['keys'], len(ntokens)),
+                                       _unpack_strings(cache['values'], len(ntokens)), ntokens)
+        except Exception:
+            # truncated or corrupted (e.g. zipfile.BadZipFile), parsed and written again below
+            logger.debug(f'Removing invalid cache {cache_file} of {filename}')
+            try:
+                cache_file.unlink()
+            except OSError:
+                pass
+
+    if table is None:
+        table = _parse_kaldi_file(filename)
+        if cache_file is not None:
+            try:
+                cache_file.parent.mkdir(parents=True, exist_ok=True)
+                # unique per writer (process and thread), renamed when complete
+                fd, partial_file = tempfile.mkstemp(dir=cache_file.parent, prefix=cache_file.stem,
+                                                    suffix='.partial.npz')
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        np.savez(f, signature=signature, keys=_pack_strings(table.keys_column),
+                                 values=_pack_strings(table.values_column), ntokens=table.ntokens_column)
+                    os.replace(partial_file, cache_file)
+                except BaseException:
+                    os.unlink(partial_file)
+                    raise
+            except OSError as e:
+                logger.debug(f'Could not cache {filename}: {e}')
+
+    with _kaldi_tables_lock:
+        _kaldi_tables[filename] = (signature, table)
+    return table
+
+def _parse_kaldi_file(filename):
+    keys, values, ntokens = [], [], []
     with open(filename, 'r', encoding='utf-8') as f:
         for line in f:
-            splitted_line = line.split()
-            if len(splitted_line) == 1:
-                key_list.append(splitted_line[0].strip())
-                value_list.append("")
-            if len(splitted_line) == 2:
-                key_list.append(splitted_line[0].strip())
-                value_list.append(splitted_line[1].strip())
-            elif len(splitted_line) > 2:
-                key_list.append(splitted_line[0].strip())
-                if values_as_string:
-                    value_list.append(' '.join([x.strip() for x in splitted_line[1:]]))
-                else:
-                    value_list.append([x.strip() for x in splitted_line[1:]])
-    if not return_as_dict:
-        return key_list, value_list
-    return dict(zip(key_list, value_list))
+            tokens = line.split()
+            if not tokens:
+                continue
+            keys.append(tokens[0])
+            values.append(' '.join(tokens[1:]))
+            ntokens.append(len(tokens) - 1)
+    return KaldiTable(keys, values, np.array(ntokens, dtype=np.int32))
+
+def _pack_strings(strings):
+    # one utf-8 blob, lines never contain a newline
+    return np.frombuffer('\n'.join(strings).encode('utf-8'), dtype=np.uint8)
+
+def _unpack_strings(blob, count):
+    return blob.tobytes().decode('utf-8').split('\n') if count else []
 
 
 def load_wav_from_scp(wav, frame_offset: int = 0,  num_frames: int = -1):
@@ -39,6 +183,14 @@ def load_wav_from_scp(wav, frame_offset: int = 0,  num_frames: int = -1):
     and returns a pytorch tensor like it was open with torchaudio.load()
     (within some tolerance due to numerical precision))
 
+    Entries of the form <shard_path>:<offset>:<length> are read from the
+    memory-mapped shard, without subprocess (see utils.audio_sink.ShardSink
+    and utils.pack_data_dir).
+
+    The common `flac -c -d -s <file> |` and `sox <file> -t wav ... - |`
+    commands are decoded in-process by soundfile (see parse_scp_pipe()),
+    other commands run in a shell with subprocess.run.
+
     Args:
         wav: a list containing the scp entry
 
@@ -47,16 +199,21 @@ def load_wav_from_scp(wav, frame_offset: int = 0,  num_frames: int = -1):
     """
     if isinstance(wav, list):
         wav = " ".join(str(x) for x in wav)
-    if wav.strip().endswith("|"):
-        devnull = open(os.devnull, "w")
+    shard_entry = SHARD_ENTRY.match(wav.strip())
+    if shard_entry:
+        # utterance packed in a shard written by utils.audio_sink.ShardSink
+        sample, sr = _load_from_shard(shard_entry['path'], int(shard_entry['offset']), int(shard_entry['length']),
+                                      frame_offset=frame_offset, num_frames=num_frames)
+    elif wav.strip().endswith("|"):
         try:
-            wav_read_process = subprocess.Popen(
-                wav.strip()[:-1], stdout=subprocess.PIPE, shell=True, stderr=devnull
-            )
-            sample, sr = torchaudio.backend.soundfile_backend.load(
-                io.BytesIO(wav_read_process.communicate()[0]),
-                frame_offset=frame_offset, num_frames=num_frames
-            )
+            pipe = parse_scp_pipe(wav)
+            if pipe is not None:
+                sample, sr = _decode_pipe(pipe, frame_offset=frame_offset, num_frames=num_frames)
+            else:
+                sample, sr = torchaudio.backend.soundfile_backend.load(
+                    io.BytesIO(_run_pipe(wav.strip()[:-1])),
+                    frame_offset=frame_offset, num_frames=num_frames
+                )
         except Exception as e:
             raise IOError("Error processing wav file: {}\n{}".format(wav, e))
     else:
@@ -64,6 +221,213 @@ def load_wav_from_scp(wav, frame_offset: int = 0,  num_frames: int = -1):
 
     return sample, sr
 
+# long flac options of the pipes decoded in-process, as their short form
+_FLAC_LONG_OPTIONS = {'--decode': 'd', '--stdout': 'c', '--silent': 's'}
+
+def parse_scp_pipe(wav):
+    """Parses a wav.scp pipe entry that can be decoded without subprocess:
+        flac -c -d -s <file> |
+        sox [-t <type>] <file> -t wav [-b 16] [-e signed-integer] [-r <sr>] [-c 1] [-R] - [rate <sr>] [channels 1] |
+
+    Args:
+        wav: the scp entry, as a string or a list
+
+    Returns:
+        a dict with the decoded `path`, the output `sr` and `channels` (None to
+        keep those of the file) and the output `bits` (None to keep them), or
+        None for any other command
+    """
+    if isinstance(wav, list):
+        wav = " ".join(str(x) for x in wav)
+    try:
+        tokens = shlex.split(wav.strip())
+    except ValueError:
+        return None
+    if not tokens or tokens[-1] != '|':
+        return None
+    program, args = os.path.basename(tokens[0]), tokens[1:-1]
+
+    if program == 'flac':
+        flags = set()
+        files = []
+        for arg in args:
+            if arg in _FLAC_LONG_OPTIONS:
+                flags.add(_FLAC_LONG_OPTIONS[arg])
+            elif arg.startswith('-') and len(arg) > 1 and set(arg[1:]) <= set('cdsf'):
+                flags.update(arg[1:])
+            elif not arg.startswith('-'):
+                files.append(arg)
+            else:
+                return None
+        if {'c', 'd'} <= flags and len(files) == 1:
+            return {'path': files[0], 'sr': None, 'channels': None, 'bits': None}
+        return None
+
+    if program == 'sox':
+        # options before the input file apply to the input, between the input and `-` to the output
+        pipe = {'path': None, 'sr': None, 'channels': None, 'bits': None}
+        i = 0
+        while i < len(args) and args[i] != '-':
+            arg = args[i]
+            if arg in ('-t', '--type', '-b', '--bits', '-e', '--encoding', '-r', '--rate', '-c', '--channels'):
+                if i + 1 >= len(args):
+                    return None
+                value = args[i + 1]
+                if pipe['path'] is None:
+                    # the input type is detected by soundfile
+                    if arg not in ('-t', '--type'):
+                        return None
+                elif arg in ('-t', '--type') and value != 'wav' \
+                        or arg in ('-b', '--bits') and value != '16' \
+                        or arg in ('-e', '--encoding') and value != 'signed-integer' \
+                        or arg in ('-c', '--channels') and value != '1':
+                    return None
+                elif arg in ('-b', '--bits'):
+                    pipe['bits'] = 16
+                elif arg in ('-r', '--rate'):
+                    pipe['sr'] = int(float(value.rstrip('k')) * (1000 if value.endswith('k') else 1))
+                elif arg in ('-c', '--channels'):
+                    pipe['channels'] = 1
+                i += 2
+            elif arg in ('-R', '-q', '--no-show-progress'):
+                i += 1
+            elif not arg.startswith('-') and pipe['path'] is None:
+                pipe['path'] = arg
+                i += 1
+            else:
+                return None
+        if pipe['path'] is None or i >= len(args):
+            return None
+        # effects after the output
+        effects = args[i + 1:]
+        while effects:
+            if effects[0] == 'rate' and len(effects) >= 2:
+                options = [e for e in effects[1:] if e.startswith('-')]
+                if set(options) - {'-v', '-h', '-m'} or len(effects) < 2 + len(options):
+                    return None
+                value = effects[1 + len(options)]
+                pipe['sr'] = int(float(value.rstrip('k')) * (1000 if value.endswith('k') else 1))
+                effects = effects[2 + len(options):]
+            elif effects[:2] == ['channels', '1']:
+                pipe['channels'] = 1
+                effects = effects[2:]
+            else:
+                return None
+        return pipe
+    return None
+
+def _decode_pipe(pipe, frame_offset=0, num_frames=-1):
+    """Decodes a command parsed by parse_scp_pipe() like its output wav
+    would be read by load_wav_from_scp()"""
+    info = soundfile.info(pipe['path'])
+    sr = info.samplerate
+    resample = pipe['sr'] is not None and pipe['sr'] != sr
+    mix = pipe['channels'] == 1 and info.channels > 1
+    if not resample and not mix:
+        # the samples are read as they are, seek directly
+        stop = None if num_frames < 0 else frame_offset + num_frames
+        samples, _ = soundfile.read(pipe['path'], start=frame_offset, stop=stop, dtype='float32', always_2d=True)
+        sample = torch.from_numpy(np.ascontiguousarray(samples.T))
+    else:
+        samples, _ = soundfile.read(pipe['path'], dtype='float32', always_2d=True)
+        sample = torch.from_numpy(np.ascontiguousarray(samples.T))
+        if mix:
+            sample = sample.mean(dim=0, keepdim=True)
+        if resample:
+            sample = resample_wave(sample, sr, pipe['sr'], method='sinc_hann')
+            sr = pipe['sr']
+        sample = sample[:, frame_offset:] if num_frames < 0 else sample[:, frame_offset:frame_offset + num_frames]
+    if pipe['bits'] == 16 or (resample or mix) and info.subtype == 'PCM_16':
+        # quantized like the 16-bit wav the command would write
+        sample = torch.clamp(torch.round(sample * 32768), -32768, 32767) / 32768
+    return sample, sr
+
+def _run_pipe(cmd):
+    # commands parse_scp_pipe() does not handle run in a shell, their output is the wav
+    return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, shell=True).stdout
+
+# read-only memory maps of the shards opened by this process, by path
+_shard_maps = {}
+_shard_maps_lock = threading.Lock()
+
+def _shard_map(path, end):
+    with _shard_maps_lock:
+        shard_map = _shard_maps.get(path)
+        # remap shards that grew since they were mapped
+        if shard_map is None or len(shard_map) < end:
+            with open(path, 'rb') as f:
+                shard_map = _shard_maps[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return shard_map
+
+def _pcm16_layout(data):
+    """Returns (data offset, number of bytes, channels, sampling rate) of a
+    16-bit PCM WAV file in the buffer data, None for any other format"""
+    if len(data) < 12 or data[0:4] != b'RIFF' or data[8:12] != b'WAVE':
+        return None
+    pos, fmt = 12, None
+    while pos + 8 <= len(data):
+        chunk_id, chunk_size = data[pos:pos + 4], struct.unpack_from('<I', data, pos + 4)[0]
+        if chunk_id == b'fmt ':
+            # PCM or WAVE_FORMAT_EXTENSIBLE
+            audio_format, channels, sr = struct.unpack_from('<HHI', data, pos + 8)
+            bits = struct.unpack_from('<H', data, pos + 22)[0]
+            if audio_format not in (1, 0xFFFE) or bits != 16:
+                return None
+            fmt = (channels, sr)
+        elif chunk_id == b'data':
+            if fmt is None:
+                return None
+            return pos + 8, min(chunk_size, len(data) - pos - 8), *fmt
+        pos += 8 + chunk_size + chunk_size % 2
+    return None
+
+def _load_from_shard(path, offset, length, frame_offset=0, num_frames=-1):
+    """16-bit PCM WAV payloads are decoded straight from the memory-mapped
+    shard, other payloads (FLAC) through soundfile"""
+    data = memoryview(_shard_map(path, offset + length))[offset:offset + length]
+    layout = _pcm16_layout(data)
+    if layout is None:
+        return torchaudio.backend.soundfile_backend.load(
+            io.BytesIO(data), frame_offset=frame_offset, num_frames=num_frames
+        )
+    data_offset, nbytes, channels, sr = layout
+    frames = np.frombuffer(data, dtype='<i2', count=nbytes // 2, offset=data_offset).reshape(-1, channels)
+    frames = frames[frame_offset:] if num_frames < 0 else frames[frame_offset:frame_offset + num_frames]
+    # same scaling as soundfile for 16-bit PCM
+    sample = torch.from_numpy(np.ascontiguousarray(frames.T, dtype=np.float32) / 32768)
+    return sample, sr
+
+def load_wav_blocks_from_scp(wav, blocksize: int):
+    """Reads a wav.scp entry block by block instead of loading it at once,
+    with the same values as load_wav_from_scp()
+
+    Plain paths and `flac -c -d -s <file> |` entries are read incrementally
+    through soundfile. Other entries with an embeded unix command and shard
+    entries are decoded with load_wav_from_scp() and then split.
+
+    Args:
+        wav: a list containing the scp entry
+        blocksize: number of samples per block
+
+    Returns:
+        blocks: generator of np.array float32 (blocksize, ) of the first channel
+        sr: sampling rate
+    """
+    if isinstance(wav, list):
+        wav = " ".join(str(x) for x in wav)
+    pipe = parse_scp_pipe(wav) if wav.strip().endswith("|") else None
+    if pipe is not None and pipe['sr'] is None and pipe['channels'] is None and pipe['bits'] is None:
+        # plain decode of a file, read it incrementally
+        wav = pipe['path']
+    if wav.strip().endswith("|") or SHARD_ENTRY.match(wav.strip()):
+        sample, sr = load_wav_from_scp(wav)
+        sample = sample[0].numpy()
+        blocks = (sample[i:i + blocksize] for i in range(0, len(sample), blocksize))
+    else:
+        sr = soundfile.info(wav).samplerate
+        blocks = (block[:, 0] for block in soundfile.blocks(wav, blocksize=blocksize, dtype='float32', always_2d=True))
+    return blocks, sr
+
 def read_table(filename, names, sep=' ', dtype=None):
     if isinstance(dtype, list):
         dtype = dict(zip(names, dtype))
@@ -82,22 +446,85 @@ def read_matrix(filename):
     return matrix
 
 
+def _kaldi_items(data):
+    if isinstance(data, list):
+        if len(data) == 2 and not isinstance(data[0], tuple):
+            return list(zip(data[0], data[1]))
+        return data
+    return list(data.items())
+
+def _write_kaldi_lines(f, items):
+    for key, value in items:
+        if isinstance(value, list):
+            value = ' '.join(value)
+        try:
+            #value = value.encode('utf-8')
+            f.write(f'{key} {value}\n')
+        except UnicodeEncodeError:
+            logger.error(f'{key} {value}')
+            raise
+
 def save_kaldi_format(data, filename):
+    """Writes data (a dict, a list of (key, value) or [keys, values]) sorted
+    by key. The file is written under a temporary name and renamed, so
+    filename is never partial."""
+    items = _kaldi_items(data)
     if isinstance(data, list):
-        if len(data) == 2:
-            data = dict(zip(data[0], data[1]))
-        elif isinstance(data[0], tuple) and len(data[0]) == 2:
-            data = dict(data)
-    with open(filename, 'w', encoding='utf-8') as f:
-        for key, value in sorted(data.items(), key=lambda x: x[0]):
-            if isinstance(value, list):
-                value = ' '.join(value)
-            try:
-                #value = value.encode('utf-8')
-                f.write(f'{key} {value}\n')
-            except UnicodeEncodeError:
-                logger.error(f'{key} {value}')
-                raise
+        # the last value of a duplicated key wins, like in a dict
+        items = list(dict(items).items())
+    filename = Path(filename)
+    partial_file = filename.with_name(f'{filename.name}.{os.getpid()}.tmp')
+    with open(partial_file, 'w', encoding='utf-8') as f:
+        _write_kaldi_lines(f, sorted(items, key=itemgetter(0)))
+    os.replace(partial_file, filename)
+
+
+class KaldiWriter:
+    """
+    Incremental writer of a Kaldi file for periodic checkpoints: append()
+    adds new entries to <filename>.partial in O(new entries), commit() sorts
+    everything once and atomically replaces filename with the same content
+    as save_kaldi_format(). Each append is sorted, so the final sort only
+    merges sorted runs.
+
+    With resume=True, the entries of an uncommitted previous run are kept.
+    """
+
+    def __init__(self, filename, resume=False):
+        self.filename = Path(filename)
+        self.partial_file = self.filename.with_name(f'{self.filename.name}.partial')
+        if not self.partial_file.exists():
+            return
+        if not resume:
+            self.partial_file.unlink()
+            return
+        # drop a line cut by a crash
+        with open(self.partial_file, 'rb+') as f:
+            content = f.read()
+            if content and not content.endswith(b'\n'):
+                f.truncate(content.rfind(b'\n') + 1)
+
+    def append(self, data):
+        items = sorted(_kaldi_items(data), key=itemgetter(0))
+        with open(self.partial_file, 'a', encoding='utf-8') as f:
+            _write_kaldi_lines(f, items)
+
+    def read(self, values_as_string=False):
+        """Returns the entries appended so far, like read_kaldi_format()"""
+        if not self.partial_file.exists():
+            return {}
+        return read_kaldi_format(self.partial_file, values_as_string=values_as_string)
+
+    def commit(self):
+        entries = {}
+        if self.partial_file.exists():
+            with open(self.partial_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    key, _, value = line.rstrip('\n').partition(' ')
+                    entries[key] = value
+        save_kaldi_format(entries, self.filename)
+        if self.partial_file.exists():
+            self.partial_file.unlink()
 
 
 def parse_yaml(filename, overrides=None):
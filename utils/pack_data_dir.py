@@ -0,0 +1,70 @@
+from pathlib import Path
+from multiprocessing import Pool
+import typer
+import numpy as np
+from tqdm import tqdm
+from typing_extensions import Annotated
+
+from utils import read_kaldi_format, save_kaldi_format, copy_data_dir, load_wav_from_scp
+from utils.audio_sink import ShardSink
+
+
+def pack_shard(shard_dir, name, payload, entries):
+    wav_scp = {}
+    with ShardSink(shard_dir, name=name, payload=payload) as sink:
+        for utt, wav in entries:
+            sample, sr = load_wav_from_scp(wav)
+            # back to the 16-bit values of the source, soundfile would scale floats by 32767
+            sample = np.clip(np.round(sample[0].numpy() * 32768), -32768, 32767).astype(np.int16)
+            wav_scp[utt], _ = sink.write(utt, sample, sr)
+    return wav_scp
+
+
+def pack_data_dir(data_dir: Path, output_dir: Path, payload: str = 'wav', utts_per_shard: int = 2000, nj: int = 4):
+    """
+        Copies the Kaldi data dir data_dir to output_dir with the audio of
+        wav.scp (files or `cmd |` pipes) packed into output_dir/shards/*.shard.
+        The new wav.scp points into the shards, which load_wav_from_scp() reads
+        through a memory map instead of a subprocess per utterance.
+    """
+    wav_scp = read_kaldi_format(data_dir / 'wav.scp')
+    copy_data_dir(data_dir, output_dir)
+    shard_dir = output_dir / 'shards'
+    shard_dir.mkdir(exist_ok=True)
+    for old_shard in shard_dir.glob('*'):
+        old_shard.unlink()
+
+    entries = list(wav_scp.items())
+    jobs = [(shard_dir, f'shard{i // utts_per_shard:05d}', payload, entries[i:i + utts_per_shard])
+            for i in range(0, len(entries), utts_per_shard)]
+    packed = {}
+    with Pool(processes=nj) as pool:
+        for shard_scp in tqdm(pool.imap_unordered(_pack_shard_job, jobs), total=len(jobs)):
+            packed.update(shard_scp)
+    save_kaldi_format(packed, output_dir / 'wav.scp')
+
+
+def _pack_shard_job(job):
+    return pack_shard(*job)
+
+
+def main(
+        data_dir: Path,
+        output_dir: Annotated[Path, typer.Argument(help='Packed copy of data_dir, must differ from it')],
+        payload: str = 'wav',
+        utts_per_shard: int = 2000,
+        nj: int = 4
+    ):
+    """
+        Packs the audio of a Kaldi data dir into indexed shards, e.g.
+            python -m utils.pack_data_dir data/libri_dev data/libri_dev_shards
+        payload is 'wav' (16-bit PCM, decoded straight from the memory map)
+        or 'flac' (smaller, decoded by soundfile).
+    """
+    assert data_dir.resolve() != output_dir.resolve(), 'output_dir must differ from data_dir'
+    assert payload in ('wav', 'flac'), f'Unknown payload {payload}, expected wav or flac'
+    pack_data_dir(data_dir, output_dir, payload=payload, utts_per_shard=utts_per_shard, nj=nj)
+
+
+if __name__ == '__main__':
+    typer.run(main)
@@ -3,6 +3,7 @@ from collections import defaultdict
 from shutil import copy
 from utils import save_kaldi_format, create_clean_dir, read_kaldi_format, get_datasets
 from .logger import setup_logger
+from .audio_sink import SHARD_ENTRY, AUDIO_SINKS
 import os,sys
 
 logger = setup_logger(__name__)
@@ -30,17 +31,14 @@ def combine_asr_data(input_dirs, output_dir):
     save_kaldi_format(spk2utt, output_dir / 'spk2utt')
 
 
-def list_wav_files_recursively(folder_path, extension=".wav"):
-    wav_files = []
+def list_audio_files_recursively(folder_path):
+    # utterances written by any audio sink (wav or flac files, shards) in folder_path and its subdirectories,
+    # utid -> wav.scp value
+    key_to_audio = {}
     for root, dirs, files in os.walk(folder_path):
-        for file in files:
-            if file.endswith(extension):
-                wav_files.append(os.path.join(root, file))
-    key_to_wav_files = {}
-    for wav in wav_files:
-        key, _ = os.path.splitext(os.path.basename(wav))
-        key_to_wav_files[key] = wav
-    return wav_files, key_to_wav_files
+        for sink in AUDIO_SINKS.values():
+            key_to_audio.update(sink.scan(root))
+    return key_to_audio
 
 
 def check_files(ori_folder, anon_folder, required_files):
@@ -77,6 +75,9 @@ def check_files(ori_folder, anon_folder, required_files):
                 ori_keys.remove(a_key)
 
                 audio = a.strip().split()[1]
+                shard_entry = SHARD_ENTRY.match(audio)
+                if shard_entry:
+                    audio = shard_entry.group('path')
                 if not os.path.isfile(audio):
                     logger.warning(f"{anon_folder / 'wav.scp'}: {a_key} (file: {audio}) is not a valid path.")
                     create_wavscp_formart_data(ori_folder, anon_folder)
@@ -87,21 +88,20 @@ def check_files(ori_folder, anon_folder, required_files):
 
 
 def create_wavscp_formart_data(ori_folder, anon_folder):
-    logger.info(f"Automatic wav.scp creation for {anon_folder} from {anon_folder}/**/*.wav")
+    logger.info(f"Automatic wav.scp creation for {anon_folder} from the audios (wav, flac or shards) in {anon_folder}/**/")
     ori_file = ori_folder / "wav.scp"
     anon_file = anon_folder / "wav.scp"
     wav_scp_content = ""
-    with open(ori_file, 'rb') as f2:
-        wav_files, key_to_wav_files = list_wav_files_recursively(anon_folder)
-        if len(wav_files) == 0:
-            logger.error(f"Directory {anon_folder}/**/* doesn't contain any audios, please create a wav.scp file with correct paths, or place the wavs in {anon_folder}/wav/$UTTID.wav")
+    key_to_audio = list_audio_files_recursively(anon_folder)
+    if len(key_to_audio) == 0:
+        logger.error(f"Directory {anon_folder}/**/* doesn't contain any audios, please create a wav.scp file with correct paths, or place the wavs in {anon_folder}/wav/$UTTID.wav")
+        exit(1)
+    for line in open(ori_file):
+        key = line.strip().split(' ')[0]
+        if key not in key_to_audio:
+            logger.error(f"{anon_folder} is missing {key}.")
             exit(1)
-        for line in open(ori_file):
-            key = line.strip().split(' ')[0]
-            if key not in key_to_wav_files:
-                logger.error(f"{Path(wav_files[0]).parent} is missing {key}.")
-                exit(1)
-            wav_scp_content += f"{key} {key_to_wav_files[key]}\n"
+        wav_scp_content += f"{key} {key_to_audio[key]}\n"
     with open(anon_file, 'w') as fp:
         fp.write(wav_scp_content)
 